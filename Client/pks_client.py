@@ -1,5 +1,5 @@
-# -*- coding: UTF8 -*-
-
-import pksclient
-
-pksclient.main()
+# -*- coding: UTF8 -*-
+
+import pksclient
+
+pksclient.main()
@@ -0,0 +1,47 @@
+# -*- coding: UTF8 -*-
+
+import hashlib
+import hmac
+import struct
+import time
+
+from .config import Config
+
+
+def get_acceptable_ports() -> list:
+    """
+    :return list: The acceptable ports, sorted, as the server numbers them.
+    """
+    excluded = set(Config.ports_blacklist)
+    return [port for port in Config.acceptable_port_range if 0 <= port < 1 << 16 and port not in excluded]
+
+
+def derive_sequence(secret: str, window: int, length: int, ports: list) -> list:
+    """
+    Computes the sequence of a time step, as the server does:
+    the i-th port is HMAC-SHA256(secret, window || i), mapped to one of the acceptable ports.
+
+    :param str secret: The secret shared with the server.
+    :param int window: A time step: the number of steps since the epoch.
+    :param int length: Number of ports.
+    :param list ports: The acceptable ports, sorted.
+    :return list: The sequence of this time step.
+    """
+    return [
+        ports[
+            int.from_bytes(
+                hmac.new(secret.encode("utf-8"), struct.pack(">QI", window, i), hashlib.sha256).digest(), "big"
+            ) % len(ports)
+        ] for i in range(length)
+    ]
+
+
+def get_current_sequence(now: float or None = None) -> list:
+    """
+    :param float|None now: Optional. A timestamp ; by default, the current time.
+    :return list: The sequence of the current time step.
+    """
+    if now is None:
+        now = time.time()
+    window = int(now // Config.sequence_time_step)
+    return derive_sequence(Config.sequence_secret, window, Config.sequences_length, get_acceptable_ports())
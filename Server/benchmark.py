@@ -0,0 +1,227 @@
+# -*- coding: UTF8 -*-
+
+"""
+
+Measures the throughput of the PKS server against a local mock of the Telegram Bot API.
+
+Synthetic users, each in their own chat, send commands to the bot.
+Each user sends its next command as soon as it receives the reply to the previous one.
+The mock server records when each reply is sent, which gives the latency of each command.
+
+Example:
+
+python3 benchmark.py --users 50 --commands 20 --engine async --latency 0.02
+
+The databases are created in a temporary directory.
+knockd is not configured by the benchmark, but note that the server still tries to start it on launch:
+preferably run this on a test machine.
+
+With --sequences, measures instead how many port sequences per second are generated:
+
+python3 benchmark.py --sequences 100000
+
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pks
+
+from pks.mock_telegram import MockTelegramServer
+from pks.sequencepool import SequencePool
+from pks.utils import Utils
+from pks.core import Core
+
+
+class LoadGenerator:
+
+    # Commands sent by the users, in turn. Every one of them gets a reply.
+    commands = ["/help", "/list_groups_members", "/add_perm 12345 member", "/remove_perm 12345 member"]
+
+    def __init__(self, server: MockTelegramServer, inject, users: int, commands_per_user: int):
+        """
+        :param MockTelegramServer server: The server the bot sends its replies to.
+        :param inject: Function called with (chat_id, text) to send a command to the bot.
+        :param int users: Number of users sending commands at the same time.
+        :param int commands_per_user: How many commands each user sends.
+        """
+        self.inject = inject
+        self.commands_per_user = commands_per_user
+        self.remaining = {str(1000 + i): commands_per_user for i in range(users)}
+        self.outstanding = {}  # Chat ID -> time the pending command was sent.
+        self.latencies = []
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        server.on_send = self.on_send
+
+    def start(self) -> None:
+        for chat_id in list(self.remaining):
+            self.send_next(chat_id)
+
+    def send_next(self, chat_id: str) -> None:
+        with self.lock:
+            index = self.commands_per_user - self.remaining[chat_id]
+            self.remaining[chat_id] -= 1
+            self.outstanding[chat_id] = time.monotonic()
+        self.inject(int(chat_id), self.commands[index % len(self.commands)])
+
+    def on_send(self, chat_id: str, text: str, reply_to: str or None) -> None:
+        with self.lock:
+            sent_at = self.outstanding.pop(chat_id, None)
+            if sent_at is None:
+                return
+            self.latencies.append(time.monotonic() - sent_at)
+            more = self.remaining[chat_id] > 0
+            if not more and not self.outstanding and not any(self.remaining.values()):
+                self.done.set()
+        if more:
+            self.send_next(chat_id)
+
+
+def percentile(values: list, p: float) -> float:
+    """
+    :param list values: A non-empty list of numbers.
+    :param float p: A percentile, between 0 and 100.
+    :return float: The value below which `p` percent of the values are.
+    """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def benchmark_sequences(count: int) -> None:
+    """
+    Compares the ways of generating `count` sequences of `Config.sequences_length` ports.
+
+    :param int count: Number of sequences generated by each method.
+    """
+    config = pks.Config
+    length = config.sequences_length
+    first, last = config.acceptable_port_range[0], config.acceptable_port_range[-1]
+
+    def randint_sequences() -> None:
+        # How the sequences were generated before the pool: not cryptographically secure, one port at a time.
+        for _ in range(count):
+            Utils.filter_port_list([random.randint(first, last) for _ in range(length)])
+
+    def batch_sequences() -> None:
+        SequencePool.generate(count, length, config.acceptable_port_range, tuple(config.ports_blacklist))
+
+    def pool_sequences() -> None:
+        for _ in range(count):
+            Core.generate_new_sequence()
+
+    def seeded_sequences() -> None:
+        for seed in range(1, count + 1):
+            Core.generate_new_sequence(seed=seed)
+
+    # Fills the pool, as it is when the server runs.
+    Core.get_sequence_pool()
+    time.sleep(0.5)
+    for name, function in [("randint", randint_sequences), ("batch", batch_sequences), ("pool", pool_sequences),
+                           ("seeded", seeded_sequences)]:
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {count} sequences in {elapsed:.3f} s ({count / elapsed:.0f} sequences/s)")
+
+
+def run_engine(target) -> None:
+    try:
+        target()
+    except SystemExit:
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="PKS load benchmark, against a mock of the Telegram Bot API.")
+    parser.add_argument("--users", type=int, default=20, help="Number of users sending commands at the same time.")
+    parser.add_argument("--commands", type=int, default=10, help="Number of commands sent by each user.")
+    parser.add_argument("--engine", choices=["polling", "async", "process"], default="polling",
+                        help="How the updates reach the bot. \"process\" calls PKS.process directly, without polling.")
+    parser.add_argument("--workers", type=int, default=8, help="Threads calling PKS.process, with --engine process.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Latency of the mock API, in seconds.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probability of a 500 error per API call.")
+    parser.add_argument("--window", type=float, default=0.0, help="Value of Config.outbox_coalesce_window.")
+    parser.add_argument("--global-rate", type=float, default=pks.Config.telegram_global_rate_limit,
+                        help="Value of Config.telegram_global_rate_limit (messages per second).")
+    parser.add_argument("--chat-rate", type=float, default=pks.Config.telegram_chat_rate_limit,
+                        help="Value of Config.telegram_chat_rate_limit (messages per second in a chat).")
+    parser.add_argument("--timeout", type=float, default=300, help="Maximum duration of the run, in seconds.")
+    parser.add_argument("--sequences", type=int, default=0,
+                        help="If set, measures the generation of this many port sequences instead.")
+    args = parser.parse_args()
+
+    if args.sequences:
+        benchmark_sequences(args.sequences)
+        return
+
+    os.chdir(tempfile.mkdtemp(prefix="pks-benchmark-"))
+
+    with MockTelegramServer(latency=args.latency, error_rate=args.error_rate, seed=0) as server:
+        pks.Config.telegram_api_url = server.url
+        pks.Config.telegram_token = server.token
+        pks.Config.outbox_coalesce_window = args.window
+        pks.Config.telegram_global_rate_limit = args.global_rate
+        pks.Config.telegram_chat_rate_limit = args.chat_rate
+        pks.Config.telegram_backoff_base = 0.01
+
+        bot = pks.TelegramBot()
+        pk = pks.PKS(bot)
+        # knockd is not managed by the benchmark: pretend it is running, so that "/help" answers.
+        pk.commands_o.running = True
+
+        if args.engine == "process":
+            executor = ThreadPoolExecutor(max_workers=args.workers)
+
+            def inject(chat_id: int, text: str) -> None:
+                executor.submit(pk.process, server.make_message(chat_id, chat_id, text))
+        else:
+            if args.engine == "async":
+                target = lambda: asyncio.run(pk.main_async())
+            else:
+                target = pk.main
+            engine = threading.Thread(target=run_engine, args=(target,), daemon=True)
+            engine.start()
+
+            def inject(chat_id: int, text: str) -> None:
+                server.push_message(chat_id, chat_id, text)
+
+        generator = LoadGenerator(server, inject, args.users, args.commands)
+        # The users are admins: their commands go through the databases and the outbox,
+        # instead of being answered right away with "Action forbidden".
+        pk.commands_o.permissions.add_users_to_group(list(generator.remaining), "admin")
+        calls_before = server.count_calls()
+        start = time.monotonic()
+        generator.start()
+        finished = generator.done.wait(args.timeout)
+        elapsed = time.monotonic() - start
+        calls = server.count_calls() - calls_before
+
+        if args.engine == "process":
+            executor.shutdown(wait=True)
+        elif args.engine == "polling":
+            # Stops polling, as "/shutdown" does, before the interpreter shuts the thread pools down.
+            pk.dispatcher.shutdown_requested.set_result(True)
+            engine.join(args.timeout)
+
+    processed = len(generator.latencies)
+    if not finished:
+        print(f"Timed out: only {processed} of {args.users * args.commands} commands got a reply.")
+    if processed == 0:
+        return
+    print(f"Engine: {args.engine} ; users: {args.users} ; API latency: {args.latency * 1000:.1f} ms")
+    print(f"Updates processed: {processed} in {elapsed:.2f} s ({processed / elapsed:.1f} updates/s)")
+    print(f"Command latency: p50 {percentile(generator.latencies, 50) * 1000:.1f} ms, "
+          f"p99 {percentile(generator.latencies, 99) * 1000:.1f} ms")
+    print(f"API calls per update: {calls / processed:.2f}")
+
+
+if __name__ == "__main__":
+    main()
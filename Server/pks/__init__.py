@@ -1,188 +1,391 @@
-# -*- coding: UTF8 -*-
-
-"""
-
-Main package.
-Most of the time, you want to modify "commands.py" instead of this file.
-
-"""
-
-import logging
-import time
-
-from .telegram import TelegramBot
-from .channels import Channels
-from .commands import Commands
-from .config import Config
-
-
-# Setup the configuration for logging.
-logging.basicConfig(
-    format='%(asctime)s - %(message)s',  # We add a timestamp to each log entries.
-    level=logging.INFO,
-    datefmt='%m/%d/%Y %I:%M:%S %p',
-    filename="/var/log/pks.log",
-    filemode="r+",
-)
-
-
-class PKS:
-
-    """
-    Main class
-
-    .. seealso :: run_server.py
-    """
-
-    def __init__(self, bot: TelegramBot):
-        self.bot = bot
-        self.chan = Channels(bot)
-        self.commands_o = Commands(self.chan)
-
-    def __del__(self):
-        del self.commands_o
-        del self.chan
-
-    def __set_commands(self, update: dict) -> None:
-        """
-        This function is used to set the class attribute "self.commands_l",
-        which contains every bot command as a tuple of three items:
-        The first is a callback to the associated function from the class Commands (accessible through
-        the object "commands_o").
-        The second is an integer indicating how many arguments are expected FROM THE USER.
-        These user-passed arguments are separated by spaces, such as "/add_perm user group".
-        The third is a list of arguments.
-        Note: this arg list is unpacked when calling the function, so each list item is an argument on its own.
-        """
-        self.commands_l = {
-            "/generate":
-                (self.commands_o.generate, 0, []),
-            "/start":
-                (self.commands_o.start, 0, []),
-            "/stop":
-                (self.commands_o.stop, 0, []),
-            "/forget":
-                (self.commands_o.forget, 0, [update['message']['chat']['id']]),
-            "/shutdown":
-                (self.commands_o.shutdown, 0, []),
-            "/list_groups_members":
-                (self.commands_o.list_groups_members, 0, []),
-            "/add_perm":
-                (self.commands_o.add_perm, 2, []),
-            "/remove_perm":
-                (self.commands_o.remove_perm, 2, []),
-        }
-        # Adds the "/help" command.
-        # Help will only print documentation for the functions listed above (in commands_l).
-        self.commands_l.update({"/help": [self.commands_o.help, 0, [list(self.commands_l.keys())]]})
-
-    def get_chat_text(self, update: dict) -> str:
-        """
-        :param dict update: A Telegram update.
-        :return str: A chat ID.
-        """
-        try:
-            chat_text = update['message']['text']  # May raise KeyError for some messages.
-        except KeyError:
-            chat_text = None
-        return chat_text
-
-    def get_chat_id(self, update: dict) -> str:
-        """
-        :param dict update: A Telegram update.
-        :return str: A chat ID.
-        """
-        return update['message']['chat']['id']
-
-    def get_message_id(self, update: dict) -> str:
-        """
-        :param dict update: A Telegram update.
-        :return str: A message ID.
-        """
-        return update['message']['message_id']
-
-    def get_user_id(self, update: dict) -> str:
-        """
-        :param dict update: A Telegram update.
-        :return str: A User ID.
-        """
-        return update['message']['from']['id']
-
-    def are_args_valid(self, found_args, expected_args) -> tuple:
-        if found_args > expected_args:
-            message = f"Too many arguments: expected {expected_args}, got {found_args}. Please refer to \"/help\"."
-            return False, message
-        elif found_args < expected_args:
-            message = f"Too few arguments: expected {expected_args}, got {found_args}. Please refer to \"/help\"."
-            return False, message
-        return True, None
-
-    def process(self, update: dict) -> None:
-        self.__set_commands(update)
-
-        chat_text: str = self.get_chat_text(update)
-        chat_id: str = self.get_chat_id(update)
-        message_id: str = self.get_message_id(update)
-        user_id: str = self.get_user_id(update)
-
-        # Register the channel by adding it to the broadcast list.
-        self.chan.add(chat_id)
-
-        # Set the "user_id" attribute of object "commands_o".
-        # It will be used to check if the user is allowed to launch the command.
-        self.commands_o.user_id = user_id
-
-        chat_msg = chat_text.split(" ")
-
-        # Get the command
-        command = chat_msg[0].split("@")[0]
-        # Get function
-        func = self.commands_l.get(command, [self.commands_o.invalid])[0]
-        # Get how many arguments should be provided by the user.
-        num_exp_args = self.commands_l.get(command, [None, 0])[1]
-        # Get additional arguments
-        args = self.commands_l.get(command, [None, None, []])[2]
-
-        chat_msg.pop(0)  # Removes the command, to only have the arguments.
-        original_args_length = len(args)
-
-        for arg in chat_msg:
-            args.append(arg)
-
-        found_args = len(args) - original_args_length
-
-        valid, message = self.are_args_valid(found_args, num_exp_args)
-        if valid:
-            # Call the function with its arguments and store the returned value.
-            # This value can either be a string (str) or nothing (None).
-            message = (func)(*args)
-
-        if message:
-            self.bot.send_message(chat_id, message, message_id)
-
-    def main(self, offset: int = 0) -> None:
-        """
-        :param int offset: Used to filter the messages already processed. Could be used to skip messages.
-        """
-        while True:
-            all_updates = self.bot.get_updates(offset)
-
-            if len(all_updates) > 0:
-                for current_update in all_updates:
-                    try:
-                        # Filters the updates: only process the ones who starts with "/".
-                        try:
-                            upd_txt = current_update['message']['text']  # May raise KeyError for some messages.
-                        except KeyError:
-                            pass
-                        else:
-                            upd_time = current_update['message']['date']
-                            if upd_txt.startswith("/") and (int(time.time()) - upd_time) < Config.telegram_timeout:
-                                logging.debug(current_update)
-                                self.process(current_update)
-                    except SystemExit:
-                        del self
-                        raise SystemExit
-
-                    update_id = current_update['update_id']
-                    offset = update_id + 1
+# -*- coding: UTF8 -*-
+
+"""
+
+Main package.
+Most of the time, you want to modify "commands.py" instead of this file.
+
+"""
+
+import asyncio
+import inspect
+import logging
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+
+from .telegram import TelegramBot
+from .channels import Channels
+from .commands import Commands
+from .permissions import Permissions
+from .config import Config
+from .core import Core
+from .webhook import WebhookServer
+from .checkpoint import OffsetCheckpoint
+from .outbox import Outbox
+from .dispatcher import Dispatcher
+
+
+# Setup the configuration for logging.
+logging.basicConfig(
+    format='%(asctime)s - %(message)s',  # We add a timestamp to each log entries.
+    level=logging.INFO,
+    datefmt='%m/%d/%Y %I:%M:%S %p',
+    filename="/var/log/pks.log",
+    filemode="r+",
+)
+
+
+class PKS:
+
+    """
+    Main class
+
+    .. seealso :: run_server.py
+    """
+
+    # Read by `__del__()`, which is also called when `__init__()` failed before setting it.
+    time_sequences = None
+
+    def __init__(self, bot: TelegramBot):
+        self.bot = bot
+        self.outbox = Outbox(bot, Config.outbox_coalesce_window, Config.broadcast_workers)
+        self.chan = Channels(bot, self.outbox)
+        self.commands_o = Commands(self.chan)
+        self.__set_commands()
+        self.checkpoint = OffsetCheckpoint(Config.telegram_offset_file)
+        self.dispatcher = Dispatcher(Config.dispatcher_workers)
+        # Time-based sequences are written to knockd as time goes.
+        self.time_sequences = Core.get_time_sequences()
+        if self.time_sequences is not None:
+            self.time_sequences.start()
+
+    def __del__(self):
+        if self.time_sequences is not None:
+            self.time_sequences.close()
+        del self.commands_o
+        del self.chan
+        # Sends the replies still queued.
+        self.outbox.close()
+
+    def __set_commands(self) -> None:
+        """
+        This function is used to set the class attribute "self.commands_l",
+        which contains every bot command as a tuple of three items:
+        The first is a callback to the associated function from the class Commands (accessible through
+        the object "commands_o").
+        The second is an integer indicating how many arguments are expected FROM THE USER.
+        A negative number -n means "at least n": the function takes the others as variadic arguments.
+        These user-passed arguments are separated by spaces or line breaks, such as "/add_perm user group".
+        The third is a list of functions, each taking the update as argument and returning an argument to pass
+        to the command (for instance the ID of the chat the command was sent in).
+        These arguments come first, in this order, followed by the user-passed arguments.
+        The registry is built once ; it must not depend on a specific update.
+        """
+        self.commands_l = {
+            "/generate":
+                (self.commands_o.generate, 0, []),
+            "/start":
+                (self.commands_o.start, 0, []),
+            "/stop":
+                (self.commands_o.stop, 0, []),
+            "/forget":
+                (self.commands_o.forget, 0, [self.get_chat_id]),
+            "/shutdown":
+                (self.commands_o.shutdown, 0, []),
+            "/list_groups_members":
+                (self.commands_o.list_groups_members, 0, []),
+            "/add_perm":
+                (self.commands_o.add_perm, 2, []),
+            "/remove_perm":
+                (self.commands_o.remove_perm, 2, []),
+            "/add_perms":
+                (self.commands_o.add_perms, -2, []),
+            "/remove_perms":
+                (self.commands_o.remove_perms, -2, []),
+            "/import_perms":
+                (self.commands_o.import_perms, -1, []),
+        }
+        # Adds the "/help" command.
+        # Help will only print documentation for the functions listed above (in commands_l).
+        # As the registry, it is built once.
+        help_text = "Commands available: \n\n"
+        for command in sorted(self.commands_l):
+            help_text += "{}: {}\n".format(command, inspect.getdoc(self.commands_l[command][0]))
+        self.commands_l.update({"/help": (self.commands_o.help, 0, [lambda update: help_text])})
+        # Used for unknown commands.
+        self.invalid_command = (self.commands_o.invalid, 0, [])
+
+    def get_chat_text(self, update: dict) -> str:
+        """
+        :param dict update: A Telegram update.
+        :return str: A chat ID.
+        """
+        try:
+            chat_text = update['message']['text']  # May raise KeyError for some messages.
+        except KeyError:
+            chat_text = None
+        return chat_text
+
+    def get_chat_id(self, update: dict) -> str:
+        """
+        :param dict update: A Telegram update.
+        :return str: A chat ID.
+        """
+        return update['message']['chat']['id']
+
+    def get_message_id(self, update: dict) -> str:
+        """
+        :param dict update: A Telegram update.
+        :return str: A message ID.
+        """
+        return update['message']['message_id']
+
+    def get_user_id(self, update: dict) -> str:
+        """
+        :param dict update: A Telegram update.
+        :return str: A User ID.
+        """
+        return update['message']['from']['id']
+
+    def are_args_valid(self, found_args, expected_args) -> tuple:
+        if expected_args < 0:
+            if found_args < -expected_args:
+                message = f"Too few arguments: expected at least {-expected_args}, got {found_args}. " \
+                          f"Please refer to \"/help\"."
+                return False, message
+            return True, None
+        if found_args > expected_args:
+            message = f"Too many arguments: expected {expected_args}, got {found_args}. Please refer to \"/help\"."
+            return False, message
+        elif found_args < expected_args:
+            message = f"Too few arguments: expected {expected_args}, got {found_args}. Please refer to \"/help\"."
+            return False, message
+        return True, None
+
+    def is_update_processable(self, update: dict) -> bool:
+        """
+        Filters the updates: only the commands (messages starting with "/") sent
+        less than `Config.telegram_timeout` seconds ago should be processed.
+
+        :param dict update: A Telegram update.
+        :return bool: True if the update should be processed, False otherwise.
+        """
+        try:
+            upd_txt = update['message']['text']  # May raise KeyError for some messages.
+        except KeyError:
+            return False
+        upd_time = update['message']['date']
+        return upd_txt.startswith("/") and (int(time.time()) - upd_time) < Config.telegram_timeout
+
+    def execute(self, update: dict) -> str or None:
+        """
+        Runs the command contained in an update.
+
+        :param dict update: A Telegram update.
+        :return str|None: The message to reply with, if any.
+        """
+        chat_text: str = self.get_chat_text(update)
+        chat_id: str = self.get_chat_id(update)
+        user_id: str = self.get_user_id(update)
+
+        # Register the channel by adding it to the broadcast list.
+        self.chan.add(chat_id)
+
+        chat_msg = chat_text.split()
+
+        # Get the command
+        command = chat_msg[0].split("@")[0]
+        # Get the function, how many arguments should be provided by the user,
+        # and how to get the additional arguments from the update.
+        func, num_exp_args, arg_getters = self.commands_l.get(command, self.invalid_command)
+
+        user_args = chat_msg[1:]  # Removes the command, to only have the arguments.
+
+        valid, message = self.are_args_valid(len(user_args), num_exp_args)
+        if valid:
+            args = [get_arg(update) for get_arg in arg_getters] + user_args
+            # Call the function with its arguments and store the returned value.
+            # This value can either be a string (str) or nothing (None).
+            # The user ID is used by the decorator "permissions_required" to check if the user is allowed
+            # to launch the command.
+            message = (func)(*args, user_id=str(user_id))
+
+        return message
+
+    def process(self, update: dict) -> None:
+        message = self.execute(update)
+        if message:
+            self.outbox.put(self.get_chat_id(update), message, self.get_message_id(update))
+
+    async def process_async(self, update: dict, stop: asyncio.Event, previous: asyncio.Task or None = None) -> None:
+        """
+        Asynchronous counterpart of `PKS.process`, used by `PKS.main_async`.
+        The command runs in the default executor, so that it does not block the event loop.
+
+        :param dict update: A Telegram update.
+        :param asyncio.Event stop: Set if the command asked for the bot to shutdown.
+        :param asyncio.Task|None previous: Optional. Task processing the previous update of the same chat ;
+        this one starts once it is done.
+        """
+        loop = asyncio.get_running_loop()
+        if previous is not None:
+            await asyncio.wait({previous})
+        try:
+            message = await loop.run_in_executor(None, self.execute, update)
+        except SystemExit:
+            stop.set()
+            return
+        except Exception:
+            logging.exception(f"Could not process update {update['update_id']}.")
+            return
+        if message:
+            self.outbox.put(self.get_chat_id(update), message, self.get_message_id(update))
+
+    def skip_backlog(self, offset: int, max_age: int or None = None) -> int:
+        """
+        Drops the pending updates older than `max_age` seconds, without processing them.
+        As Telegram returns the updates in order, whole batches are dropped at once
+        until one containing a recent update is found.
+
+        :param int offset: The offset polling would start from.
+        :param int|None max_age: Maximum age of the updates to keep, in seconds.
+        By default, `Config.telegram_startup_skip_age`.
+        :return int: The offset polling should start from.
+        """
+        if max_age is None:
+            max_age = Config.telegram_startup_skip_age
+        skipped = 0
+        while True:
+            all_updates = self.bot.get_updates(offset, timeout=0)
+            if len(all_updates) == 0:
+                break
+            # Updates which are not messages are never processed, whatever their age.
+            newest_date = max(u.get('message', {}).get('date', 0) for u in all_updates)
+            if (int(time.time()) - newest_date) < max_age:
+                # The older updates of this batch are filtered by the polling loop.
+                break
+            skipped += len(all_updates)
+            offset = all_updates[-1]['update_id'] + 1
+        if skipped > 0:
+            logging.info(f"Skipped {skipped} updates older than {max_age} seconds.")
+        return offset
+
+    def resume(self, offset: int = 0) -> int:
+        """
+        Computes the offset polling should start from: the one saved by the previous run (unless `offset` is greater),
+        minus the stale backlog.
+
+        :param int offset: The minimum offset.
+        :return int: An offset.
+        """
+        offset = max(offset, self.checkpoint.load())
+        offset = self.skip_backlog(offset)
+        self.checkpoint.save(offset)
+        return offset
+
+    def main(self, offset: int = 0) -> None:
+        """
+        The updates are processed by `Config.dispatcher_workers` threads ;
+        the updates of a same chat are processed one after the other, in order.
+
+        :param int offset: Used to filter the messages already processed. Could be used to skip messages.
+        By default, resumes after the last update processed by the previous run.
+        """
+        offset = self.resume(offset)
+        poller = ThreadPoolExecutor(max_workers=1)
+        while True:
+            # Polls in another thread, to notice right away a command asking for the bot to shutdown.
+            poll = poller.submit(self.bot.get_updates, offset)
+            wait({poll, self.dispatcher.shutdown_requested}, return_when=FIRST_COMPLETED)
+            if self.dispatcher.shutdown_requested.done():
+                # The thread running the request will finish on its own.
+                poller.shutdown(wait=False)
+                # Let the updates already dispatched be processed.
+                self.dispatcher.close()
+                del self
+                raise SystemExit
+
+            all_updates = poll.result()
+
+            if len(all_updates) > 0:
+                for current_update in all_updates:
+                    if self.is_update_processable(current_update):
+                        logging.debug(current_update)
+                        self.dispatcher.submit(self.get_chat_id(current_update), self.process, current_update)
+
+                    update_id = current_update['update_id']
+                    offset = update_id + 1
+
+                self.checkpoint.save(offset)
+
+    async def main_async(self, offset: int = 0) -> None:
+        """
+        Asynchronous alternative to `PKS.main`.
+        Each update is dispatched as a task, so polling and replies do not wait for the commands to complete.
+        At most `Config.async_max_concurrency` updates are handled at the same time ;
+        polling is paused when this limit is reached.
+        The updates of a same chat are processed one after the other, in order.
+
+        :param int offset: Used to filter the messages already processed. Could be used to skip messages.
+        """
+        loop = asyncio.get_running_loop()
+        # One thread per concurrent update, plus one for polling.
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=Config.async_max_concurrency + 1))
+        offset = await loop.run_in_executor(None, self.resume, offset)
+        semaphore = asyncio.Semaphore(Config.async_max_concurrency)
+        tasks = set()
+        chat_tasks = {}  # Chat ID -> task processing the last update received from this chat.
+        stop = asyncio.Event()
+        stop_waiter = asyncio.ensure_future(stop.wait())
+
+        def on_task_done(chat_id: str, task: asyncio.Task) -> None:
+            tasks.discard(task)
+            if chat_tasks.get(chat_id) is task:
+                del chat_tasks[chat_id]
+            semaphore.release()
+
+        while not stop.is_set():
+            poll = asyncio.ensure_future(self.bot.get_updates_async(offset))
+            await asyncio.wait({poll, stop_waiter}, return_when=asyncio.FIRST_COMPLETED)
+            if stop.is_set():
+                # The thread running the request will finish on its own.
+                poll.cancel()
+                break
+
+            for current_update in poll.result():
+                if self.is_update_processable(current_update):
+                    logging.debug(current_update)
+                    await semaphore.acquire()
+                    chat_id = self.get_chat_id(current_update)
+                    # The updates of a same chat are processed in order.
+                    task = asyncio.ensure_future(self.process_async(current_update, stop, chat_tasks.get(chat_id)))
+                    tasks.add(task)
+                    chat_tasks[chat_id] = task
+                    task.add_done_callback(partial(on_task_done, chat_id))
+
+                update_id = current_update['update_id']
+                offset = update_id + 1
+
+            self.checkpoint.save(offset)
+
+        # Let the commands already started finish before shutting down.
+        if tasks:
+            await asyncio.wait(tasks)
+        raise SystemExit
+
+    def main_webhook(self) -> None:
+        """
+        Alternative to `PKS.main` where the updates are pushed by Telegram to an embedded HTTP(S) server,
+        which removes the polling round-trip from the commands latency.
+
+        .. seealso :: WebhookServer
+        """
+        if Config.webhook_url:
+            self.bot.set_webhook(Config.webhook_url, Config.webhook_secret_token)
+        server = WebhookServer(self)
+        server.serve_forever()
+        if server.shutdown_requested:
+            del self
+            raise SystemExit
@@ -0,0 +1,676 @@
+# -*- coding: UTF8 -*-
+
+import gc
+import logging
+import pickle
+import shelve
+import sqlite3
+import struct
+import threading
+import zlib
+import os
+
+from .config import Config
+
+
+class Backend:
+
+    """
+    Storage engine used by `Database`.
+
+    A backend stores columns, as described in `Database`.
+    The dictionary columns are accessed key by key: their keys are always strings.
+    The other columns (lists, tuples) are read and written as a whole.
+
+    The backends are not thread-safe: `Database` serializes the calls.
+    Writes only need to be durable once `sync()` returned.
+    The methods modifying the files (writes, `sync()`, `close()` and opening) are called with the exclusive
+    lock of the database held, the others at least with the shared lock (see `Database`).
+
+    """
+
+    def __init__(self, db_name: str):
+        """
+        :param str db_name: The relative database path.
+        Creates the subdirectories for the file if they don't exist already.
+        """
+        self.db_name = db_name
+        directory = os.path.dirname(db_name)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def tags(value) -> set:
+        """
+        Lists the values under which an entry can be found by `find_keys()`:
+        the value itself, or its items if it is a list, tuple or set.
+        Only strings, integers and booleans are taken into account.
+
+        :param value: The value of an entry.
+        :return set: The representation of each of these values.
+        """
+        items = value if isinstance(value, (list, tuple, set, frozenset)) else [value]
+        return {repr(item) for item in items if isinstance(item, (str, int))}
+
+    def columns(self) -> dict:
+        """
+        :return dict{str: type}: The existing columns and their types.
+        """
+        raise NotImplementedError
+
+    def create_column(self, column: str, column_type: type) -> None:
+        raise NotImplementedError
+
+    def get_value(self, column: str) -> any:
+        """
+        :param str column: A column which is not a dictionary.
+        :return: Its content.
+        """
+        raise NotImplementedError
+
+    def set_value(self, column: str, value) -> None:
+        """
+        :param str column: A column which is not a dictionary.
+        :param value: Its new content.
+        """
+        raise NotImplementedError
+
+    def has_key(self, column: str, key: str) -> bool:
+        raise NotImplementedError
+
+    def get(self, column: str, key: str) -> any:
+        """
+        :param str column: A dictionary column.
+        :param str key: A key.
+        :return: The value of the key. Raises KeyError if it doesn't exist.
+        """
+        raise NotImplementedError
+
+    def put(self, column: str, key: str, value) -> None:
+        """
+        Creates or replaces an entry of a dictionary column.
+        """
+        raise NotImplementedError
+
+    def delete(self, column: str, key: str) -> None:
+        """
+        Removes an entry of a dictionary column. Does nothing if it does not exist.
+        """
+        raise NotImplementedError
+
+    def items(self, column: str) -> iter:
+        """
+        :param str column: A dictionary column.
+        :return iter: The (key, value) pairs of the column.
+        """
+        raise NotImplementedError
+
+    def find_keys(self, column: str, value) -> list:
+        """
+        :param str column: A dictionary column.
+        :param value: A string, integer or boolean.
+        :return list: The keys whose value is `value`, or contains it.
+        """
+        tag = repr(value)
+        return [key for key, item in self.items(column) if tag in self.tags(item)]
+
+    def generation(self) -> any:
+        """
+        :return: A value which changes when the database is modified by another process.
+        """
+        return None
+
+    def reload(self) -> None:
+        """
+        Called when another process modified the database, to take its changes into account.
+        """
+        pass
+
+    def sync(self) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        raise NotImplementedError
+
+
+class ShelveBackend(Backend):
+
+    """
+    Stores the database with `shelve`.
+
+    The database file (`db_name`) is a catalog holding the type of each column and the content of the columns
+    which are not dictionaries.
+    Each dictionary column is stored in its own file (`db_name.column`), with one entry per key,
+    so that reading or writing a single key does not load nor rewrite the whole column.
+
+    Databases using the former layout (one pickled value per column) are migrated when opened.
+
+    There is no index: `find_keys()` reads the whole column.
+
+    The changes of other processes are detected with the modification time and the size of the files.
+
+    """
+
+    # Version of the storage layout, stored in the catalog.
+    layout_version = 2
+
+    # Suffixes of the files of a shelf, depending on the dbm module used.
+    suffixes = ("", ".db", ".dat", ".dir")
+
+    # `dbm.dumb` parses its index with `ast.literal_eval()`, which must not be re-entered
+    # (SystemError "AST constructor recursion depth mismatch", see CPython issue gh-106905).
+    # It would be if the garbage collector finalized a database during the parsing, as `Database.__del__()` flushes it:
+    # the shelves are opened one at a time, with the garbage collector paused.
+    open_lock = threading.Lock()
+
+    @classmethod
+    def open_shelf(cls, path: str) -> shelve.Shelf:
+        """
+        :param str path: The file of the shelf, without the suffix added by the dbm module.
+        :return shelve.Shelf: The shelf, opened.
+        """
+        with cls.open_lock:
+            enabled = gc.isenabled()
+            gc.disable()
+            try:
+                return shelve.open(path)
+            finally:
+                if enabled:
+                    gc.enable()
+
+    def __init__(self, db_name: str):
+        super().__init__(db_name)
+        self.db = self.open_shelf(db_name)
+        # Opened files of the dictionary columns.
+        self.dict_columns = {}
+        if self.db.get("__layout__") != self.layout_version:
+            self.__migrate()
+
+    def __get_dict_column(self, column: str) -> shelve.DbfilenameShelf:
+        """
+        :param str column: The name of a dictionary column.
+        :return shelve.DbfilenameShelf: The file storing this column.
+        """
+        shelf = self.dict_columns.get(column)
+        if shelf is None:
+            shelf = self.open_shelf(f"{self.db_name}.{column}")
+            self.dict_columns[column] = shelf
+        return shelf
+
+    def __migrate(self) -> None:
+        """
+        Converts a database using the former layout, where each column was a single pickled value.
+        The catalog is updated last: if interrupted, the migration starts over on the next opening.
+        """
+        column_types = {}
+        for column in list(self.db.keys()):
+            if column.startswith("__"):
+                continue
+            value = self.db[column]
+            column_types[column] = type(value)
+            if type(value) == dict:
+                shelf = self.__get_dict_column(column)
+                for key, item in value.items():
+                    shelf[str(key)] = item
+                shelf.sync()
+        if column_types:
+            logging.info(f"Migrating database {self.db_name} to layout version {self.layout_version}.")
+        self.db["__columns__"] = column_types
+        self.db["__layout__"] = self.layout_version
+        for column, column_type in column_types.items():
+            if column_type == dict:
+                del self.db[column]
+        self.db.sync()
+
+    def columns(self) -> dict:
+        return dict(self.db["__columns__"])
+
+    def create_column(self, column: str, column_type: type) -> None:
+        column_types = self.db["__columns__"]
+        column_types[column] = column_type
+        if column_type != dict:
+            self.db[column] = column_type()
+        self.db["__columns__"] = column_types
+
+    def get_value(self, column: str) -> any:
+        return self.db[column]
+
+    def set_value(self, column: str, value) -> None:
+        self.db[column] = value
+
+    def has_key(self, column: str, key: str) -> bool:
+        return key in self.__get_dict_column(column)
+
+    def get(self, column: str, key: str) -> any:
+        return self.__get_dict_column(column)[key]
+
+    def put(self, column: str, key: str, value) -> None:
+        self.__get_dict_column(column)[key] = value
+
+    def delete(self, column: str, key: str) -> None:
+        shelf = self.__get_dict_column(column)
+        if key in shelf:
+            del shelf[key]
+
+    def items(self, column: str) -> iter:
+        shelf = self.__get_dict_column(column)
+        for key in list(shelf.keys()):
+            yield key, shelf[key]
+
+    def generation(self) -> tuple:
+        names = [self.db_name] + [f"{self.db_name}.{column}" for column in self.dict_columns]
+        stats = []
+        for path in [name + suffix for name in names for suffix in self.suffixes]:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            stats.append((path, stat.st_mtime_ns, stat.st_size))
+        return tuple(stats)
+
+    @staticmethod
+    def __discard(shelf: shelve.Shelf) -> None:
+        """
+        Closes a shelf without writing it: called when another process changed the files, which are more recent.
+        Once modified, `dbm.dumb` writes its whole index on closing, which would replace the one on disk.
+        Everything written by this process has been synced before.
+        """
+        if hasattr(shelf.dict, "_modified"):
+            shelf.dict._modified = False
+        shelf.close()
+
+    def reload(self) -> None:
+        # The dbm modules may keep part of the file in memory (i.e. the index of `dbm.dumb`): reopen them.
+        for shelf in self.dict_columns.values():
+            self.__discard(shelf)
+        self.__discard(self.db)
+        self.db = self.open_shelf(self.db_name)
+        self.dict_columns = {}
+
+    def sync(self) -> None:
+        for shelf in self.dict_columns.values():
+            shelf.sync()
+        self.db.sync()
+
+    def close(self) -> None:
+        for shelf in self.dict_columns.values():
+            shelf.close()
+        self.db.close()
+
+
+class SQLiteBackend(Backend):
+
+    """
+    Stores the database in a SQLite file (`db_name.sqlite`), in WAL mode:
+    readers, including other processes, are not blocked by the writer.
+
+    Structure:
+
+    - table "columns": name, type and content of the columns (the content only for the non-dictionary columns).
+    - table "entries": one row per key of the dictionary columns, the values being pickled.
+    - table "tags": indexes the entries by value (see `Backend.tags()`), which makes `find_keys()`
+      an indexed lookup, such as the active channels or the members of a group.
+
+    The changes of other processes are detected with "PRAGMA data_version".
+
+    """
+
+    types = {t.__name__: t for t in (dict, list, tuple, set)}
+
+    def __init__(self, db_name: str):
+        super().__init__(db_name)
+        # The connection is shared by the threads, `Database` serializes the calls.
+        # The statements are prepared once, and cached by the connection.
+        self.connection = sqlite3.connect(f"{db_name}.sqlite", check_same_thread=False, cached_statements=64)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS columns "
+                                    "(name TEXT PRIMARY KEY, type TEXT NOT NULL, value BLOB)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS entries "
+                                    "(column_name TEXT, key TEXT, value BLOB NOT NULL, "
+                                    "PRIMARY KEY (column_name, key)) WITHOUT ROWID")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS tags "
+                                    "(column_name TEXT, tag TEXT, key TEXT, "
+                                    "PRIMARY KEY (column_name, tag, key)) WITHOUT ROWID")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS tags_by_key ON tags (column_name, key)")
+
+    def columns(self) -> dict:
+        rows = self.connection.execute("SELECT name, type FROM columns")
+        return {name: self.types[column_type] for name, column_type in rows}
+
+    def create_column(self, column: str, column_type: type) -> None:
+        value = None if column_type == dict else pickle.dumps(column_type())
+        self.connection.execute("INSERT OR REPLACE INTO columns (name, type, value) VALUES (?, ?, ?)",
+                                (column, column_type.__name__, value))
+
+    def get_value(self, column: str) -> any:
+        row = self.connection.execute("SELECT value FROM columns WHERE name = ?", (column, )).fetchone()
+        if row is None:
+            raise KeyError(column)
+        return pickle.loads(row[0])
+
+    def set_value(self, column: str, value) -> None:
+        self.connection.execute("UPDATE columns SET value = ? WHERE name = ?", (pickle.dumps(value), column))
+
+    def has_key(self, column: str, key: str) -> bool:
+        row = self.connection.execute("SELECT 1 FROM entries WHERE column_name = ? AND key = ?",
+                                      (column, key)).fetchone()
+        return row is not None
+
+    def get(self, column: str, key: str) -> any:
+        row = self.connection.execute("SELECT value FROM entries WHERE column_name = ? AND key = ?",
+                                      (column, key)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return pickle.loads(row[0])
+
+    def put(self, column: str, key: str, value) -> None:
+        self.connection.execute("INSERT OR REPLACE INTO entries (column_name, key, value) VALUES (?, ?, ?)",
+                                (column, key, pickle.dumps(value)))
+        self.connection.execute("DELETE FROM tags WHERE column_name = ? AND key = ?", (column, key))
+        self.connection.executemany("INSERT INTO tags (column_name, tag, key) VALUES (?, ?, ?)",
+                                    [(column, tag, key) for tag in self.tags(value)])
+
+    def delete(self, column: str, key: str) -> None:
+        self.connection.execute("DELETE FROM entries WHERE column_name = ? AND key = ?", (column, key))
+        self.connection.execute("DELETE FROM tags WHERE column_name = ? AND key = ?", (column, key))
+
+    def items(self, column: str) -> iter:
+        rows = self.connection.execute("SELECT key, value FROM entries WHERE column_name = ?", (column, ))
+        for key, value in rows.fetchall():
+            yield key, pickle.loads(value)
+
+    def find_keys(self, column: str, value) -> list:
+        rows = self.connection.execute("SELECT key FROM tags WHERE column_name = ? AND tag = ?",
+                                       (column, repr(value)))
+        return [key for key, in rows]
+
+    def generation(self) -> int:
+        return self.connection.execute("PRAGMA data_version").fetchone()[0]
+
+    def sync(self) -> None:
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.commit()
+        self.connection.close()
+
+
+class LogBackend(Backend):
+
+    """
+    Log-structured storage: each write appends a small record to a log file (`db_name.log.N`),
+    while the whole content of the database is kept in memory.
+
+    When more than `Config.database_log_garbage_ratio` of the records of the log are outdated (their key
+    has been written again since), the log is compacted: the writes go to a new log, while a background thread
+    writes the content to a snapshot. On the next `sync()`, the snapshot replaces `db_name.snapshot`,
+    and the logs it covers are deleted.
+
+    On opening, the snapshot is loaded, then the logs written after it are replayed.
+    Each record is framed with its length and its CRC32: a record partially written (i.e. the server crashed
+    while appending it) is detected and truncated, leaving the database as it was after the last complete write.
+
+    """
+
+    # Length and CRC32 of the payload of a record.
+    header = struct.Struct("<II")
+
+    types = {t.__name__: t for t in (dict, list, tuple, set)}
+
+    def __init__(self, db_name: str):
+        super().__init__(db_name)
+        self.snapshot_path = f"{db_name}.snapshot"
+        self.lock = threading.RLock()  # Shared with the compaction thread.
+        self.compaction = None  # Thread writing the snapshot.
+        self.new_snapshot = None  # (path, number of the first log not covered) of the snapshot to install.
+        self.__load()
+
+    @classmethod
+    def frame(cls, payload: bytes) -> bytes:
+        """
+        :param bytes payload: The content of a record.
+        :return bytes: The record, as written in the files.
+        """
+        return cls.header.pack(len(payload), zlib.crc32(payload)) + payload
+
+    @classmethod
+    def read_records(cls, data: bytes) -> tuple:
+        """
+        Reads the records of a file, up to the first incomplete or corrupted one.
+
+        :param bytes data: The content of the file.
+        :return tuple: The list of the payloads, and the length of the valid part of the file.
+        """
+        records = []
+        offset = 0
+        while offset + cls.header.size <= len(data):
+            length, crc = cls.header.unpack_from(data, offset)
+            start = offset + cls.header.size
+            payload = data[start:start + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            records.append(payload)
+            offset = start + length
+        return records, offset
+
+    def __log_path(self, number: int) -> str:
+        return f"{self.db_name}.log.{number}"
+
+    def __log_numbers(self) -> list:
+        """
+        :return list: The numbers of the log files on disk, in ascending order.
+        """
+        prefix = os.path.basename(self.db_name) + ".log."
+        numbers = []
+        for name in os.listdir(os.path.dirname(self.db_name) or "."):
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                numbers.append(int(name[len(prefix):]))
+        return sorted(numbers)
+
+    def __read_snapshot(self, path: str) -> tuple:
+        """
+        A snapshot holds two records: the number of the first log it does not cover, then the content.
+
+        :param str path: The snapshot file.
+        :return tuple: The number of the first log not covered, and the list of the records' payloads.
+        """
+        try:
+            with open(path, "rb") as file:
+                records, _ = self.read_records(file.read())
+        except FileNotFoundError:
+            return 0, []
+        if len(records) != 2:
+            raise RuntimeError(f"The snapshot {path} is corrupted.")
+        return pickle.loads(records[0]), records
+
+    def __load(self) -> None:
+        """
+        Loads the snapshot and replays the logs written after it.
+        """
+        next_log, records = self.__read_snapshot(self.snapshot_path)
+        if records:
+            self.column_types, self.data = pickle.loads(records[1])
+        else:
+            self.column_types, self.data = {}, {}  # The content: column -> value.
+
+        # Records written since the snapshot, and the keys they concern.
+        self.log_records = 0
+        self.log_keys = set()
+        numbers = [number for number in self.__log_numbers() if number >= next_log]
+        for number in numbers:
+            path = self.__log_path(number)
+            with open(path, "rb") as file:
+                data = file.read()
+            records, length = self.read_records(data)
+            for payload in records:
+                self.__apply(pickle.loads(payload))
+            if length < len(data):
+                logging.warning(f"Truncating the incomplete end of {path} ({len(data) - length} bytes).")
+                with open(path, "r+b") as file:
+                    file.truncate(length)
+                    os.fsync(file.fileno())
+
+        self.log_number = max([next_log] + numbers)
+        self.log = open(self.__log_path(self.log_number), "ab")
+
+    def __apply(self, record: tuple) -> None:
+        """
+        Applies a record to the content in memory.
+
+        :param tuple record: ("column", column, type name), ("set", column, key, value), ("delete", column, key)
+        or ("value", column, value).
+        """
+        operation, column = record[:2]
+        if operation == "column":
+            column_type = self.types[record[2]]
+            self.column_types[column] = column_type
+            self.data[column] = column_type()
+        elif operation == "set":
+            self.data[column][record[2]] = record[3]
+            self.log_keys.add((column, record[2]))
+        elif operation == "delete":
+            self.data[column].pop(record[2], None)
+            self.log_keys.add((column, record[2]))
+        elif operation == "value":
+            self.data[column] = record[2]
+            self.log_keys.add((column, None))
+        self.log_records += 1
+
+    def __append(self, record: tuple) -> None:
+        """
+        Applies a record and appends it to the log.
+        The log is buffered: it is written to disk by `sync()`.
+        """
+        with self.lock:
+            self.__apply(record)
+            self.log.write(self.frame(pickle.dumps(record)))
+            if self.log_records < Config.database_log_compaction_min_records:
+                return
+            if self.compaction is not None and self.compaction.is_alive():
+                return
+            if 1 - len(self.log_keys) / self.log_records >= Config.database_log_garbage_ratio:
+                self.compact(wait=False)
+
+    def compact(self, wait: bool = True) -> None:
+        """
+        Starts a new log, and writes the content to a new snapshot, installed on the next `sync()`.
+        The snapshot is written by a background thread.
+
+        :param bool wait: Whether to wait for the snapshot to be written.
+        """
+        with self.lock:
+            if self.compaction is not None:
+                self.compaction.join()
+            self.log.flush()
+            os.fsync(self.log.fileno())
+            self.log.close()
+            self.log_number += 1
+            self.log = open(self.__log_path(self.log_number), "ab")
+            self.log_records = 0
+            self.log_keys = set()
+            # The values are never modified in place: copying the dictionaries is enough.
+            content = {column: dict(value) if isinstance(value, dict) else value for column, value in self.data.items()}
+            state = (self.log_number, dict(self.column_types), content)
+            self.compaction = threading.Thread(target=self.__write_snapshot, args=(state, ), daemon=True)
+            self.compaction.start()
+        if wait:
+            self.compaction.join()
+
+    def __write_snapshot(self, state: tuple) -> None:
+        """
+        Writes a snapshot to a temporary file.
+
+        :param tuple state: The number of the first log not covered, the column types and the content.
+        """
+        next_log, column_types, content = state
+        # Another process may be compacting the same database.
+        path = f"{self.snapshot_path}.{os.getpid()}.tmp"
+        try:
+            with open(path, "wb") as file:
+                file.write(self.frame(pickle.dumps(next_log)))
+                file.write(self.frame(pickle.dumps((column_types, content))))
+                file.flush()
+                os.fsync(file.fileno())
+        except OSError:
+            logging.exception(f"Could not compact the database {self.db_name}.")
+            return
+        # Not under `self.lock`: it is held by the callers joining this thread.
+        self.new_snapshot = (path, next_log)
+
+    def __install_snapshot(self) -> None:
+        """
+        Replaces the snapshot by the one written by the compaction, unless a more recent one has been installed
+        by another process meanwhile, then deletes the logs covered.
+        """
+        path, next_log = self.new_snapshot
+        self.new_snapshot = None
+        current, _ = self.__read_snapshot(self.snapshot_path)
+        if next_log > current:
+            os.replace(path, self.snapshot_path)
+            current = next_log
+        else:
+            os.remove(path)
+        for number in self.__log_numbers():
+            if number < current:
+                os.remove(self.__log_path(number))
+        logging.info(f"Database {self.db_name} compacted.")
+
+    def columns(self) -> dict:
+        return dict(self.column_types)
+
+    def create_column(self, column: str, column_type: type) -> None:
+        self.__append(("column", column, column_type.__name__))
+
+    def get_value(self, column: str) -> any:
+        return self.data[column]
+
+    def set_value(self, column: str, value) -> None:
+        self.__append(("value", column, value))
+
+    def has_key(self, column: str, key: str) -> bool:
+        return key in self.data[column]
+
+    def get(self, column: str, key: str) -> any:
+        return self.data[column][key]
+
+    def put(self, column: str, key: str, value) -> None:
+        self.__append(("set", column, key, value))
+
+    def delete(self, column: str, key: str) -> None:
+        if key in self.data[column]:
+            self.__append(("delete", column, key))
+
+    def items(self, column: str) -> iter:
+        with self.lock:
+            return iter(list(self.data[column].items()))
+
+    def generation(self) -> tuple:
+        stats = []
+        for path in [self.snapshot_path] + [self.__log_path(number) for number in self.__log_numbers()]:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            stats.append((path, stat.st_mtime_ns, stat.st_size))
+        return tuple(stats)
+
+    def reload(self) -> None:
+        with self.lock:
+            self.log.close()
+            self.__load()
+
+    def sync(self) -> None:
+        with self.lock:
+            self.log.flush()
+            os.fsync(self.log.fileno())
+            if self.new_snapshot is not None:
+                self.__install_snapshot()
+
+    def close(self) -> None:
+        with self.lock:
+            if self.compaction is not None:
+                self.compaction.join()
+            self.sync()
+            self.log.close()
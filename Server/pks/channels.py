@@ -1,117 +1,464 @@
-# -*- coding: UTF8 -*-
-
-import logging
-
-from .database import Database
-
-
-class Channels:
-    def __init__(self, bot):
-        self.bot = bot
-        self.db = ChannelsDatabase()
-
-    def add(self, chat_id: str) -> None:
-        """
-        Adds a new chat id to the known channels database.
-        If it already exists, set it to active, otherwise, create it.
-
-        :param str chat_id: A Telegram Chat ID.
-        """
-        if self.db.channel_exists(chat_id):
-            self.db.set_active(chat_id)
-        else:
-            self.db.add(chat_id)
-
-    def disable(self, chat_id: str) -> None:
-        """
-        Disables a chat id from the known channels database (only if it exists of course).
-
-        :param str chat_id: A Telegram Chat ID.
-        """
-        if self.db.channel_exists(chat_id):
-            self.db.disable(chat_id)
-
-    def broadcast(self, message: str) -> None:
-        """
-        Broadcast a message.
-        This means a message is sent to every active channel.
-
-        :param str message: The message to broadcast.
-        """
-        logging.info(f"Broadcasting message: \"{message}\"")
-        for chat_id in self.list_active_channels():
-            self.bot.send_message(chat_id, message)
-
-    def list_active_channels(self) -> list:
-        """
-        :return list: A list containing all the active channels.
-        """
-        column = self.db.query_column(self.db.db_columns[0])
-        return [row for row in column if column[row] is True]
-
-    def list_all_channels(self) -> list:
-        """
-        :return list: A list containing all the channels, active as well as inactive.
-        """
-        return [chan for chan in self.db.query_column(self.db.db_columns[0])]
-
-
-class ChannelsDatabase(Database):
-
-    """
-    Wrapper used to manipulate the channels database, still roughly low-level.
-    Verifications and assertions are done in the `Channels` class.
-
-    Database structure:
-
-    channels = dict{
-        channels = {
-            "channel_id1": True,
-            "channel_id2": False,
-        }
-    }
-
-    """
-
-    def __init__(self):
-        super().__init__(
-            "db/channels.db",
-            {
-                "channels": dict
-            }
-        )
-
-    def channel_exists(self, chat_id: str) -> bool:
-        """
-        :param str chat_id: The chat id to search for in the database.
-        :return bool: True if the channel id already exists in the database, False otherwise.
-        """
-        return self.key_exists(self.db_columns[0], chat_id)
-
-    def set_active(self, chat_id: str) -> None:
-        """
-        Set a channel as active.
-
-        :param str chat_id: A Telegram Chat ID.
-        """
-        # assert self.key_exists(self.db_columns[0], chat_id)
-        self.update(self.db_columns[0], chat_id, True)
-
-    def add(self, chat_id: str) -> None:
-        """
-        Adds a new chat id to the known channels database.
-        Does not care if the chat already exists ; should be checked beforehand.
-
-        :param str chat_id: A Telegram Chat ID.
-        """
-        self.insert_dict(self.db_columns[0], {chat_id: True})
-
-    def disable(self, chat_id: str) -> None:
-        """
-        Disables a chat id from the known channels database (removes it from broadcast list).
-        Does not care if the chat already exists ; should be checked beforehand.
-
-        :param str chat_id: A Telegram Chat ID.
-        """
-        # assert self.key_exists(self.db_columns[0], chat_id)
-        self.update(self.db_columns[0], chat_id, False)
+# -*- coding: UTF8 -*-
+
+import itertools
+import logging
+import threading
+import time
+import weakref
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from functools import partial
+
+from .database import Database
+from .telegram import UncertainRequest
+from .config import Config
+
+
+class Channels:
+
+    """
+    The channels (chats) the bot broadcasts to.
+
+    The outcome of each delivery is checked:
+    - the channels the bot cannot write to anymore (kicked, blocked, deleted chat) are disabled ;
+    - the messages which failed because of a transient error (network, 5xx, rate limit) are queued,
+      persistently, and sent again after an exponential backoff, see `retry_pending()`.
+    """
+
+    def __init__(self, bot, outbox=None, db_name: str or None = None):
+        """
+        :param TelegramBot bot: The bot sending the messages.
+        :param Outbox|None outbox: Optional. If set, the broadcasts are queued in it, to be merged with the other
+        messages sent to the same chats.
+        :param str|None db_name: Optional. Path of the database, see `ChannelsDatabase`.
+        """
+        self.bot = bot
+        self.outbox = outbox
+        self.db = ChannelsDatabase(db_name)
+        self.retry_lock = threading.RLock()
+        self.retry_timer = None
+        # Retries queued by a previous run.
+        self.__schedule_retries()
+
+    def add(self, chat_id: str) -> None:
+        """
+        Adds a new chat id to the known channels database.
+        If it already exists, set it to active, otherwise, create it.
+        Called for every message: if the channel is already active, the database is not accessed.
+
+        :param str chat_id: A Telegram Chat ID.
+        """
+        if self.db.is_active(chat_id):
+            return
+        if self.db.channel_exists(chat_id):
+            self.db.set_active(chat_id)
+        else:
+            self.db.add(chat_id)
+
+    def disable(self, chat_id: str) -> None:
+        """
+        Disables a chat id from the known channels database (only if it exists of course).
+
+        :param str chat_id: A Telegram Chat ID.
+        """
+        if self.db.channel_exists(chat_id):
+            self.db.disable(chat_id)
+
+    @staticmethod
+    def get_delivery_outcome(resp) -> str:
+        """
+        :param requests.Response|UncertainRequest|None resp: The response to a "sendMessage" request, None if the API
+        could not be reached, the error if the message may have been delivered without a response.
+        :return str: "delivered" ; "gone" if the bot cannot write to the chat anymore ; "transient" if the message
+        may be delivered later ; "failed" otherwise (i.e. the message itself is invalid, or sending it again could
+        deliver it twice).
+        """
+        if isinstance(resp, UncertainRequest):
+            return "failed"
+        if resp is None or resp.status_code == 429 or resp.status_code >= 500:
+            return "transient"
+        if resp.ok:
+            return "delivered"
+        if resp.status_code == 403:
+            # The bot was blocked, kicked, or the chat was deleted.
+            return "gone"
+        if resp.status_code == 400:
+            try:
+                description = resp.json().get("description", "")
+            except ValueError:
+                description = ""
+            if "chat not found" in description:
+                return "gone"
+        return "failed"
+
+    def __send_all(self, messages):
+        """
+        Sends messages concurrently, with `Config.broadcast_workers` threads, within the bot's rate limits.
+        At most `Config.broadcast_max_pending` messages are queued at the same time: `messages` is read as they are
+        sent.
+
+        :param messages: Iterable of (chat ID, text) pairs.
+        :return: A generator of (chat ID, text, response) tuples, in the order the messages were sent.
+        The response is None if the API could not be reached, the `UncertainRequest` if the message may have been
+        delivered without a response.
+        """
+        with ThreadPoolExecutor(max_workers=Config.broadcast_workers) as executor:
+            if self.outbox is not None:
+                send = self.outbox.put
+            else:
+                send = partial(executor.submit, self.bot.send_message)
+            pending = {}  # Future -> (chat ID, text).
+
+            def result(future) -> tuple:
+                chat_id, text = pending.pop(future)
+                try:
+                    resp = future.result()
+                except UncertainRequest as error:
+                    logging.warning(f"The message to channel {chat_id} may not have been delivered: {error}")
+                    resp = error
+                except Exception:
+                    logging.exception(f"Could not send a message to channel {chat_id}.")
+                    resp = None
+                return chat_id, text, resp
+
+            for chat_id, text in messages:
+                if len(pending) >= Config.broadcast_max_pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield result(future)
+                pending[send(chat_id, text)] = (chat_id, text)
+            for future in as_completed(list(pending)):
+                yield result(future)
+
+    def broadcast(self, message: str) -> dict:
+        """
+        Broadcast a message.
+        This means a message is sent to every active channel.
+        The messages are sent concurrently by `Config.broadcast_workers` threads, within the bot's rate limits.
+        At most `Config.broadcast_max_pending` messages are queued at the same time.
+        The channels which are gone are disabled, the transient failures are queued to be retried.
+
+        :param str message: The message to broadcast.
+        :return dict: For each channel, True if the message was delivered, False otherwise.
+        """
+        logging.info(f"Broadcasting message: \"{message}\"")
+        results = {}
+        outcomes = dict.fromkeys(["delivered", "gone", "transient", "failed"], 0)
+        gone = []
+        messages = ((chat_id, message) for chat_id in self.iter_active_channels())
+        for chat_id, text, resp in self.__send_all(messages):
+            outcome = self.get_delivery_outcome(resp)
+            outcomes[outcome] += 1
+            results[chat_id] = outcome == "delivered"
+            if outcome == "gone":
+                gone.append(chat_id)
+            elif outcome == "transient":
+                self.__queue_retry(chat_id, text)
+        self.db.disable_channels(gone)
+        if outcomes["transient"]:
+            self.__schedule_retries()
+        logging.info(f"Broadcast delivered to {outcomes['delivered']} of {len(results)} channels ; "
+                     f"{outcomes['gone']} channels gone (disabled), {outcomes['transient']} to retry, "
+                     f"{outcomes['failed']} failed.")
+        return results
+
+    @staticmethod
+    def __retry_entry(messages: list, attempts: int) -> dict:
+        """
+        :param list messages: The messages to send again.
+        :param int attempts: Number of retries already done.
+        :return dict: An entry of the retry queue, due after a delay doubled with each attempt.
+        """
+        delay = min(Config.broadcast_retry_max, Config.broadcast_retry_base * 2 ** attempts)
+        return {"messages": messages, "attempts": attempts, "due": time.time() + delay}
+
+    def __queue_retry(self, chat_id: str, message: str) -> None:
+        """
+        Queues a message which could not be delivered because of a transient error.
+        """
+        with self.db.transaction():
+            entry = self.db.get_retry(chat_id)
+            if entry is None:
+                entry = self.__retry_entry([message], 0)
+            elif message not in entry["messages"]:
+                entry["messages"].append(message)
+            self.db.set_retry(chat_id, entry)
+
+    @staticmethod
+    def __retry_reference(reference: weakref.ref) -> None:
+        """
+        Sends the retries due, unless the channels have been deleted in the meantime.
+        """
+        channels = reference()
+        if channels is None:
+            return
+        try:
+            channels.retry_pending()
+        except Exception:
+            logging.exception("Could not retry the broadcasts.")
+
+    def __schedule_retries(self) -> None:
+        """
+        Schedules `retry_pending()` for when the first retry is due.
+        """
+        retries = self.db.list_retries()
+        with self.retry_lock:
+            if self.retry_timer is not None:
+                self.retry_timer.cancel()
+                self.retry_timer = None
+            if not retries:
+                return
+            delay = max(0.0, min(entry["due"] for entry in retries.values()) - time.time())
+            self.retry_timer = threading.Timer(delay, self.__retry_reference, (weakref.ref(self), ))
+            self.retry_timer.daemon = True
+            self.retry_timer.start()
+
+    def retry_pending(self) -> int:
+        """
+        Sends again the messages which could not be delivered because of a transient error, once their delay passed.
+        The messages are given up after `Config.broadcast_max_retries` retries, or if their channel was disabled.
+        Called automatically ; also takes over the retries queued by other processes.
+
+        :return int: The number of channels retried.
+        """
+        with self.retry_lock:
+            now = time.time()
+            due = {chat_id: entry for chat_id, entry in self.db.list_retries().items() if entry["due"] <= now}
+            messages = [(chat_id, text) for chat_id, entry in due.items() if self.db.is_active(chat_id)
+                        for text in entry["messages"]]
+            undelivered = {}  # Chat ID -> messages which failed again.
+            gone = []
+            for chat_id, text, resp in self.__send_all(messages):
+                outcome = self.get_delivery_outcome(resp)
+                if outcome == "gone":
+                    gone.append(chat_id)
+                elif outcome == "transient":
+                    undelivered.setdefault(chat_id, []).append(text)
+            self.db.disable_channels(gone)
+            with self.db.transaction():
+                for chat_id, entry in due.items():
+                    current = self.db.get_retry(chat_id) or entry
+                    # Messages queued by a broadcast in the meantime.
+                    queued = [text for text in current["messages"] if text not in entry["messages"]]
+                    failed = undelivered.get(chat_id, [])
+                    attempts = entry["attempts"] + 1
+                    if not self.db.is_active(chat_id):
+                        self.db.set_retry(chat_id, None)
+                        continue
+                    if failed and attempts > Config.broadcast_max_retries:
+                        logging.warning(f"Giving up {len(failed)} messages to channel {chat_id} "
+                                        f"after {attempts} attempts.")
+                        failed = []
+                    if failed:
+                        self.db.set_retry(chat_id, self.__retry_entry(failed + queued, attempts))
+                    elif queued:
+                        self.db.set_retry(chat_id, self.__retry_entry(queued, 0))
+                    else:
+                        self.db.set_retry(chat_id, None)
+            if due:
+                logging.info(f"Retried the broadcasts to {len(due)} channels: {len(undelivered)} failed again, "
+                             f"{len(gone)} channels gone.")
+            self.__schedule_retries()
+            return len(due)
+
+    def iter_active_channels(self):
+        """
+        Iterates over the active channels, without copying them.
+        The channels activated or disabled meanwhile are not taken into account.
+
+        :return: A generator of Telegram Chat IDs.
+        """
+        yield from self.db.active_channels()
+
+    def list_active_channels(self, offset: int = 0, limit: int or None = None) -> list:
+        """
+        Can be paginated with `offset` and `limit`.
+
+        :param int offset: Number of channels to skip.
+        :param int|None limit: Maximum number of channels to return. None for all of them.
+        :return list: A list containing the active channels, in the order of `ChannelsDatabase.active_channels()`.
+        """
+        stop = None if limit is None else offset + limit
+        return list(itertools.islice(self.db.active_channels(), offset, stop))
+
+    def list_all_channels(self) -> list:
+        """
+        :return list: A list containing all the channels, active as well as inactive.
+        """
+        return [chan for chan in self.db.query_column(self.db.db_columns[0])]
+
+
+class ChannelsDatabase(Database):
+
+    """
+    Wrapper used to manipulate the channels database, still roughly low-level.
+    Verifications and assertions are done in the `Channels` class.
+
+    Database structure:
+
+    channels = dict{
+        channels = {
+            "channel_id1": True,
+            "channel_id2": False,
+        }
+        retries = {
+            "channel_id1": {"messages": ["text"], "attempts": 1, "due": 1700000000.0},
+        }
+    }
+
+    The active channels are also kept in memory, see `active_channels()`.
+    "retries" is the queue of the messages to send again, see `Channels.retry_pending()`.
+    The channels which have nothing to retry have no entry. It is also kept in memory, see `list_retries()`.
+
+    """
+
+    def __init__(self, db_name: str or None = None):
+        """
+        :param str|None db_name: Optional. Path of the database. Defaults to "db/channels.db".
+        """
+        super().__init__(
+            db_name or "db/channels.db",
+            {
+                "channels": dict,
+                "retries": dict
+            }
+        )
+        self.active = None  # See `active_channels()`. Loaded on first use.
+        self.active_reloads = None
+        self.retries = None  # See `list_retries()`. Loaded on first use.
+        self.retries_reloads = None
+
+    def active_channels(self) -> dict:
+        """
+        The dictionary is replaced, not modified, when a channel is activated or disabled:
+        it can be iterated over while the channels change. It must not be modified.
+
+        :return dict: The active channels as keys. They are in the order of the backend when loaded, which happens
+        again when another process modifies the database ; those activated since come last, in the order they were
+        activated.
+        """
+        with self.lock:
+            # Another process may have modified the channels.
+            reloads = self.check_changes()
+            if self.active is None or reloads != self.active_reloads:
+                self.active = dict.fromkeys(self.find_keys(self.db_columns[0], True))
+                self.active_reloads = reloads
+            return self.active
+
+    def is_active(self, chat_id: str) -> bool:
+        """
+        :param str chat_id: A Telegram Chat ID.
+        :return bool: True if the channel exists and is active, False otherwise.
+        """
+        return chat_id in self.active_channels()
+
+    def __set_active(self, chat_id: str, active: bool) -> None:
+        """
+        Writes the state of a channel, and updates the active channels.
+        """
+        with self.lock:
+            self.update(self.db_columns[0], chat_id, active)
+            if self.active is None or (chat_id in self.active) == active:
+                return
+            active_channels = dict(self.active)
+            if active:
+                active_channels[chat_id] = None
+            else:
+                del active_channels[chat_id]
+            self.active = active_channels
+
+    def channel_exists(self, chat_id: str) -> bool:
+        """
+        :param str chat_id: The chat id to search for in the database.
+        :return bool: True if the channel id already exists in the database, False otherwise.
+        """
+        return self.key_exists(self.db_columns[0], chat_id)
+
+    def set_active(self, chat_id: str) -> None:
+        """
+        Set a channel as active.
+
+        :param str chat_id: A Telegram Chat ID.
+        """
+        # assert self.key_exists(self.db_columns[0], chat_id)
+        self.__set_active(chat_id, True)
+
+    def add(self, chat_id: str) -> None:
+        """
+        Adds a new chat id to the known channels database.
+        Does not care if the chat already exists ; should be checked beforehand.
+
+        :param str chat_id: A Telegram Chat ID.
+        """
+        self.__set_active(chat_id, True)
+
+    def disable(self, chat_id: str) -> None:
+        """
+        Disables a chat id from the known channels database (removes it from broadcast list).
+        Does not care if the chat already exists ; should be checked beforehand.
+
+        :param str chat_id: A Telegram Chat ID.
+        """
+        # assert self.key_exists(self.db_columns[0], chat_id)
+        self.__set_active(chat_id, False)
+
+    def disable_channels(self, chat_ids: list) -> None:
+        """
+        Disables several chat ids, in a single transaction.
+        Does not care if the chats already exist ; should be checked beforehand.
+
+        :param list chat_ids: Telegram Chat IDs.
+        """
+        if not chat_ids:
+            return
+        with self.transaction():
+            for chat_id in chat_ids:
+                self.update(self.db_columns[0], chat_id, False)
+            chat_ids = set(chat_ids)
+            if self.active is not None:
+                self.active = {chat_id: None for chat_id in self.active if chat_id not in chat_ids}
+        logging.info(f"Disabled {len(chat_ids)} channels the bot cannot write to anymore.")
+
+    def get_retry(self, chat_id: str) -> dict or None:
+        """
+        :param str chat_id: A Telegram Chat ID.
+        :return dict|None: The entry of the retry queue of this channel, if any.
+        """
+        if self.key_exists(self.db_columns[1], chat_id):
+            return self.query(self.db_columns[1], chat_id)
+        return None
+
+    def set_retry(self, chat_id: str, entry: dict or None) -> None:
+        """
+        Writes the entry of the retry queue of a channel, and updates the retries in memory.
+
+        :param str chat_id: A Telegram Chat ID.
+        :param dict|None entry: The entry of the retry queue of this channel, None to remove it.
+        """
+        with self.lock:
+            retries = dict(self.list_retries())
+            if entry is None:
+                if retries.pop(chat_id, None) is None:
+                    return
+                self.delete(self.db_columns[1], chat_id)
+            else:
+                retries[chat_id] = entry
+                self.update(self.db_columns[1], chat_id, entry)
+            self.retries = retries
+
+    def list_retries(self) -> dict:
+        """
+        The dictionary is replaced, not modified, when an entry is written:
+        it can be iterated over while the retries change. Neither it nor its entries must be modified.
+
+        :return dict: Chat ID -> entry of the retry queue, for the channels which have one.
+        """
+        with self.lock:
+            # Another process may have modified the retries.
+            reloads = self.check_changes()
+            if self.retries is None or reloads != self.retries_reloads:
+                # The databases written before the entries could be deleted have None in their place.
+                self.retries = {chat_id: entry for chat_id, entry in self.query_column(self.db_columns[1]).items()
+                                if entry is not None}
+                self.retries_reloads = reloads
+            return self.retries
@@ -0,0 +1,62 @@
+# -*- coding: UTF8 -*-
+
+import logging
+import os
+
+from .config import Config
+
+
+class OffsetCheckpoint:
+
+    """
+    Persists the offset of the next update to fetch,
+    so that a restarted bot resumes where it stopped instead of downloading the whole backlog again.
+
+    The file is replaced atomically: a crash can never leave it half-written.
+    """
+
+    def __init__(self, path: str or None = None):
+        """
+        :param str|None path: The file the offset is stored in. If empty, nothing is persisted.
+        By default, `Config.telegram_offset_file`.
+        """
+        if path is None:
+            path = Config.telegram_offset_file
+        self.path = path
+        self.offset = None
+        if self.path:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+    def load(self) -> int:
+        """
+        :return int: The offset saved, or 0 if there is none.
+        """
+        if not self.path:
+            return 0
+        try:
+            with open(self.path, "r") as file:
+                self.offset = int(file.read().strip())
+        except FileNotFoundError:
+            self.offset = 0
+        except ValueError:
+            logging.warning(f"Invalid offset checkpoint {self.path}, starting from the earliest update.")
+            self.offset = 0
+        return self.offset
+
+    def save(self, offset: int) -> None:
+        """
+        Saves the offset, unless it did not change since the last call.
+
+        :param int offset: The offset of the next update to fetch.
+        """
+        if not self.path or offset == self.offset:
+            return
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as file:
+            file.write(str(offset))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+        self.offset = offset
@@ -1,69 +1,205 @@
-# -*- coding: UTF8 -*-
-
-
-class Config:
-
-    """
-    Class containing the configuration parameters used across the PKS project.
-
-    Each attribute (config variable) is type hinted - constructed as follows:
-    \
-    `variable_name: expected_type = value`
-
-    Variables can handle Python operations.
-
-    You could also add static functions to this class.
-    """
-
-    # Token of your bot
-    telegram_token: str = ""
-
-    # Maximum time between the moment the user sends a message and when the bot receives it.
-    # If a message is received after this delay, it will not be taken into account by the bot.
-    # Mainly useful to avoid processing commands sent when the bot was offline.
-    telegram_timeout: int = 5
-
-    # Note: to get your Telegram user ID, send "/start" to @userinfobot (via Telegram).
-
-    # A list of telegram userids which should be ADMINISTRATOR of the bot.
-    # Needs to be of type string. i.e: ["01234", "56789"]
-    # Note: if you're using the whitelist, make sure these admins are part of it.
-    telegram_user_admin_list: list = []
-
-    # A list of userids AUTHORIZED to send commands to the bot.
-    # Needs to be of type string. i.e: ["01234", "56789"]
-    # Watch out: if one or more ids are added to this list, ONLY them will be able to send commands.
-    telegram_user_whitelist: list = []
-    # A list of userids UNAUTHORIZED to send commands to the bot.
-    # Needs to be of type string. i.e: ["01234", "56789"]
-    # Can be used alongside the whitelist.
-    telegram_user_blacklist: list = []
-
-    # Range of acceptable ports ; first included, last not included (how a usual range works in Python)
-    # This variable MUST be a range.
-    acceptable_port_range: range = range(1025, 65536)
-    # Lists the ports that should not be used.
-    # If you want to exclude a range, use this syntax:
-    # ports_blacklist: list = [600, 601] + list(range(700, 800))
-    ports_blacklist: list = []
-
-    # Port to open and close. Usually, SSH.
-    target_port: int = 22
-
-    # Should the script use the following sequence as the open sequence (making the open sequence static).
-    # Should only be set to True for tests purposes.
-    use_open_sequence: bool = False
-    # The ports to use for the open sequence if the above parameter is set to True
-    open_sequence: list = [100, 200, 300]
-
-    # How many ports the knocking service uses. In most cases 3.
-    sequences_length: int = 3
-
-    # Absolute location of the knockd configuration file.
-    knockd_config_file: str = "/etc/knockd.conf"
-
-    # The packet manager of your Linux distro. Working for sure: apt and yum.
-    packet_manager: str = "apt"
-
-    # Network interface on which the service must listen.
-    network_interface: str = "eth0"
+# -*- coding: UTF8 -*-
+
+
+class Config:
+
+    """
+    Class containing the configuration parameters used across the PKS project.
+
+    Each attribute (config variable) is type hinted - constructed as follows:
+    \
+    `variable_name: expected_type = value`
+
+    Variables can handle Python operations.
+
+    You could also add static functions to this class.
+    """
+
+    # Token of your bot
+    telegram_token: str = ""
+
+    # Address of the Telegram Bot API.
+    # Only change it to use a local Bot API server, or the mock server used for benchmarks (see `benchmark.py`).
+    telegram_api_url: str = "https://api.telegram.org"
+
+    # Maximum time between the moment the user sends a message and when the bot receives it.
+    # If a message is received after this delay, it will not be taken into account by the bot.
+    # Mainly useful to avoid processing commands sent when the bot was offline.
+    telegram_timeout: int = 5
+    # At startup, the pending updates older than this (in seconds) are dropped in bulk,
+    # instead of being downloaded and filtered by the polling loop.
+    telegram_startup_skip_age: int = telegram_timeout
+    # File the offset of the next update to fetch is saved in, so that a restarted bot does not
+    # fetch the updates it already processed. Leave empty to disable.
+    telegram_offset_file: str = "db/offset"
+
+    # Maximum number of keep-alive connections kept open to the Telegram API.
+    telegram_pool_size: int = 10
+    # Time (in seconds) to wait for a connection to the Telegram API to be established.
+    telegram_connect_timeout: float = 5
+    # Time (in seconds) to wait for the Telegram API to answer, on top of the long polling timeout.
+    telegram_read_timeout: float = 10
+    # How many times a failed request (network error, 5xx or 429 response) is retried before giving up.
+    telegram_max_retries: int = 5
+    # Delays (in seconds) of the exponential backoff applied between two retries.
+    # The actual delay is picked randomly between 0 and min(max, base * 2 ** attempt), which
+    # avoids every client retrying at the same time.
+    telegram_backoff_base: float = 0.5
+    telegram_backoff_max: float = 30
+    # Maximum number of messages sent per second, all chats combined, and in a single chat.
+    # Telegram allows about 30 messages per second overall, and about one per second in a given chat.
+    telegram_global_rate_limit: float = 30
+    telegram_chat_rate_limit: float = 1
+
+    # The first message to an idle chat waits this delay (in seconds), to be merged with those queued right after it
+    # (i.e. a reply and the broadcast the command triggered). With 0, it is sent right away.
+    outbox_first_window: float = 0.1
+    # The messages queued for a chat while a message is being sent to it wait up to this delay (in seconds),
+    # and are merged into a single message.
+    # With 0, only the messages queued while it is being sent are merged.
+    outbox_coalesce_window: float = 0.5
+
+    # Number of messages sent at the same time when broadcasting.
+    # Should not exceed `telegram_pool_size`, otherwise connections will not be reused.
+    broadcast_workers: int = 8
+    # Maximum number of messages of a broadcast waiting to be sent: the channels are read as the messages are sent.
+    broadcast_max_pending: int = 1000
+    # The broadcast messages which could not be delivered because of a transient error (network, 5xx, rate limit)
+    # are sent again after `broadcast_retry_base` seconds, then after a delay doubled with each attempt
+    # (up to `broadcast_retry_max` seconds), and given up after `broadcast_max_retries` retries.
+    # The queue is kept in the channels database: it survives restarts.
+    # The channels the bot cannot write to anymore (blocked, kicked) are disabled.
+    broadcast_retry_base: float = 60
+    broadcast_retry_max: float = 3600
+    broadcast_max_retries: int = 8
+
+    # Number of updates processed at the same time by the "polling" engine.
+    # The updates of a same chat are always processed one after the other.
+    dispatcher_workers: int = 4
+
+    # How the server receives the updates:
+    # - "polling": a long polling loop, handing the commands to a pool of threads (`PKS.main`).
+    # - "async": long polling in an asyncio event loop, processing the commands as concurrent tasks (`PKS.main_async`).
+    # - "webhook": Telegram pushes the updates to an embedded HTTP(S) server (`PKS.main_webhook`).
+    engine: str = "polling"
+    # Maximum number of updates handled at the same time by the "async" engine.
+    async_max_concurrency: int = 8
+
+    # Public URL Telegram must push the updates to, when using the "webhook" engine.
+    # Its path must be `webhook_path`. i.e: "https://example.com:8443/pks"
+    # If empty, the webhook is expected to be registered already.
+    webhook_url: str = ""
+    # Address and port the embedded server listens on.
+    webhook_host: str = "0.0.0.0"
+    webhook_port: int = 8443
+    # Path on which the updates are accepted ; requests on other paths are rejected.
+    webhook_path: str = "/pks"
+    # Secret Telegram sends in the header "X-Telegram-Bot-Api-Secret-Token" of each request.
+    # Requests without it are rejected. Leave empty to disable the check (not recommended).
+    webhook_secret_token: str = ""
+    # Certificate and private key used to serve HTTPS.
+    # Leave empty to serve plain HTTP, for instance behind a reverse proxy handling TLS.
+    webhook_certfile: str = ""
+    webhook_keyfile: str = ""
+    # Number of threads processing the updates received.
+    webhook_workers: int = 4
+
+    # Storage engine of the databases (channels and permissions):
+    # - "shelve": files managed by the `shelve` module, one per dictionary column.
+    # - "sqlite": one SQLite file per database, in WAL mode, with indexed lookups by value
+    #   (active channels, members of a group). Recommended with many users or channels.
+    # - "log": an append-only log per database, with the content kept in memory. Writes are sequential appends ;
+    #   the log is compacted in the background (see below).
+    # Changing it does not convert the existing databases.
+    database_backend: str = "shelve"
+    # The writes to the databases are buffered and flushed to disk together:
+    # at most `database_flush_interval` seconds after the first pending write,
+    # or as soon as `database_max_dirty` writes are pending.
+    # The databases are also flushed on shutdown, but if the server crashes (or the machine loses power),
+    # the writes of the last `database_flush_interval` seconds may be lost.
+    # Set the interval to 0 to flush after every write.
+    database_flush_interval: float = 1
+    database_max_dirty: int = 100
+    # Maximum number of values kept in memory by each database, to answer the reads without accessing the disk.
+    database_cache_size: int = 10000
+    # How often (in seconds) the databases check whether another process (such as `trigger_sequence_change.py`)
+    # modified them. Their changes may not be seen before.
+    database_cache_check_interval: float = 1
+    # The databases can be shared by several processes (i.e. the server and `trigger_sequence_change.py`):
+    # they are protected by a readers / writer lock. A warning is logged when a process waits
+    # for this lock longer than this delay (in seconds).
+    database_lock_warning: float = 1
+    # With the "log" backend, the log is compacted into a snapshot once it holds at least
+    # `database_log_compaction_min_records` records, and this share of them has been overwritten since.
+    database_log_garbage_ratio: float = 0.5
+    database_log_compaction_min_records: int = 1000
+
+    # Note: to get your Telegram user ID, send "/start" to @userinfobot (via Telegram).
+
+    # A list of telegram userids which should be ADMINISTRATOR of the bot.
+    # Needs to be of type string. i.e: ["01234", "56789"]
+    # Note: if you're using the whitelist, make sure these admins are part of it.
+    telegram_user_admin_list: list = []
+
+    # A list of userids AUTHORIZED to send commands to the bot.
+    # Needs to be of type string. i.e: ["01234", "56789"]
+    # Watch out: if one or more ids are added to this list, ONLY them will be able to send commands.
+    telegram_user_whitelist: list = []
+    # A list of userids UNAUTHORIZED to send commands to the bot.
+    # Needs to be of type string. i.e: ["01234", "56789"]
+    # Can be used alongside the whitelist.
+    telegram_user_blacklist: list = []
+    # Optional. Files listing more userids for the whitelist and the blacklist, one per line
+    # (lines starting with "#" are ignored). They must exist.
+    # They are checked every `user_lists_check_interval` seconds, and reloaded when they changed,
+    # i.e. these lists can be updated without restarting the bot.
+    telegram_user_whitelist_file: str or None = None
+    telegram_user_blacklist_file: str or None = None
+    user_lists_check_interval: float = 1
+    # Maximum number of users whose permissions are kept in memory.
+    permissions_cache_size: int = 10000
+    # Maximum number of members listed per group by "/list_groups_members".
+    list_members_limit: int = 50
+
+    # Range of acceptable ports ; first included, last not included (how a usual range works in Python)
+    # This variable MUST be a range.
+    acceptable_port_range: range = range(1025, 65536)
+    # Lists the ports that should not be used.
+    # If you want to exclude a range, use this syntax:
+    # ports_blacklist: list = [600, 601] + list(range(700, 800))
+    # To change either while the server runs, replace it rather than modifying it in place (see `PortIndex.current()`).
+    ports_blacklist: list = []
+
+    # Port to open and close. Usually, SSH.
+    target_port: int = 22
+
+    # Should the script use the following sequence as the open sequence (making the open sequence static).
+    # Should only be set to True for tests purposes.
+    use_open_sequence: bool = False
+    # The ports to use for the open sequence if the above parameter is set to True
+    open_sequence: list = [100, 200, 300]
+
+    # How many ports the knocking service uses. In most cases 3.
+    sequences_length: int = 3
+    # Number of sequences generated in advance, so that "/generate" does not wait for their generation.
+    sequence_pool_size: int = 256
+
+    # Time-based sequences: if a secret is set, the sequence is derived from it and the current time step,
+    # as TOTP codes are, and rotates on its own. The client computes it without Telegram:
+    # the same secret, step, length and ports must be set in its configuration.
+    # Generate a secret with: python3 -c "import secrets; print(secrets.token_hex(32))"
+    sequence_secret: str or None = None
+    # Duration of a time step, in seconds.
+    sequence_time_step: int = 30
+    # Number of time steps written to knockd after the current one ; knockd is restarted every this many steps.
+    # The sequences of these steps stay valid until it is, so do not set it too high.
+    sequence_time_windows: int = 2
+
+    # Absolute location of the knockd configuration file.
+    knockd_config_file: str = "/etc/knockd.conf"
+
+    # The packet manager of your Linux distro. Working for sure: apt and yum.
+    packet_manager: str = "apt"
+
+    # Network interface on which the service must listen.
+    network_interface: str = "eth0"
@@ -1,127 +1,165 @@
-# -*- coding: UTF8 -*-
-
-import logging
-
-from hashlib import sha256
-from random import randint
-
-from .config import Config
-from .utils import Utils
-
-
-class Core:
-
-    """
-
-    This class contains the most relevant functions in the project, what makes the "core" of the project (haha get it ?)
-
-    Functions which are not core-related should be placed in the Utils class.
-
-    Classes Utils and Core are pretty much the same though.
-
-    All functions in this class should be static.
-
-    """
-
-    @staticmethod
-    def generate_new_sequence(num: int = Config.sequences_length, seed: int or None = None) -> list:
-        """
-        Generates a new sequence of ports.
-
-        :param int num: How many ports to generate.
-        :param int seed: A seed used by the generator. Calling the function with a same seed will return the same ports.
-        :return list[int]: A list of ports.
-
-        :example:
-
-        >>> Core.generate_new_sequence()
-        [6158, 16499, 8715]
-
-        >>> Core.generate_new_sequence()  # Returns a different list each time it is called.
-        [40596, 13335, 5189]
-
-        >>> Core.generate_new_sequence(num=3, seed=123456789)
-        [58045, 13282, 10510]
-
-        >>> Core.generate_new_sequence(num=4, seed=123456789)  # Another call ; same seed, different length
-        [58045, 13282, 10510, 3987]
-
-        """
-
-        logging.debug("Creating a new sequence with args num: int = %s, seed: int = %s.", Config.sequences_length, seed)
-
-        first_acceptable_port: int = Config.acceptable_port_range[0]
-        last_acceptable_port: int = Config.acceptable_port_range[-1:][0]
-
-        logging.debug("First acceptable port: %d ; last acceptable port: %d",
-                      first_acceptable_port, last_acceptable_port)
-
-        if seed:
-            port_list = [
-                int(
-                    # Hashes the index and the seed.
-                    sha256(
-                        str(i + seed).encode("utf-8")
-                    ).hexdigest(),
-                    16  # Converts the hexadecimal digest to decimal.
-                ) for i, _ in enumerate(range(num))
-            ]
-        else:
-            port_list = [
-                randint(
-                    # Applies the range to the randint function
-                    first_acceptable_port,
-                    last_acceptable_port
-                ) for _ in range(num)
-            ]
-
-        port_list = Utils.filter_port_list(port_list)
-
-        return port_list
-
-    @staticmethod
-    def set_open_sequence(port_sequence: list) -> None:
-        """
-        Writes a new list of ports to the knockd configuration file.
-
-        :param list port_sequence: A list containing the ports to write.
-        """
-        Core.configure_knockd(port_sequence)
-        Utils.restart_service("knockd")
-
-    @staticmethod
-    def configure_knockd(seq: list) -> None:
-        """
-        Rewrites the knockd configuration file.
-
-        :param list seq: The new sequence to write in the conf.
-        """
-
-        def knockd_conf(new_sequence: list) -> str:
-            """
-            Constructs a new configuration for knockd.
-
-            :param new_sequence: The new sequence to apply to knockd.
-            :return str: The new configuration for knockd.
-            """
-            return """
-[options]
-    logfile     = /var/log/knockd.log
-    interface   = {network_interface}
-
-[opencloseSSH]
-    sequence                = {open_sequence}
-    seq_timeout             = 5
-    start_command           = /sbin/iptables -I INPUT -s %IP% -p tcp --dport {ssh_port} -j ACCEPT
-    tcpflags                = syn
-    cmd_timeout             = 30
-    stop_command            = /sbin/iptables -D INPUT -s %IP% -p tcp --dport {ssh_port} -j ACCEPT
-        """.format(
-                open_sequence=", ".join([str(p) for p in new_sequence]),
-                network_interface=Config.network_interface,
-                ssh_port=Config.target_port,
-            )
-        # End of function knockd_conf()
-
-        with open(Config.knockd_config_file, "w") as conf_file:
-            conf_file.write(knockd_conf(seq))
+# -*- coding: UTF8 -*-
+
+import logging
+import threading
+
+from hashlib import sha256
+
+from .config import Config
+from .utils import Utils
+from .sequencepool import SequencePool
+from .portindex import PortIndex
+from .timesequence import TimeSequences
+
+
+class Core:
+
+    """
+
+    This class contains the most relevant functions in the project, what makes the "core" of the project (haha get it ?)
+
+    Functions which are not core-related should be placed in the Utils class.
+
+    Classes Utils and Core are pretty much the same though.
+
+    All functions in this class should be static.
+
+    """
+
+    # Created on first use, see `Core.get_sequence_pool()`.
+    sequence_pool = None
+    sequence_pool_lock = threading.Lock()
+    # Created on first use, see `Core.get_time_sequences()`.
+    time_sequences = None
+
+    @staticmethod
+    def get_sequence_pool() -> SequencePool:
+        """
+        :return SequencePool: The sequences generated in advance, shared by the whole process.
+        """
+        with Core.sequence_pool_lock:
+            if Core.sequence_pool is None:
+                Core.sequence_pool = SequencePool(Config.sequence_pool_size)
+            return Core.sequence_pool
+
+    @staticmethod
+    def get_time_sequences() -> TimeSequences or None:
+        """
+        :return TimeSequences|None: The time-based sequences, shared by the whole process ;
+        None if `Config.sequence_secret` is not set.
+        """
+        if not Config.sequence_secret:
+            return None
+        with Core.sequence_pool_lock:
+            if Core.time_sequences is None:
+                Core.time_sequences = TimeSequences(Config.sequence_secret)
+            return Core.time_sequences
+
+    @staticmethod
+    def generate_new_sequence(num: int = Config.sequences_length, seed: int or None = None) -> list:
+        """
+        Generates a new sequence of ports.
+        Without a seed, the ports are drawn from a cryptographically secure source ;
+        the sequences of `Config.sequences_length` ports are taken from a pool generated in advance.
+        With a seed, each hash is mapped to an acceptable port through the `PortIndex`.
+
+        :param int num: How many ports to generate.
+        :param int seed: A seed used by the generator. Calling the function with a same seed will return the same ports.
+        :return list[int]: A list of ports.
+
+        :example:
+
+        >>> Core.generate_new_sequence()
+        [6158, 16499, 8715]
+
+        >>> Core.generate_new_sequence()  # Returns a different list each time it is called.
+        [40596, 13335, 5189]
+
+        >>> Core.generate_new_sequence(num=3, seed=123456789)
+        [6747, 49231, 17962]
+
+        >>> Core.generate_new_sequence(num=4, seed=123456789)  # Another call ; same seed, different length
+        [6747, 49231, 17962, 1294]
+
+        """
+
+        logging.debug("Creating a new sequence with args num: int = %s, seed: int = %s.", Config.sequences_length, seed)
+
+        first_acceptable_port: int = Config.acceptable_port_range[0]
+        last_acceptable_port: int = Config.acceptable_port_range[-1:][0]
+
+        logging.debug("First acceptable port: %d ; last acceptable port: %d",
+                      first_acceptable_port, last_acceptable_port)
+
+        if not seed:
+            if num == Config.sequences_length:
+                return Core.get_sequence_pool().get()
+            sequence = SequencePool.generate(1, num, Config.acceptable_port_range, tuple(Config.ports_blacklist))[0]
+            return list(sequence)
+
+        index = PortIndex.current()
+        port_list = [
+            index.from_integer(
+                int(
+                    # Hashes the index and the seed.
+                    sha256(
+                        str(i + seed).encode("utf-8")
+                    ).hexdigest(),
+                    16  # Converts the hexadecimal digest to decimal.
+                )
+            ) for i, _ in enumerate(range(num))
+        ]
+
+        return port_list
+
+    @staticmethod
+    def set_open_sequence(*port_sequences: list) -> None:
+        """
+        Writes new lists of ports to the knockd configuration file.
+
+        :param list port_sequences: Lists containing the ports to write ; any of them opens the port.
+        """
+        Core.configure_knockd(*port_sequences)
+        Utils.restart_service("knockd")
+
+    @staticmethod
+    def configure_knockd(*sequences: list) -> None:
+        """
+        Rewrites the knockd configuration file.
+
+        :param list sequences: The new sequences to write in the conf, each in its own section.
+        """
+
+        def knockd_section(name: str, new_sequence: list) -> str:
+            """
+            Constructs a section of the configuration for knockd.
+
+            :param str name: Name of the section.
+            :param new_sequence: The new sequence to apply to knockd.
+            :return str: The section.
+            """
+            return """
+[{name}]
+    sequence                = {open_sequence}
+    seq_timeout             = 5
+    start_command           = /sbin/iptables -I INPUT -s %IP% -p tcp --dport {ssh_port} -j ACCEPT
+    tcpflags                = syn
+    cmd_timeout             = 30
+    stop_command            = /sbin/iptables -D INPUT -s %IP% -p tcp --dport {ssh_port} -j ACCEPT
+""".format(
+                name=name,
+                open_sequence=", ".join([str(p) for p in new_sequence]),
+                ssh_port=Config.target_port,
+            )
+        # End of function knockd_section()
+
+        conf = """
+[options]
+    logfile     = /var/log/knockd.log
+    interface   = {network_interface}
+""".format(network_interface=Config.network_interface)
+        for i, sequence in enumerate(sequences):
+            conf += knockd_section("opencloseSSH" if i == 0 else f"opencloseSSH{i + 1}", sequence)
+
+        with open(Config.knockd_config_file, "w") as conf_file:
+            conf_file.write(conf)
@@ -1,175 +1,535 @@
-# -*- coding: UTF8 -*-
-
-import shelve
-import os
-
-
-class Database:
-
-    """
-    This class is a low-level interface to a database.
-    Low-level because it does not make any verification and is pretty bare bones
-    - it just sends raw "commands" to the database object.
-
-    Usual database structure:
-
-    self.db = dict{
-        "column1": dict{
-            "value1": value,
-            "value2": value,
-            "value3": value,
-        },
-        "column2": list[
-            "value1",
-            "value2",
-        ]
-    }
-
-    """
-
-    def __init__(self, db_name: str, columns: dict):
-        """
-        Structure of "columns":
-
-        dict{
-            "column1": list,
-            "column2": dict,
-            "column3": tuple,
-        }
-
-        :param str db_name: Name of the database.
-        :param dict{str: type} columns: Uni-dimensional dictionary with each "key: value" pair representing
-        "column_name": type_of_column. "type_of_column" must be a type object (dict, list, tuple, set, etc).
-        """
-        self.db_name = db_name
-        self.db = self.__get_db(self.db_name)
-        self.db_columns = list(columns.keys())
-        for column in columns:
-            if not self.column_exists(column):
-                self.db[column] = (columns[column])()
-        self.db.sync()
-
-    def __del__(self):
-        self.db.close()
-
-    def __get_db(self, db_name: str) -> shelve.DbfilenameShelf:
-        """
-        Returns a DB object.
-        \
-        Creates the subdirectories for the file if it doesn't exist already.
-
-        :param str db_name: The relative database path (as the data will be stored in a file).
-        :return shelve.DbfilenameShelf: A database object.
-        """
-        try:
-            os.mkdir("/".join(db_name.split("/")[:-1]))
-        except FileExistsError:
-            pass
-        db = shelve.open(db_name)
-        return db
-
-    def insert_new_column(self, column_name: str, column_type: type) -> None:
-        """
-        Adds a new column to the database structure.
-
-        :param str column_name: The name of the new column.
-        :param type column_type: Its type as a type object (dict, list, tuple, etc.)
-        """
-        if column_type == dict:
-            ins = {column_name: {}}
-        elif column_type == list:
-            ins = {column_name: []}
-        elif column_type == tuple:
-            ins = {column_name: ()}
-        else:
-            raise TypeError(f"Invalid column type: {column_type} for new column named \"{column_name}\"")
-        self.db_columns.append(column_name)
-        self.db.update(ins)
-
-    def column_exists(self, column: str) -> bool:
-        """
-        Checks if the column exists in the database.
-
-        :param str column: A column name.
-        :return bool: True if it does, False otherwise.
-        """
-        return column in self.db
-
-    def key_exists(self, column: str, key: str) -> bool:
-        """
-        Checks if `key` exists in `column`.
-
-        :param str column: The column to parse.
-        :param str key: The key to search for.
-        :return bool: True if it exists, False otherwise.
-        """
-        # assert self.column_exists(column)
-        # assert type(key) == str
-        return key in self.db[column]
-
-    def insert_dict(self, column: str, pair: dict) -> None:
-        """
-        Adds a new value to a column in the database.
-        Used when the column's type is dict.
-        The column must exist. This check must be done beforehand.
-
-        :param str column: A column name.
-        :param dict pair: A dictionary.
-        """
-        cl = self.db[column]
-        # assert type(cl) == dict
-        cl.update(pair)
-        self.db[column] = cl
-        self.db.sync()
-
-    def insert_list(self, column: str, value) -> None:
-        """
-        Adds a new value to a column in the database.
-        Used when the column's type is list.
-        The column must exist. This check must be done beforehand.
-
-        :param str column: A column name.
-        :param value: A value to add. Can be of any type.
-        """
-        cl = self.db[column]
-        # assert type(cl) == list
-        cl.append(value)
-        self.db[column] = cl
-        self.db.sync()
-
-    def update(self, column: str, key: str, value) -> None:
-        """
-        Updates a field in the database.
-
-        :param str column: A column name.
-        :param str key: A key.
-        :param value: The new value.
-        """
-        # assert self.column_exists(column)
-        # assert self.key_exists(column, key)
-        cl = self.db[column]  # Get a copy of the column.
-        cl[key] = value  # Alters the copy.
-        self.db[column] = cl  # Replace the original by the copy.
-        self.db.sync()  # Update the database.
-
-    def query_column(self, search_column: str) -> any:
-        """
-        Returns the whole content of a column.
-
-        :param str search_column: A column name.
-        :return: The value of the column.
-        """
-        # assert self.column_exists(search_column)
-        return self.db[search_column]
-
-    def query(self, search_column: str, search_key: str) -> any:
-        """
-        Queries the value from column -> key.
-        Both column and key must exist in the DB.
-
-        :param str search_column: A column name.
-        :param str search_key: A key.
-        """
-        # assert self.column_exists(search_column)
-        # assert self.key_exists(search_column, search_key)
-        return self.db[search_column][search_key]
+# -*- coding: UTF8 -*-
+
+import atexit
+import copy
+import logging
+import threading
+import time
+import weakref
+import os
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+
+from .backends import ShelveBackend, SQLiteBackend, LogBackend
+from .filelock import FileLock
+from .config import Config
+
+
+class Database:
+
+    """
+    This class is a low-level interface to a database.
+    Low-level because it does not make any verification and is pretty bare bones
+    - it just sends raw "commands" to the database object.
+
+    Usual database structure:
+
+    self.db = dict{
+        "column1": dict{
+            "value1": value,
+            "value2": value,
+            "value3": value,
+        },
+        "column2": list[
+            "value1",
+            "value2",
+        ]
+    }
+
+    How the data is stored depends on the backend (see `pks.backends`), selected with `Config.database_backend`.
+    The keys of the dictionary columns are always stored as strings.
+
+    Every method is thread-safe. The attribute `lock` (reentrant) can be held by the subclasses
+    to make a sequence of operations atomic.
+
+    The writes are kept in memory, and flushed to disk in groups (write-behind): at most
+    `Config.database_flush_interval` seconds after the first pending write, as soon as `Config.database_max_dirty`
+    writes are pending, when `flush()` is called, when the database is closed and when the interpreter exits.
+
+    The values read are kept in a cache of `Config.database_cache_size` values (least recently used first out).
+    The values returned are copies: modifying them does not alter the cache.
+
+    Several processes can use the same database (i.e. the server and `trigger_sequence_change.py`).
+    The backend is only read with a shared lock, and only written (by `flush()`) with an exclusive lock,
+    held on the file `db_name.lock` (see `FileLock`). Transactions hold the exclusive lock from start to end.
+    The changes made by other processes are detected every `Config.database_cache_check_interval` seconds,
+    and before each flush.
+
+    Several writes can be grouped in a transaction, see `transaction()`.
+
+    """
+
+    backends = {
+        "shelve": ShelveBackend,
+        "sqlite": SQLiteBackend,
+        "log": LogBackend,
+    }
+
+    # Every database opened, flushed when the interpreter exits.
+    instances = weakref.WeakSet()
+
+    # Cached in place of the keys which do not exist.
+    missing = object()
+
+    # Written in place of the keys deleted, until they are flushed.
+    deleted = object()
+
+    def __init__(self, db_name: str, columns: dict, backend: str or None = None):
+        """
+        Structure of "columns":
+
+        dict{
+            "column1": list,
+            "column2": dict,
+            "column3": tuple,
+        }
+
+        :param str db_name: Name of the database.
+        :param dict{str: type} columns: Uni-dimensional dictionary with each "key: value" pair representing
+        "column_name": type_of_column. "type_of_column" must be a type object (dict, list, tuple, set, etc).
+        :param str|None backend: Optional. Name of the backend. Defaults to `Config.database_backend`.
+        """
+        self.db_name = db_name
+        self.lock = threading.RLock()
+        self.flush_timer = None
+        self.closed = False
+        self.cache = OrderedDict()  # Values read from the backend, the most recently used last.
+        self.versions = {}  # Column -> number of changes of this column in the backend, identifies the cached results.
+        self.pending = {}  # (column, key) -> value written, not flushed yet. The key is None for non-dict columns.
+        self.overlay = None  # Writes of the current transaction, see `transaction()`.
+        directory = os.path.dirname(db_name)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file_lock = FileLock.get(f"{db_name}.lock")
+        with self.file_lock.exclusive():
+            self.backend = self.backends[backend or Config.database_backend](db_name)
+            self.column_types = self.backend.columns()
+            self.db_columns = list(columns.keys())
+            for column in columns:
+                if not self.column_exists(column):
+                    self.__create_column(column, columns[column])
+            self.backend.sync()
+            # Identifies the state of the files, to detect the changes made by other processes.
+            self.generation = self.backend.generation()
+        self.generation_checked = time.monotonic()
+        self.reloads = 0  # Number of times the changes of another process were loaded.
+        self.instances.add(self)
+
+    def __del__(self):
+        self.close()
+
+    def close(self) -> None:
+        """
+        Flushes the pending writes and closes the database.
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.flush()
+            with self.file_lock.exclusive():
+                self.backend.close()
+            self.closed = True
+
+    def flush(self) -> None:
+        """
+        Writes to disk the changes not flushed yet.
+        """
+        with self.lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            if not self.pending or self.closed:
+                return
+            with self.file_lock.exclusive():
+                # Takes into account the changes of the other processes, so that they are not overwritten.
+                self.__check_generation(force=True)
+                for (column, key), value in self.pending.items():
+                    if key is None:
+                        self.backend.set_value(column, value)
+                    elif value is self.deleted:
+                        self.backend.delete(column, key)
+                    else:
+                        self.backend.put(column, key, value)
+                    self.__changed(column, key)
+                self.backend.sync()
+                self.generation = self.backend.generation()
+            self.pending = {}
+
+    @staticmethod
+    def __flush_reference(reference: weakref.ref) -> None:
+        """
+        Flushes a database, unless it has been deleted in the meantime.
+        The timer only keeps a weak reference, so that it does not delay the closing of the database.
+        """
+        db = reference()
+        if db is not None:
+            db.flush()
+
+    def __written(self) -> None:
+        """
+        Called after each write ; schedules the flush.
+        """
+        if len(self.pending) >= Config.database_max_dirty or Config.database_flush_interval <= 0:
+            self.flush()
+        elif self.flush_timer is None:
+            self.flush_timer = threading.Timer(Config.database_flush_interval, self.__flush_reference,
+                                               (weakref.ref(self), ))
+            self.flush_timer.daemon = True
+            self.flush_timer.start()
+
+    def __create_column(self, column_name: str, column_type: type) -> None:
+        """
+        Must be called with the exclusive lock.
+        """
+        self.backend.create_column(column_name, column_type)
+        self.column_types[column_name] = column_type
+
+    def __is_dict_column(self, column: str) -> bool:
+        return self.column_types[column] == dict
+
+    def __check_generation(self, force: bool = False) -> None:
+        """
+        Checks whether another process modified the database.
+        If so, the backend is reloaded and the cache emptied.
+        Unless forced, the check is done at most every `Config.database_cache_check_interval` seconds.
+
+        :param bool force: Check now. The caller must hold the exclusive lock.
+        """
+        now = time.monotonic()
+        if not force:
+            if now - self.generation_checked < Config.database_cache_check_interval:
+                return
+            with self.file_lock.shared():
+                self.__check_generation(force=True)
+            return
+        self.generation_checked = now
+        if self.backend.generation() == self.generation:
+            return
+        logging.debug(f"Database {self.db_name} modified by another process, reloading it.")
+        self.backend.reload()
+        self.column_types = self.backend.columns()
+        self.cache.clear()
+        self.generation = self.backend.generation()
+        self.reloads += 1
+
+    def __lookup(self, cache_key: tuple, load) -> any:
+        """
+        Reads a value from the backend, through the cache.
+        The value returned must not be modified: the callers return copies.
+
+        :param tuple cache_key: Identifies the value in the cache.
+        :param load: Function reading the value from the backend, if it is not cached.
+        :return: The value.
+        """
+        self.__check_generation()
+        try:
+            value = self.cache[cache_key]
+            self.cache.move_to_end(cache_key)
+            return value
+        except KeyError:
+            pass
+        with self.file_lock.shared():
+            value = load()
+        self.cache[cache_key] = value
+        if len(self.cache) > Config.database_cache_size:
+            self.cache.popitem(last=False)
+        return value
+
+    def __load_key(self, column: str, key: str) -> any:
+        try:
+            return self.backend.get(column, key)
+        except KeyError:
+            return self.missing
+
+    def __load_items(self, column: str) -> dict:
+        return dict(self.backend.items(column))
+
+    def __lookup_column(self, column: str) -> any:
+        """
+        Reads a whole column from the backend, through the cache.
+        """
+        if self.__is_dict_column(column):
+            load = partial(self.__load_items, column)
+        else:
+            load = partial(self.backend.get_value, column)
+        return self.__lookup(("column", column, self.versions.get(column, 0)), load)
+
+    def __changed(self, column: str, key: str or None = None) -> None:
+        """
+        Drops the values of the cache made outdated by a change of the backend.
+
+        :param str column: The column modified.
+        :param str|None key: The key modified, in a dictionary column.
+        """
+        # The cached results computed over the whole column are identified by its version.
+        self.versions[column] = self.versions.get(column, 0) + 1
+        if key is not None:
+            self.cache.pop(("key", column, key), None)
+
+    def __unflushed(self, column: str, key: str or None = None) -> any:
+        """
+        :param str column: A column name.
+        :param str|None key: A key of a dictionary column, None for the other columns.
+        :return: The value written by the current transaction or not flushed yet, `deleted`, or `missing`.
+        """
+        if self.overlay is not None and (column, key) in self.overlay:
+            return self.overlay[(column, key)]
+        return self.pending.get((column, key), self.missing)
+
+    def __unflushed_items(self, column: str) -> dict:
+        """
+        :param str column: A dictionary column name.
+        :return dict: The entries of the column written by the current transaction or not flushed yet,
+        `deleted` for those deleted.
+        """
+        items = {key: value for (name, key), value in self.pending.items() if name == column}
+        if self.overlay:
+            items.update({key: value for (name, key), value in self.overlay.items() if name == column})
+        return items
+
+    def __write(self, column: str, key: str or None, value) -> None:
+        """
+        Writes a value, or records it in the current transaction.
+
+        :param str column: A column name.
+        :param str|None key: A key of a dictionary column, None to replace the content of another column.
+        :param value: The new value.
+        """
+        if self.overlay is not None:
+            self.overlay[(column, key)] = value
+            return
+        self.pending[(column, key)] = value
+        self.__written()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups writes: they are applied together when the block exits, followed by a single flush.
+        If the block raises an exception, none of them is applied.
+        Within the block, the reads return the values written by the transaction.
+        The other threads cannot use the database until the transaction is over.
+        Nested transactions are part of the outermost one.
+
+        The exclusive lock is held from the start of the outermost transaction until its writes are flushed,
+        and the changes of the other processes are loaded first: a read-modify-write done in a transaction
+        cannot lose the writes of another process, nor be lost by it.
+
+        Usage:
+
+        >>> with db.transaction():
+        ...     db.insert_dict("column", {"key1": 1})
+        ...     db.update("column", "key2", 2)
+        """
+        with self.lock:
+            if self.overlay is not None:
+                yield
+                return
+            with self.file_lock.exclusive():
+                self.__check_generation(force=True)
+                self.overlay = {}  # (column, key) -> value written by the transaction.
+                try:
+                    yield
+                except BaseException:
+                    self.overlay = None
+                    raise
+                overlay, self.overlay = self.overlay, None
+                if overlay:
+                    self.pending.update(overlay)
+                    self.flush()
+
+    def insert_new_column(self, column_name: str, column_type: type) -> None:
+        """
+        Adds a new column to the database structure.
+
+        :param str column_name: The name of the new column.
+        :param type column_type: Its type as a type object (dict, list, tuple, etc.)
+        """
+        if column_type not in (dict, list, tuple):
+            raise TypeError(f"Invalid column type: {column_type} for new column named \"{column_name}\"")
+        with self.lock:
+            self.db_columns.append(column_name)
+            with self.file_lock.exclusive():
+                self.__create_column(column_name, column_type)
+                self.backend.sync()
+                self.generation = self.backend.generation()
+            self.__changed(column_name)
+
+    def column_exists(self, column: str) -> bool:
+        """
+        Checks if the column exists in the database.
+
+        :param str column: A column name.
+        :return bool: True if it does, False otherwise.
+        """
+        with self.lock:
+            return column in self.column_types
+
+    def key_exists(self, column: str, key: str) -> bool:
+        """
+        Checks if `key` exists in `column`.
+
+        :param str column: The column to parse.
+        :param str key: The key to search for.
+        :return bool: True if it exists, False otherwise.
+        """
+        # assert self.column_exists(column)
+        with self.lock:
+            if self.__is_dict_column(column):
+                key = str(key)
+                value = self.__unflushed(column, key)
+                if value is not self.missing:
+                    return value is not self.deleted
+                value = self.__lookup(("key", column, key), partial(self.__load_key, column, key))
+                return value is not self.missing
+            return key in self.query_column(column)
+
+    def insert_dict(self, column: str, pair: dict) -> None:
+        """
+        Adds a new value to a column in the database.
+        Used when the column's type is dict.
+        The column must exist. This check must be done beforehand.
+
+        :param str column: A column name.
+        :param dict pair: A dictionary.
+        """
+        with self.lock:
+            for key, value in pair.items():
+                self.__write(column, str(key), value)
+
+    def insert_list(self, column: str, value) -> None:
+        """
+        Adds a new value to a column in the database.
+        Used when the column's type is list.
+        The column must exist. This check must be done beforehand.
+
+        :param str column: A column name.
+        :param value: A value to add. Can be of any type.
+        """
+        with self.lock:
+            cl = self.query_column(column)
+            # assert type(cl) == list
+            cl.append(value)
+            self.__write(column, None, cl)
+
+    def update(self, column: str, key: str, value) -> None:
+        """
+        Updates a field in the database.
+
+        :param str column: A column name.
+        :param str key: A key.
+        :param value: The new value.
+        """
+        # assert self.column_exists(column)
+        # assert self.key_exists(column, key)
+        with self.lock:
+            if self.__is_dict_column(column):
+                self.__write(column, str(key), value)
+                return
+            cl = self.query_column(column)  # Get a copy of the column.
+            cl[key] = value  # Alters the copy.
+            self.__write(column, None, cl)  # Replace the original by the copy.
+
+    def delete(self, column: str, key: str) -> None:
+        """
+        Removes a key from a dictionary column. Does nothing if it does not exist.
+
+        :param str column: A dictionary column name.
+        :param str key: A key.
+        """
+        with self.lock:
+            self.__write(column, str(key), self.deleted)
+
+    def query_column(self, search_column: str) -> any:
+        """
+        Returns the whole content of a column.
+        For a dictionary column, this reads every entry: prefer `query()` when possible.
+
+        :param str search_column: A column name.
+        :return: The value of the column.
+        """
+        # assert self.column_exists(search_column)
+        with self.lock:
+            if not self.__is_dict_column(search_column):
+                value = self.__unflushed(search_column)
+                if value is self.missing:
+                    value = self.__lookup_column(search_column)
+                return copy.deepcopy(value)
+            content = dict(self.__lookup_column(search_column))
+            for key, value in self.__unflushed_items(search_column).items():
+                if value is self.deleted:
+                    content.pop(key, None)
+                else:
+                    content[key] = value
+            return copy.deepcopy(content)
+
+    def query(self, search_column: str, search_key: str) -> any:
+        """
+        Queries the value from column -> key.
+        Both column and key must exist in the DB.
+
+        :param str search_column: A column name.
+        :param str search_key: A key.
+        """
+        # assert self.column_exists(search_column)
+        # assert self.key_exists(search_column, search_key)
+        with self.lock:
+            if not self.__is_dict_column(search_column):
+                return self.query_column(search_column)[search_key]
+            key = str(search_key)
+            value = self.__unflushed(search_column, key)
+            if value is self.missing:
+                value = self.__lookup(("key", search_column, key), partial(self.__load_key, search_column, key))
+            if value is self.missing or value is self.deleted:
+                raise KeyError(search_key)
+            return copy.deepcopy(value)
+
+    def find_keys(self, search_column: str, value) -> list:
+        """
+        Searches a dictionary column for the keys whose value is `value`,
+        or contains it if the values are lists (i.e. the members of a group).
+        Indexed with the SQLite backend ; the other backends read the whole column.
+
+        :param str search_column: A dictionary column name.
+        :param value: A string, integer or boolean.
+        :return list: The matching keys.
+        """
+        with self.lock:
+            cache_key = ("find", search_column, self.versions.get(search_column, 0), repr(value))
+            keys = list(self.__lookup(cache_key, partial(self.backend.find_keys, search_column, value)))
+            unflushed = self.__unflushed_items(search_column)
+            if unflushed:
+                # Takes into account the values not flushed yet.
+                tag = repr(value)
+                matches = {key: tag in self.backend.tags(item) for key, item in unflushed.items()}
+                keys = [key for key in keys if key not in matches]
+                keys += [key for key, match in matches.items() if match]
+            return keys
+
+    def check_changes(self) -> int:
+        """
+        Checks whether another process modified the database, at most every
+        `Config.database_cache_check_interval` seconds.
+        Lets the users keeping values derived from the database know when to drop them.
+
+        :return int: The number of times the changes of another process were loaded.
+        """
+        with self.lock:
+            self.__check_generation()
+            return self.reloads
+
+    def lock_stats(self) -> dict:
+        """
+        .. seealso: FileLock.stats()
+        """
+        return self.file_lock.stats()
+
+
+@atexit.register
+def flush_databases() -> None:
+    """
+    Flushes the databases still opened when the interpreter exits.
+    """
+    for db in list(Database.instances):
+        db.flush()
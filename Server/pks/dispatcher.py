@@ -0,0 +1,71 @@
+# -*- coding: UTF8 -*-
+
+import logging
+import threading
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class Dispatcher:
+
+    """
+
+    Runs tasks on a pool of threads, while keeping in order the tasks sharing a same key (usually a chat ID):
+    a task only starts once the previous task with the same key is done.
+    Tasks with different keys run in parallel.
+
+    If a task raises SystemExit (i.e. the command "/shutdown"), the future `shutdown_requested` is resolved.
+
+    """
+
+    def __init__(self, workers: int):
+        """
+        :param int workers: Maximum number of tasks running at the same time.
+        """
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.queues = {}  # Key -> deque of the (function, args) tuples waiting for the running task of this key.
+        self.lock = threading.Lock()
+        self.shutdown_requested = Future()
+
+    def submit(self, key, function, *args) -> None:
+        """
+        Schedules `function(*args)`, after the tasks already submitted with the same key.
+
+        :param key: Any hashable value.
+        :param function: The function to call.
+        :param args: Its arguments.
+        """
+        with self.lock:
+            queue = self.queues.get(key)
+            if queue is not None:
+                queue.append((function, args))
+                return
+            self.queues[key] = deque()
+        self.executor.submit(self.__run, key, function, args)
+
+    def __run(self, key, function, args: tuple) -> None:
+        """
+        Runs a task, then the ones queued behind it.
+        """
+        while True:
+            try:
+                function(*args)
+            except SystemExit:
+                if not self.shutdown_requested.done():
+                    self.shutdown_requested.set_result(True)
+            except Exception:
+                logging.exception(f"Task {getattr(function, '__name__', function)} failed.")
+            with self.lock:
+                queue = self.queues[key]
+                if not queue:
+                    del self.queues[key]
+                    return
+                function, args = queue.popleft()
+
+    def close(self) -> None:
+        """
+        Waits for every task submitted to be done, then releases the threads.
+        No task can be submitted afterwards.
+        """
+        self.executor.shutdown(wait=True)
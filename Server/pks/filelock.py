@@ -0,0 +1,137 @@
+# -*- coding: UTF8 -*-
+
+import fcntl
+import logging
+import threading
+import time
+import os
+
+from contextlib import contextmanager
+
+from .config import Config
+
+
+class FileLock:
+
+    """
+    Readers / writer lock shared between processes, using `flock()` on a lock file.
+
+    Any number of processes can hold the shared lock at the same time, while the exclusive lock
+    is held by a single process, with no shared lock held.
+
+    Within a process, there is a single instance per file (see `FileLock.get()`), and its threads
+    take it one at a time. It is reentrant: a thread can acquire it again, in any mode.
+    Note that turning a shared lock into an exclusive one is not atomic.
+
+    The time spent waiting for the lock is measured ; a warning is logged when it exceeds
+    `Config.database_lock_warning` seconds.
+
+    Usage:
+
+    >>> lock = FileLock.get("db/channels.db.lock")
+    >>> with lock.shared():
+    ...     pass  # Read.
+    >>> with lock.exclusive():
+    ...     pass  # Write.
+
+    """
+
+    # Path -> instance. The lock files stay open until the process exits: the databases may use them
+    # in their finalizers, which run in any order.
+    instances = {}
+    instances_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, path: str):
+        """
+        :param str path: The lock file. Created if it does not exist.
+        :return FileLock: The instance for this file.
+        """
+        path = os.path.abspath(path)
+        with cls.instances_lock:
+            lock = cls.instances.get(path)
+            if lock is None:
+                lock = cls(path)
+                cls.instances[path] = lock
+            return lock
+
+    def __init__(self, path: str):
+        """
+        Use `FileLock.get()` instead: two instances for the same file would exclude each other, even in the same thread.
+
+        :param str path: The lock file. Created if it does not exist.
+        """
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.thread_lock = threading.RLock()
+        self.modes = []  # Modes (fcntl.LOCK_SH or fcntl.LOCK_EX) requested by the thread holding the lock.
+        # Instrumentation.
+        self.acquisitions = 0
+        self.contentions = 0  # Acquisitions which had to wait for another process.
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @contextmanager
+    def shared(self):
+        self.__acquire(fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            self.__release()
+
+    @contextmanager
+    def exclusive(self):
+        self.__acquire(fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            self.__release()
+
+    def __mode(self) -> int or None:
+        """
+        :return int|None: The mode the file is locked in, None if it isn't.
+        """
+        if not self.modes:
+            return None
+        return fcntl.LOCK_EX if fcntl.LOCK_EX in self.modes else fcntl.LOCK_SH
+
+    def __acquire(self, mode: int) -> None:
+        self.thread_lock.acquire()
+        current = self.__mode()
+        self.modes.append(mode)
+        if current == fcntl.LOCK_EX or current == mode:
+            return
+        self.acquisitions += 1
+        try:
+            fcntl.flock(self.fd, mode | fcntl.LOCK_NB)
+        except BlockingIOError:
+            start = time.monotonic()
+            fcntl.flock(self.fd, mode)
+            waited = time.monotonic() - start
+            self.contentions += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            if waited > Config.database_lock_warning:
+                logging.warning(f"Waited {waited:.3f} seconds for the lock {self.path}.")
+
+    def __release(self) -> None:
+        previous = self.__mode()
+        self.modes.pop()
+        current = self.__mode()
+        if current is None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        elif current != previous:
+            # Back to the shared lock.
+            fcntl.flock(self.fd, current)
+        self.thread_lock.release()
+
+    def stats(self) -> dict:
+        """
+        :return dict: Number of acquisitions, how many had to wait, total and maximum wait time (in seconds).
+        """
+        return {
+            "acquisitions": self.acquisitions,
+            "contentions": self.contentions,
+            "wait_total": self.wait_total,
+            "wait_max": self.wait_max,
+        }
@@ -0,0 +1,258 @@
+# -*- coding: UTF8 -*-
+
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+
+class MockTelegramServer:
+
+    """
+
+    Local stand-in for the Telegram Bot API, used for tests and benchmarks.
+
+    It implements the methods used by `TelegramBot` (getUpdates with long polling, sendMessage,
+    setWebhook and deleteWebhook), with configurable latency and error injection.
+    Point the bot at it by setting `Config.telegram_api_url` to the attribute `url`.
+
+    Usage:
+
+    >>> with MockTelegramServer(token="test", latency=0.05) as server:
+    ...     Config.telegram_api_url, Config.telegram_token = server.url, "test"
+    ...     server.push_message(chat_id=1, user_id=1, text="/help")
+
+    """
+
+    class Server(ThreadingHTTPServer):
+        daemon_threads = True
+        # Benchmarks open many connections at once ; the default backlog of 5 would delay some of them.
+        request_queue_size = 128
+
+    def __init__(self, token: str = "test", host: str = "127.0.0.1", port: int = 0,
+                 latency: float = 0.0, error_rate: float = 0.0, rate_limit_rate: float = 0.0,
+                 retry_after: int = 1, seed: int or None = None):
+        """
+        :param str token: The only token accepted.
+        :param str host: Address to listen on.
+        :param int port: Port to listen on. 0 picks a free port.
+        :param float latency: Time (in seconds) spent before answering each request.
+        :param float error_rate: Probability for a request to fail with a 500 error.
+        :param float rate_limit_rate: Probability for a request to fail with a 429 error.
+        :param int retry_after: The delay (in seconds) asked with each 429 error.
+        :param int|None seed: Seed of the errors injection, for reproducible runs.
+        """
+        self.token = token
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+
+        # Chats in which sending a message fails with a 403 error, as if the bot had been blocked or kicked.
+        self.blocked_chats = set()
+        # Called with (chat_id, text, reply_to) each time a message is sent.
+        self.on_send = None
+
+        self.updates = []  # Updates not confirmed yet.
+        self.sent = []  # List of (timestamp, chat_id, text, reply_to) tuples.
+        self.calls = {}  # Method name -> number of calls.
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.webhook_url = ""
+        self.condition = threading.Condition()
+        self.stopped = False
+
+        self.httpd = self.Server((host, port), self.__get_handler_class())
+        self.url = f"http://{host}:{self.httpd.server_address[1]}"
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        """
+        Starts serving in a background thread.
+        """
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops serving. The pending long polls return right away.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def push_update(self, update: dict) -> dict:
+        """
+        Adds an update to the queue returned by getUpdates. Its "update_id" is set by the server.
+
+        :param dict update: A Telegram update.
+        :return dict: The update.
+        """
+        with self.condition:
+            update['update_id'] = next(self.update_ids)
+            self.updates.append(update)
+            self.condition.notify_all()
+        return update
+
+    def make_message(self, chat_id: int, user_id: int, text: str, date: int or None = None) -> dict:
+        """
+        Creates an update containing a message, without queuing it.
+
+        :param int chat_id: The chat the message is sent in.
+        :param int user_id: The user sending the message.
+        :param str text: The text of the message.
+        :param int|None date: Optional. Unix time the message was sent at. Defaults to now.
+        :return dict: A Telegram update.
+        """
+        return {
+            "update_id": next(self.update_ids),
+            "message": {
+                "message_id": next(self.message_ids),
+                "date": int(time.time()) if date is None else date,
+                "text": text,
+                "chat": {"id": chat_id},
+                "from": {"id": user_id},
+            }
+        }
+
+    def push_message(self, chat_id: int, user_id: int, text: str, date: int or None = None) -> dict:
+        """
+        Simulates a message sent to the bot.
+
+        .. seealso: MockTelegramServer.make_message()
+
+        :return dict: The update created.
+        """
+        return self.push_update(self.make_message(chat_id, user_id, text, date))
+
+    def count_calls(self) -> int:
+        """
+        :return int: How many API calls the server received.
+        """
+        with self.condition:
+            return sum(self.calls.values())
+
+    def __get_updates(self, params: dict) -> tuple:
+        offset = int(params.get("offset", 0))
+        timeout = float(params.get("timeout", 0))
+        limit = int(params.get("limit", 100))
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            if offset < 0:
+                # Only the last -offset updates are kept.
+                self.updates = self.updates[offset:]
+            else:
+                # Updates with a lower ID are confirmed.
+                self.updates = [u for u in self.updates if u['update_id'] >= offset]
+            while not self.updates and not self.stopped and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+            return 200, {"ok": True, "result": self.updates[:limit]}
+
+    def __send_message(self, params: dict) -> tuple:
+        chat_id = params.get("chat_id")
+        if chat_id is None or "text" not in params:
+            return 400, {"ok": False, "error_code": 400, "description": "Bad Request: message text is empty"}
+        if str(chat_id) in self.blocked_chats:
+            return 403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+        reply_to = params.get("reply_to_message_id")
+        with self.condition:
+            self.sent.append((time.monotonic(), str(chat_id), params["text"], reply_to))
+        if self.on_send is not None:
+            self.on_send(str(chat_id), params["text"], reply_to)
+        return 200, {"ok": True, "result": {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id},
+            "text": params["text"],
+        }}
+
+    def handle(self, path: str, params: dict) -> tuple:
+        """
+        Answers an API call.
+
+        :param str path: The path of the request, such as "/bot<token>/getUpdates".
+        :param dict params: The parameters of the call.
+        :return tuple: The status code and the JSON body of the response.
+        """
+        prefix, _, method = path.lstrip("/").partition("/")
+        if prefix != f"bot{self.token}":
+            return 401, {"ok": False, "error_code": 401, "description": "Unauthorized"}
+        with self.condition:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+        if self.latency:
+            time.sleep(self.latency)
+        draw = self.random.random()
+        if draw < self.error_rate:
+            return 500, {"ok": False, "error_code": 500, "description": "Internal Server Error"}
+        if draw < self.error_rate + self.rate_limit_rate:
+            return 429, {"ok": False, "error_code": 429, "description": "Too Many Requests",
+                         "parameters": {"retry_after": self.retry_after}}
+
+        if method == "getUpdates":
+            if self.webhook_url:
+                return 409, {"ok": False, "error_code": 409, "description": "Conflict: webhook is active"}
+            return self.__get_updates(params)
+        elif method == "sendMessage":
+            return self.__send_message(params)
+        elif method == "setWebhook":
+            self.webhook_url = params.get("url", "")
+            return 200, {"ok": True, "result": True}
+        elif method == "deleteWebhook":
+            self.webhook_url = ""
+            return 200, {"ok": True, "result": True}
+        return 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+
+    def __get_handler_class(self) -> type:
+        """
+        :return type: A request handler class bound to this server.
+        """
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = "HTTP/1.1"  # Keeps the connections alive.
+            disable_nagle_algorithm = True  # Headers and body are written separately.
+
+            def __answer(self, params: dict) -> None:
+                code, body = server.handle(urlsplit(self.path).path, params)
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self) -> None:
+                self.__answer(dict(parse_qsl(urlsplit(self.path).query)))
+
+            def do_POST(self) -> None:
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length).decode("utf-8")
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    params = json.loads(body or "{}")
+                else:
+                    params = dict(parse_qsl(body))
+                params.update(parse_qsl(urlsplit(self.path).query))
+                self.__answer(params)
+
+            def log_message(self, format: str, *args) -> None:
+                logging.debug("Mock Telegram API: " + format, *args)
+
+        return Handler
@@ -0,0 +1,165 @@
+# -*- coding: UTF8 -*-
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .config import Config
+from .telegram import UncertainRequest
+
+
+class Outbox:
+
+    """
+
+    Queue of the messages sent by the bot.
+
+    Queuing a message returns immediately: the messages are sent by a background thread.
+    The first message to an idle chat waits `first_window` seconds (a short delay), those queued for a chat while
+    a message is being sent to it wait up to `window` seconds. The messages queued meanwhile are merged into
+    as few messages as possible (within Telegram's size limit), which saves API calls and rate limit budget
+    when, for instance, a reply and a broadcast target the same chat.
+
+    Messages to a same chat are always sent in the order they were queued.
+
+    """
+
+    # Maximum length of a Telegram message.
+    max_message_length = 4096
+    # Inserted between two merged messages.
+    separator = "\n\n"
+
+    def __init__(self, bot, window: float or None = None, workers: int or None = None,
+                 first_window: float or None = None):
+        """
+        :param TelegramBot bot: The bot sending the messages.
+        :param float|None window: How long (in seconds) the messages queued for a busy chat wait for others.
+        By default, `Config.outbox_coalesce_window`.
+        :param int|None workers: Number of chats flushed at the same time. By default, `Config.broadcast_workers`.
+        :param float|None first_window: How long (in seconds) the first message to an idle chat waits for others.
+        By default, `Config.outbox_first_window`.
+        """
+        self.bot = bot
+        self.window = Config.outbox_coalesce_window if window is None else window
+        self.first_window = Config.outbox_first_window if first_window is None else first_window
+        if workers is None:
+            workers = Config.broadcast_workers
+        self.pending = {}  # Chat ID -> list of (text, reply_to, future) tuples.
+        self.deadlines = []  # Heap of (deadline, counter, chat ID) tuples, one per key of `pending`.
+        self.counter = itertools.count()  # Breaks the ties between deadlines.
+        self.in_flight = set()  # Chats currently being flushed by a worker.
+        self.ready = set()  # Chats whose deadline passed while they were in flight.
+        self.closed = False
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    def put(self, chat_id: str, text: str, reply_to: str or None = None) -> Future:
+        """
+        Queues a message.
+
+        :param str chat_id: The channel ID into which the message will be sent.
+        :param str text: The message to send.
+        :param str|None reply_to: Optional. ID of the message to respond to.
+        :return Future: Resolved with the `requests.Response` (or None) of the API call which delivered the message ;
+        fails with `UncertainRequest` if the message may have been delivered without a response.
+        """
+        future = Future()
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("Cannot queue a message in a closed outbox.")
+            if chat_id not in self.pending:
+                self.pending[chat_id] = []
+                # Nothing else is pending for this chat: only waits shortly for the messages queued right after.
+                delay = self.window if chat_id in self.in_flight else self.first_window
+                heapq.heappush(self.deadlines, (time.monotonic() + delay, next(self.counter), chat_id))
+                self.condition.notify()
+            self.pending[chat_id].append((text, reply_to, future))
+        return future
+
+    def close(self) -> None:
+        """
+        Sends every message queued without waiting for the end of their window, then stops the outbox.
+        """
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        self.executor.shutdown(wait=True)
+
+    def __run(self) -> None:
+        """
+        Hands the chats whose window is over to the workers.
+        """
+        while True:
+            with self.condition:
+                while True:
+                    if self.deadlines:
+                        delay = self.deadlines[0][0] - time.monotonic()
+                        if delay <= 0 or self.closed:
+                            break
+                        self.condition.wait(delay)
+                    elif self.closed:
+                        return
+                    else:
+                        self.condition.wait()
+                _, _, chat_id = heapq.heappop(self.deadlines)
+                if chat_id in self.in_flight:
+                    # The worker flushing this chat will send these messages afterwards.
+                    self.ready.add(chat_id)
+                    continue
+                messages = self.pending.pop(chat_id)
+                self.in_flight.add(chat_id)
+            self.executor.submit(self.__flush, chat_id, messages)
+
+    def __flush(self, chat_id: str, messages: list) -> None:
+        """
+        Sends the messages queued for a chat.
+
+        :param str chat_id: A Telegram Chat ID.
+        :param list messages: A list of (text, reply_to, future) tuples.
+        """
+        while True:
+            for text, reply_to, futures in self.merge(messages):
+                try:
+                    resp = self.bot.send_message(chat_id, text, reply_to)
+                except UncertainRequest as error:
+                    for future in futures:
+                        future.set_exception(error)
+                    continue
+                except Exception:
+                    logging.exception(f"Could not send a message to channel {chat_id}.")
+                    resp = None
+                for future in futures:
+                    future.set_result(resp)
+            with self.condition:
+                if chat_id not in self.ready:
+                    self.in_flight.discard(chat_id)
+                    return
+                self.ready.discard(chat_id)
+                messages = self.pending.pop(chat_id)
+
+    @classmethod
+    def merge(cls, messages: list) -> list:
+        """
+        Merges consecutive messages, as long as the result fits in a single Telegram message.
+        A merged message replies to the message the first of its parts replied to.
+
+        :param list messages: A list of (text, reply_to, future) tuples.
+        :return list: A list of (text, reply_to, list of futures) tuples.
+        """
+        merged = []
+        for text, reply_to, future in messages:
+            if merged and len(merged[-1][0]) + len(cls.separator) + len(text) <= cls.max_message_length:
+                merged_text, merged_reply_to, futures = merged[-1]
+                merged[-1] = (merged_text + cls.separator + text, merged_reply_to, futures + [future])
+            else:
+                merged.append((text, reply_to, [future]))
+        return merged
@@ -1,252 +1,492 @@
-# -*- coding: UTF8 -*-
-
-import logging
-
-from .database import Database
-from .config import Config
-
-
-class Permissions:
-
-    # This variable contains the permissions that can be used to set a command's rights.
-    # They represent permissions sets, not groups.
-    # First item is the name of the set, the second is a description (used nowhere, only informational).
-    permission_sets = [
-        ("manage_sequences", "Can manage new and old sequences."),
-        ("modify_bot_behaviour", "Can take measures that have a direct impact on the bot's behaviour."),
-        ("admin_access", "Can take drastic measures that can affect the whole system."),
-    ]
-
-    # This variables contains the groups and their associated sets of permissions.
-    permission_groups = [
-        {"guest": []},
-        {"member": ["manage_sequences", ]},
-        {"manager": ["manage_sequences", "modify_bot_behaviour", ]},
-        {"admin": ["manage_sequences", "modify_bot_behaviour", "admin_access", ]},
-    ]
-
-    def __init__(self):
-        self.db = PermissionsDatabase()
-
-    def __del__(self):
-        del self.db
-
-    def set_telegram_admins(self) -> None:
-        """
-        Promote the system account (1) and the users defined in
-        `pks.config.telegram_user_admin_list` as the Telegram bot's admins.
-        """
-        self.add_user_to_group("1", "admin")  # 1 is the system account (arbitrary)
-        for admin in Config.telegram_user_admin_list:
-            self.add_user_to_group(
-                str(admin),  # We convert the value to string as Telegram IDs are integers.
-                "admin"
-            )
-
-    def user_exists(self, user_id: str) -> bool:
-        """
-        Checks if the user exists in the database.
-
-        :param str user_id: A Telegram User ID.
-        :return bool: True if he does, False otherwise.
-        """
-        return self.db.key_exists(self.db.db_columns[0], user_id)
-
-    def get_group_members(self, group: str) -> list:
-        """
-        Parses the database to find which users are part of a group, and return a list of these users.
-
-        :param str group: A group name.
-        :return list: The group's users.
-        """
-        groups = []
-        if group in self.get_valid_groups():
-            all_users_raw = self.db.query_column(self.db.db_columns[0])
-            all_users = all_users_raw.keys()
-            for user in all_users:
-                if group in all_users_raw[user]:
-                    groups.append(user)
-        return groups
-
-    def get_valid_groups(self) -> list:
-        """
-        Returns a list of the valid groups defined by the attribute `permission_groups`.
-
-        :return list: A list of valid groups.
-        """
-        return [v[0] for v in [list(g.keys()) for g in self.permission_groups]]
-
-    def is_group_valid(self, group: str) -> bool:
-        """
-        Searches attribute "permission_groups" to check if the group specified is valid.
-
-        :param str group: A group name.
-        :return bool: True if the group is valid, False otherwise.
-
-        .. seealso: Permissions.get_valid_groups()
-        """
-        return group in self.get_valid_groups()
-
-    def create_user(self, user_id: str) -> None:
-        """
-        .. seealso: PermissionsDatabase.create_user()
-
-        :param str user_id: A Telegram User ID.
-        """
-        if not self.user_exists(user_id):
-            self.db.create_user(user_id)
-
-    def add_user_to_group(self, user_id: str, group: str) -> None:
-        """
-        Add a user to a group.
-
-        :param str user_id: A Telegram User ID.
-        :param str group: A group name.
-        """
-        if not self.is_group_valid(group):
-            return
-        # Creates the user if it doesn't already exists in the database.
-        if not self.user_exists(user_id):
-            self.create_user(user_id)
-        self.db.add_user_to_group(user_id, group)
-        logging.info(f"User {user_id} added to group {group} successfully.")
-
-    def remove_user_from_group(self, user_id: str, group: str) -> None:
-        """
-        Remove user from a group.
-
-        :param str user_id: A Telegram User ID.
-        :param str group: A group name.
-        """
-        if not self.is_group_valid(group):
-            return
-        self.db.remove_user_from_group(user_id, group)
-        logging.info(f"User {user_id} removed from group {group} successfully.")
-
-    def get_groups_permissions(self, user_id: str) -> list:
-        """
-        Get a list of permissions granted by the user's groups membership.
-
-        :param str user_id: A Telegram User ID.
-        :return list: A list of permissions granted by the groups the user is part of.
-        """
-        u_groups = self.db.list_groups(user_id)
-
-        p_groups = ["none"]
-        for permission_group in self.permission_groups:  # permission_group is a dict
-            # Get the name of the group.
-            group = list(permission_group.keys())[0]
-            if group in u_groups:
-                for pg in permission_group[group]:
-                    p_groups.append(pg)
-
-        return p_groups
-
-    def is_user_allowed(self, user_id: str, needed_permissions: list) -> bool:
-        """
-        Will test if the user with precised id has sufficient permissions.
-
-        :param str user_id: A Telegram User ID.
-        :param list needed_permissions: Must be a subset of attribute "permission_sets".
-        :return bool: True if he does, False otherwise.
-        """
-
-        # If the whitelist is not empty
-        if len(Config.telegram_user_whitelist) > 0:
-            # Terminate if the user is not part of it
-            if user_id not in Config.telegram_user_whitelist:
-                return False
-
-        # Terminate if the user is in the blacklist
-        if user_id in Config.telegram_user_blacklist:
-            return False
-
-        user_permissions = self.get_groups_permissions(user_id)
-
-        # Checks if the user's permissions list contains the needed permissions (if one is the subset of the other).
-        # If not, terminate.
-        if not all([p in user_permissions for p in needed_permissions]):
-            return False
-
-        return True
-
-
-class PermissionsDatabase(Database):
-
-    """
-
-    Database structure:
-
-    permissions = dict{
-        permissions = dict{
-            "user1": ["admin", "manager"],
-            "user2": ["guest"],
-            "user3": ["guest"],
-        }
-    }
-
-    """
-
-    def __init__(self):
-        super().__init__(
-            "db/permissions.db",
-            {
-                "permissions": dict
-            }
-        )
-
-    def list_groups(self, user_id: str) -> list:
-        """
-        Lists the groups "user_id" is part of.
-        If the user does not exist in the database, returns an empty list.
-
-        :param str user_id: A Telegram User ID.
-        :return list: A list of the groups this User ID is part of.
-        """
-        if self.key_exists(self.db_columns[0], user_id):
-            val = self.query(self.db_columns[0], user_id)
-            return val
-        else:
-            return []
-
-    def create_user(self, user_id: str) -> None:
-        """
-        Creates a new user in the database.
-        Does not care if it already exists ; this verification must be made beforehand.
-
-        :param str user_id: A Telegram User ID.
-        """
-        self.insert_dict(self.db_columns[0], {user_id: []})
-
-    def add_user_to_group(self, user_id: str, group: str) -> None:
-        """
-        Adds "user_id" to "group".
-        This user must already exist in the database and the group must be verified to be valid beforehand.
-        This function takes care of removing duplicates (in case the user was already part of the group).
-
-        :param str user_id: A Telegram User ID.
-        :param str group: A group name.
-        """
-        # Get a list of the groups the user belongs to
-        groups = self.list_groups(user_id)
-        # Add the new group to this list
-        groups.append(group)
-        # Remove duplicates
-        groups = list(dict.fromkeys(groups))
-        # And update the database entry with the new groups.
-        self.update(self.db_columns[0], user_id, groups)
-
-    def remove_user_from_group(self, user_id: str, group: str) -> None:
-        """
-        Removes "user_id" from "group".
-        This user must already exist in the database and the group must be verified to be valid beforehand.
-
-        :param str user_id: A Telegram User ID.
-        :param str group: A group name.
-        """
-        groups = self.list_groups(user_id)
-        # Remove the new group to this list
-        groups = dict.fromkeys(groups)
-        groups.pop(group)
-        groups = list(groups)
-        self.update(self.db_columns[0], user_id, groups)
+# -*- coding: UTF8 -*-
+
+import logging
+
+from .database import Database
+from .userlist import UserList
+from .config import Config
+
+
+class Permissions:
+
+    # This variable contains the permissions that can be used to set a command's rights.
+    # They represent permissions sets, not groups.
+    # First item is the name of the set, the second is a description (used nowhere, only informational).
+    permission_sets = [
+        ("manage_sequences", "Can manage new and old sequences."),
+        ("modify_bot_behaviour", "Can take measures that have a direct impact on the bot's behaviour."),
+        ("admin_access", "Can take drastic measures that can affect the whole system."),
+    ]
+
+    # This variables contains the groups and their associated sets of permissions.
+    permission_groups = [
+        {"guest": []},
+        {"member": ["manage_sequences", ]},
+        {"manager": ["manage_sequences", "modify_bot_behaviour", ]},
+        {"admin": ["manage_sequences", "modify_bot_behaviour", "admin_access", ]},
+    ]
+
+    # The account used by the system itself, admin of the bot. Its ID is arbitrary.
+    system_account = "1"
+
+    def __init__(self):
+        self.db = PermissionsDatabase()
+        self.whitelist = UserList(Config.telegram_user_whitelist, Config.telegram_user_whitelist_file)
+        self.blacklist = UserList(Config.telegram_user_blacklist, Config.telegram_user_blacklist_file)
+        # The permission sets, as bits of a mask. "none" is granted to everyone: it is no bit.
+        self.permission_bits = {"none": 0}
+        for index, (permission, _) in enumerate(self.permission_sets):
+            self.permission_bits[permission] = 1 << index
+        # Group -> mask of the permissions it grants.
+        self.group_masks = {}
+        for permission_group in self.permission_groups:
+            for group, permissions in permission_group.items():
+                self.group_masks[group] = self.get_permissions_mask(permissions)
+        # User ID -> mask of the permissions granted by their groups, see `get_user_mask()`.
+        self.user_masks = {}
+        self.user_masks_reloads = self.db.check_changes()
+
+    def __del__(self):
+        del self.db
+
+    def set_telegram_admins(self) -> None:
+        """
+        Promote the system account (1) and the users defined in
+        `pks.config.telegram_user_admin_list` as the Telegram bot's admins.
+        """
+        with self.db.transaction():
+            self.add_user_to_group(self.system_account, "admin")
+            for admin in Config.telegram_user_admin_list:
+                self.add_user_to_group(
+                    str(admin),  # We convert the value to string as Telegram IDs are integers.
+                    "admin"
+                )
+
+    def user_exists(self, user_id: str) -> bool:
+        """
+        Checks if the user exists in the database.
+
+        :param str user_id: A Telegram User ID.
+        :return bool: True if he does, False otherwise.
+        """
+        return self.db.key_exists(self.db.db_columns[0], user_id)
+
+    def get_group_members(self, group: str, offset: int = 0, limit: int or None = None) -> list:
+        """
+        Returns the users which are part of a group, in the order they were added.
+        Can be paginated with `offset` and `limit`.
+
+        :param str group: A group name.
+        :param int offset: Number of members to skip.
+        :param int|None limit: Maximum number of members to return. None for all of them.
+        :return list: The group's users.
+        """
+        if group in self.get_valid_groups():
+            return self.db.list_members(group, offset, limit)
+        return []
+
+    def count_group_members(self, group: str) -> int:
+        """
+        :param str group: A group name.
+        :return int: The number of users part of this group.
+        """
+        if group in self.get_valid_groups():
+            return self.db.count_members(group)
+        return 0
+
+    def get_valid_groups(self) -> list:
+        """
+        Returns a list of the valid groups defined by the attribute `permission_groups`.
+
+        :return list: A list of valid groups.
+        """
+        return [v[0] for v in [list(g.keys()) for g in self.permission_groups]]
+
+    def is_group_valid(self, group: str) -> bool:
+        """
+        Searches attribute "permission_groups" to check if the group specified is valid.
+
+        :param str group: A group name.
+        :return bool: True if the group is valid, False otherwise.
+
+        .. seealso: Permissions.get_valid_groups()
+        """
+        return group in self.get_valid_groups()
+
+    def create_user(self, user_id: str) -> None:
+        """
+        .. seealso: PermissionsDatabase.create_user()
+
+        :param str user_id: A Telegram User ID.
+        """
+        if not self.user_exists(user_id):
+            self.db.create_user(user_id)
+
+    def add_user_to_group(self, user_id: str, group: str) -> None:
+        """
+        Add a user to a group.
+
+        :param str user_id: A Telegram User ID.
+        :param str group: A group name.
+        """
+        if not self.is_group_valid(group):
+            return
+        with self.db.transaction():
+            # Creates the user if it doesn't already exists in the database.
+            if not self.user_exists(user_id):
+                self.create_user(user_id)
+            self.db.add_user_to_group(user_id, group)
+            self.user_masks.pop(user_id, None)
+        logging.info(f"User {user_id} added to group {group} successfully.")
+
+    def add_users_to_group(self, user_ids: list, group: str) -> list:
+        """
+        Add users to a group, in a single transaction.
+
+        :param list user_ids: Telegram User IDs.
+        :param str group: A group name.
+        :return list: The users added, i.e. those which were not already part of the group.
+        """
+        if not self.is_group_valid(group):
+            return []
+        with self.db.transaction():
+            added = self.db.add_users_to_group(user_ids, group)
+            for user_id in added:
+                self.user_masks.pop(user_id, None)
+        logging.info(f"{len(added)} users added to group {group} successfully.")
+        return added
+
+    def import_memberships(self, rows) -> tuple:
+        """
+        Add users to groups, in a single transaction.
+
+        :param rows: Pairs "user ID, group name", such as the rows returned by `csv.reader()`.
+        :return tuple: The number of users added to a group, and the list of the rows ignored because invalid.
+        """
+        groups = {}  # Group -> users to add.
+        invalid = []
+        for row in rows:
+            if not row:
+                continue
+            row = [value.strip() for value in row]
+            if len(row) != 2 or not row[0] or not self.is_group_valid(row[1]):
+                invalid.append(row)
+                continue
+            groups.setdefault(row[1], []).append(row[0])
+        added = 0
+        with self.db.transaction():
+            for group, user_ids in groups.items():
+                added += len(self.add_users_to_group(user_ids, group))
+        return added, invalid
+
+    def remove_user_from_group(self, user_id: str, group: str) -> None:
+        """
+        Remove user from a group.
+
+        :param str user_id: A Telegram User ID.
+        :param str group: A group name.
+        """
+        if not self.is_group_valid(group):
+            return
+        with self.db.lock:
+            self.db.remove_user_from_group(user_id, group)
+            self.user_masks.pop(user_id, None)
+        logging.info(f"User {user_id} removed from group {group} successfully.")
+
+    def remove_users_from_group(self, user_ids: list, group: str) -> list:
+        """
+        Remove users from a group, in a single transaction.
+
+        :param list user_ids: Telegram User IDs.
+        :param str group: A group name.
+        :return list: The users removed, i.e. those which were part of the group.
+        """
+        if not self.is_group_valid(group):
+            return []
+        with self.db.transaction():
+            removed = self.db.remove_users_from_group(user_ids, group)
+            for user_id in removed:
+                self.user_masks.pop(user_id, None)
+        logging.info(f"{len(removed)} users removed from group {group} successfully.")
+        return removed
+
+    def get_groups_permissions(self, user_id: str) -> list:
+        """
+        Get a list of permissions granted by the user's groups membership.
+
+        :param str user_id: A Telegram User ID.
+        :return list: A list of permissions granted by the groups the user is part of.
+        """
+        u_groups = self.db.list_groups(user_id)
+
+        p_groups = ["none"]
+        for permission_group in self.permission_groups:  # permission_group is a dict
+            # Get the name of the group.
+            group = list(permission_group.keys())[0]
+            if group in u_groups:
+                for pg in permission_group[group]:
+                    p_groups.append(pg)
+
+        return p_groups
+
+    def get_permissions_mask(self, permissions: list) -> int:
+        """
+        :param list permissions: Permission sets, listed in attribute "permission_sets".
+        :return int: The mask of these permissions. The unknown ones are a bit granted to no one.
+        """
+        mask = 0
+        for permission in permissions:
+            mask |= self.permission_bits.get(permission, 1 << len(self.permission_sets))
+        return mask
+
+    def get_user_mask(self, user_id: str) -> int:
+        """
+        Get the mask of the permissions granted by the user's groups membership.
+        The masks are kept in memory, until the user's groups change.
+
+        :param str user_id: A Telegram User ID.
+        :return int: A mask of permissions, see `get_permissions_mask()`.
+        """
+        reloads = self.db.check_changes()
+        if reloads != self.user_masks_reloads:
+            # Another process modified the groups.
+            self.user_masks = {}
+            self.user_masks_reloads = reloads
+        mask = self.user_masks.get(user_id)
+        if mask is not None:
+            return mask
+        with self.db.lock:
+            mask = 0
+            for group in self.db.list_groups(user_id):
+                mask |= self.group_masks.get(group, 0)
+            # Within a transaction, the groups read may be rolled back.
+            if self.db.overlay is None:
+                if len(self.user_masks) >= Config.permissions_cache_size:
+                    self.user_masks = {}
+                self.user_masks[user_id] = mask
+        return mask
+
+    def is_user_allowed(self, user_id: str, needed_permissions: list) -> bool:
+        """
+        Will test if the user with precised id has sufficient permissions.
+
+        :param str user_id: A Telegram User ID.
+        :param list needed_permissions: Must be a subset of attribute "permission_sets".
+        :return bool: True if he does, False otherwise.
+        """
+
+        # If the whitelist is not empty
+        if self.whitelist:
+            # Terminate if the user is not part of it
+            if user_id not in self.whitelist:
+                return False
+
+        # Terminate if the user is in the blacklist
+        if user_id in self.blacklist:
+            return False
+
+        # Checks if the user's permissions contain the needed permissions.
+        needed_mask = self.get_permissions_mask(needed_permissions)
+        return self.get_user_mask(user_id) & needed_mask == needed_mask
+
+
+class PermissionsDatabase(Database):
+
+    """
+
+    Database structure:
+
+    permissions = dict{
+        permissions = dict{
+            "user1": ["admin", "manager"],
+            "user2": ["guest"],
+            "user3": ["guest"],
+        }
+        members = dict{
+            "admin/0": "user1",
+            "manager/0": "user1",
+            "guest/0": "user2",
+            "guest/1": "user3",
+        }
+        positions = dict{
+            "admin/user1": 0,
+            "manager/user1": 0,
+            "guest/user2": 0,
+            "guest/user3": 1,
+        }
+        counts = dict{
+            "admin": 1,
+            "manager": 1,
+            "guest": 2,
+        }
+    }
+
+    The columns "members", "positions" and "counts" are the reverse of "permissions", updated along with it:
+    the members of a group are an array, one entry per member, "group/position" -> user ID,
+    of "counts[group]" entries. "positions" gives the position of each member in this array.
+    Adding, removing and counting members only reads and writes a few entries, whatever the size of the group,
+    and a page of members only reads its own entries.
+    The entries beyond the count are left over by the removals, and are overwritten by the next additions.
+
+    """
+
+    def __init__(self):
+        super().__init__(
+            "db/permissions.db",
+            {
+                "permissions": dict,
+                "members": dict,
+                "positions": dict,
+                "counts": dict,
+            }
+        )
+        with self.transaction():
+            # Databases created before the columns "members", "positions" and "counts" existed.
+            if not self.query_column(self.db_columns[3]) and self.query_column(self.db_columns[0]):
+                self.__build_groups()
+
+    def __build_groups(self) -> None:
+        """
+        Fills the columns "members", "positions" and "counts" from the column "permissions".
+        """
+        counts = {}
+        for user_id, groups in self.query_column(self.db_columns[0]).items():
+            for group in groups:
+                self.__set_member(group, user_id, counts.get(group, 0))
+                counts[group] = counts.get(group, 0) + 1
+        self.insert_dict(self.db_columns[3], counts)
+        logging.info(f"Index of the groups' members built ({len(counts)} groups).")
+
+    def __set_member(self, group: str, user_id: str, position: int) -> None:
+        """
+        Writes "user_id" at "position" in the members of "group". Does not update the count.
+        """
+        self.update(self.db_columns[1], f"{group}/{position}", user_id)
+        self.update(self.db_columns[2], f"{group}/{user_id}", position)
+
+    def count_members(self, group: str) -> int:
+        """
+        :param str group: A group name.
+        :return int: The number of users part of this group.
+        """
+        if not self.key_exists(self.db_columns[3], group):
+            return 0
+        return self.query(self.db_columns[3], group)
+
+    def list_members(self, group: str, offset: int = 0, limit: int or None = None) -> list:
+        """
+        Lists the members of "group", in the order they were added ;
+        the last member takes the place of a member removed.
+        Only the entries of the members returned are read.
+
+        :param str group: A group name.
+        :param int offset: Number of members to skip.
+        :param int|None limit: Maximum number of members to return. None for all of them.
+        :return list: A list of User IDs.
+        """
+        with self.lock:
+            end = self.count_members(group)
+            if limit is not None:
+                end = min(end, offset + limit)
+            return [self.query(self.db_columns[1], f"{group}/{position}") for position in range(offset, end)]
+
+    def list_groups(self, user_id: str) -> list:
+        """
+        Lists the groups "user_id" is part of.
+        If the user does not exist in the database, returns an empty list.
+
+        :param str user_id: A Telegram User ID.
+        :return list: A list of the groups this User ID is part of.
+        """
+        if self.key_exists(self.db_columns[0], user_id):
+            val = self.query(self.db_columns[0], user_id)
+            return val
+        else:
+            return []
+
+    def create_user(self, user_id: str) -> None:
+        """
+        Creates a new user in the database.
+        Does not care if it already exists ; this verification must be made beforehand.
+
+        :param str user_id: A Telegram User ID.
+        """
+        self.insert_dict(self.db_columns[0], {user_id: []})
+
+    def add_user_to_group(self, user_id: str, group: str) -> None:
+        """
+        Adds "user_id" to "group".
+        This user must already exist in the database and the group must be verified to be valid beforehand.
+        Does nothing if the user is already part of the group.
+
+        :param str user_id: A Telegram User ID.
+        :param str group: A group name.
+        """
+        self.add_users_to_group([user_id], group)
+
+    def add_users_to_group(self, user_ids: list, group: str) -> list:
+        """
+        Adds the users to "group", in a single transaction.
+        The users are created if they do not exist. The group must be verified to be valid beforehand.
+
+        :param list user_ids: Telegram User IDs.
+        :param str group: A group name.
+        :return list: The users added, i.e. those which were not already part of the group.
+        """
+        with self.transaction():
+            added = []
+            count = self.count_members(group)
+            for user_id in dict.fromkeys(user_ids):
+                # Get a list of the groups the user belongs to
+                groups = self.list_groups(user_id)
+                if group in groups:
+                    continue
+                # Add the new group to this list
+                groups.append(group)
+                # And update the database entry with the new groups.
+                self.update(self.db_columns[0], user_id, groups)
+                self.__set_member(group, user_id, count)
+                count += 1
+                added.append(user_id)
+            if added:
+                self.update(self.db_columns[3], group, count)
+            return added
+
+    def remove_user_from_group(self, user_id: str, group: str) -> None:
+        """
+        Removes "user_id" from "group".
+        This user must already exist in the database and the group must be verified to be valid beforehand.
+
+        :param str user_id: A Telegram User ID.
+        :param str group: A group name.
+        """
+        self.remove_users_from_group([user_id], group)
+
+    def remove_users_from_group(self, user_ids: list, group: str) -> list:
+        """
+        Removes the users from "group", in a single transaction.
+        The group must be verified to be valid beforehand.
+
+        :param list user_ids: Telegram User IDs.
+        :param str group: A group name.
+        :return list: The users removed, i.e. those which were part of the group.
+        """
+        with self.transaction():
+            removed = []
+            count = self.count_members(group)
+            for user_id in dict.fromkeys(user_ids):
+                groups = self.list_groups(user_id)
+                if group not in groups:
+                    continue
+                # Remove the group from this list
+                groups.remove(group)
+                self.update(self.db_columns[0], user_id, groups)
+                # The last member takes the place of the one removed.
+                count -= 1
+                position = self.query(self.db_columns[2], f"{group}/{user_id}")
+                if position != count:
+                    self.__set_member(group, self.query(self.db_columns[1], f"{group}/{count}"), position)
+                removed.append(user_id)
+            if removed:
+                self.update(self.db_columns[3], group, count)
+            return removed
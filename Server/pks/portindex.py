@@ -0,0 +1,138 @@
+# -*- coding: UTF8 -*-
+
+from array import array
+from functools import lru_cache
+from itertools import accumulate, compress
+
+from .config import Config
+
+
+class PortIndex:
+
+    """
+    Index of the acceptable ports: those of `Config.acceptable_port_range` which are not in `Config.ports_blacklist`.
+
+    It is built once per configuration (see `PortIndex.get()`), and holds:
+    - the sorted acceptable ports, the i-th being `select(i)` ;
+    - a bitmap of the 65536 ports, for `port in index` ;
+    - the rank of each port, the number of acceptable ports below it, for `next_port()` ;
+    - lookup tables mapping random 16-bit values to acceptable ports, see `sample()`.
+
+    Every operation is O(1), whatever the length of the blacklist.
+    `PortIndex.current()` is O(1) as well, as long as the configuration is changed by replacing
+    `Config.acceptable_port_range` and `Config.ports_blacklist`, not by modifying them in place.
+
+    Usage:
+
+    >>> index = PortIndex.current()
+    >>> index.select(0)
+    1025
+    >>> index.next_port(700)
+    1025
+    """
+
+    # The index of the current configuration, and the objects it was built from, see `current()`.
+    cached = None
+
+    def __init__(self, port_range: range, blacklist: tuple):
+        """
+        Use `PortIndex.get()` instead, which builds a single index per configuration.
+
+        :param range port_range: The acceptable ports.
+        :param tuple blacklist: Ports which must not be used.
+        """
+        excluded = set(blacklist)
+        self.ports = array("H", (port for port in port_range if 0 <= port < 1 << 16 and port not in excluded))
+        if not self.ports:
+            raise ValueError("No port is acceptable: check `Config.acceptable_port_range` and `Config.ports_blacklist`.")
+        self.first = port_range[0]
+        self.last = port_range[-1]
+        self.bitmap = bytearray(1 << 16)
+        for port in self.ports:
+            self.bitmap[port] = 1
+        # `ranks[port]` is the number of acceptable ports below `port`.
+        self.ranks = array("I", accumulate(self.bitmap, initial=0))
+        # The low bits of a 16-bit value, as many as needed to write len - 1, give an index:
+        # the value is kept if it is below len, which happens at least half the time.
+        # As there are 2 ** 16 / (low_bits + 1) values per index, every port is equally likely.
+        low_bits = (1 << (len(self.ports) - 1).bit_length()) - 1
+        padding = low_bits + 1 - len(self.ports)
+        repeats = (1 << 16) // (low_bits + 1)
+        self.kept = bytes([1] * len(self.ports) + [0] * padding) * repeats
+        self.mapping = array("H", list(self.ports) + [0] * padding) * repeats
+        self.share = len(self.ports) / (low_bits + 1)
+
+    def __len__(self) -> int:
+        return len(self.ports)
+
+    def __contains__(self, port: int) -> bool:
+        return 0 <= port < 1 << 16 and self.bitmap[port] == 1
+
+    @staticmethod
+    @lru_cache(maxsize=4)
+    def get(port_range: range, blacklist: tuple):
+        """
+        :param range port_range: The acceptable ports.
+        :param tuple blacklist: Ports which must not be used.
+        :return PortIndex: The index for this configuration.
+        """
+        return PortIndex(port_range, blacklist)
+
+    @staticmethod
+    def current():
+        """
+        :return PortIndex: The index for the current configuration.
+        """
+        port_range, blacklist = Config.acceptable_port_range, Config.ports_blacklist
+        # Compared by identity: the blacklist is neither copied nor hashed for each port drawn.
+        cached = PortIndex.cached
+        if cached is None or cached[0] is not port_range or cached[1] is not blacklist:
+            cached = (port_range, blacklist, PortIndex.get(port_range, tuple(blacklist)))
+            PortIndex.cached = cached
+        return cached[2]
+
+    def select(self, i: int) -> int:
+        """
+        :param int i: An index, from 0 to len - 1.
+        :return int: The i-th acceptable port.
+        """
+        return self.ports[i]
+
+    def rank(self, port: int) -> int:
+        """
+        :param int port: A port, from 0 to 65535.
+        :return int: The number of acceptable ports below it.
+        """
+        return self.ranks[port]
+
+    def from_integer(self, value: int) -> int:
+        """
+        Maps a large integer, such as a hash, to an acceptable port.
+        The ports are equally likely, up to a bias of len / value range: negligible for a 256-bit hash.
+
+        :param int value: A non-negative integer.
+        :return int: An acceptable port.
+        """
+        return self.ports[value % len(self.ports)]
+
+    def next_port(self, port: int) -> int:
+        """
+        :param int port: Any port.
+        :return int: The first acceptable port from `port`, going back to the first one after the last.
+        """
+        while port > self.last:
+            port = (port % self.last) + self.first
+        if port < 0:
+            port = 0
+        i = self.ranks[port] if port < 1 << 16 else len(self.ports)
+        return self.ports[i % len(self.ports)]
+
+    def sample(self, values: array) -> array:
+        """
+        Maps random 16-bit values to acceptable ports, dropping those which would bias the distribution.
+
+        :param array values: Random 16-bit values (array of type "H").
+        :return array: Acceptable ports, equally likely, at least `share` of `len(values)` on average.
+        """
+        return array("H", map(self.mapping.__getitem__, compress(values, map(self.kept.__getitem__, values))))
+
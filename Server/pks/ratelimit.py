@@ -0,0 +1,121 @@
+# -*- coding: UTF8 -*-
+
+import threading
+import time
+
+
+class TokenBucket:
+
+    """
+    Thread-safe token bucket.
+
+    Tokens are added continuously at `rate` tokens per second, up to `capacity`.
+    Each action consumes a token ; when none is left, the caller waits for the next one.
+    """
+
+    def __init__(self, rate: float, capacity: float or None = None):
+        """
+        :param float rate: How many tokens are added per second.
+        :param float|None capacity: Maximum number of tokens stored, i.e. the largest burst allowed.
+        Defaults to one second worth of tokens (at least one).
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+    def reserve(self) -> float:
+        """
+        Takes a token, even if it is not available yet.
+
+        :return float: How long (in seconds) the caller must wait before using it.
+        """
+        with self.lock:
+            self.__refill()
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def acquire(self) -> None:
+        """
+        Takes a token, waiting for it to be available if needed.
+        """
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Prevents any token from being available during `seconds`.
+
+        :param float seconds: A delay, in seconds.
+        """
+        with self.lock:
+            self.__refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def is_full(self) -> bool:
+        """
+        :return bool: True if the bucket is full, meaning it was not used recently.
+        """
+        with self.lock:
+            self.__refill()
+            return self.tokens >= self.capacity
+
+
+class RateLimiter:
+
+    """
+    Combines a global token bucket with one token bucket per chat.
+
+    .. seealso :: TelegramBot.send_message()
+    """
+
+    # When more buckets than this are stored, the unused ones are dropped.
+    max_chat_buckets = 10000
+
+    def __init__(self, global_rate: float, chat_rate: float):
+        """
+        :param float global_rate: Maximum number of actions per second, all chats combined.
+        :param float chat_rate: Maximum number of actions per second in a single chat.
+        """
+        self.chat_rate = chat_rate
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_buckets = {}
+        self.lock = threading.Lock()
+
+    def __get_chat_bucket(self, chat_id: str) -> TokenBucket:
+        with self.lock:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                if len(self.chat_buckets) >= self.max_chat_buckets:
+                    # A full bucket is equivalent to a new one, so it can safely be forgotten.
+                    self.chat_buckets = {c: b for c, b in self.chat_buckets.items() if not b.is_full()}
+                bucket = TokenBucket(self.chat_rate)
+                self.chat_buckets[chat_id] = bucket
+            return bucket
+
+    def acquire(self, chat_id: str) -> None:
+        """
+        Waits until an action is allowed in a chat.
+
+        :param str chat_id: A Telegram Chat ID.
+        """
+        # Wait for the chat first, so that a global token is not held while waiting.
+        self.__get_chat_bucket(chat_id).acquire()
+        self.global_bucket.acquire()
+
+    def pause(self, seconds: float) -> None:
+        """
+        Blocks every action during `seconds`, for instance when the API asks to retry later.
+
+        :param float seconds: A delay, in seconds.
+        """
+        self.global_bucket.pause(seconds)
@@ -0,0 +1,128 @@
+# -*- coding: UTF8 -*-
+
+import logging
+import secrets
+import threading
+
+from array import array
+from collections import deque
+
+from .config import Config
+from .portindex import PortIndex
+
+
+class SequencePool:
+
+    """
+    Sequences of ports generated in advance, from a cryptographically secure source (`secrets`),
+    so that rotating the sequence does not wait for their generation.
+
+    The ports are drawn in batches: a single buffer of random bytes is read as 16-bit values,
+    each mapped to one of the acceptable ports (see `Config.acceptable_port_range` and `Config.ports_blacklist`)
+    through the lookup tables of their `PortIndex`. Every acceptable port is equally likely.
+
+    A background thread refills the pool as soon as it is less than half full.
+    The sequences generated for a previous configuration of the ports are dropped.
+
+    Usage:
+
+    >>> pool = SequencePool(Config.sequence_pool_size)
+    >>> pool.get()
+    [6158, 16499, 8715]
+    """
+
+    def __init__(self, size: int or None = None):
+        """
+        :param int|None size: Optional. Number of sequences kept ready. Defaults to `Config.sequence_pool_size`.
+        """
+        size = Config.sequence_pool_size if size is None else size
+        self.size = size
+        self.low = max(1, size // 2)  # The pool is refilled below this number of sequences.
+        self.sequences = deque()
+        self.key = self.__key()
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def __key() -> tuple:
+        """
+        :return tuple: The configuration the sequences depend on. The range and the blacklist are compared by
+        identity (see `PortIndex.current()`), see `__same_key()`.
+        """
+        return Config.acceptable_port_range, Config.ports_blacklist, Config.sequences_length
+
+    @staticmethod
+    def __same_key(key: tuple, other: tuple) -> bool:
+        return key[0] is other[0] and key[1] is other[1] and key[2] == other[2]
+
+    @staticmethod
+    def generate(count: int, length: int, port_range: range, blacklist: tuple) -> list:
+        """
+        Generates sequences in a single batch.
+
+        :param int count: Number of sequences.
+        :param int length: Number of ports per sequence.
+        :param range port_range: The acceptable ports.
+        :param tuple blacklist: Ports which must not be used.
+        :return list: A list of `count` tuples of `length` ports.
+        """
+        index = PortIndex.get(port_range, blacklist)
+        needed = count * length
+        ports = array("H")
+        while len(ports) < needed:
+            missing = needed - len(ports)
+            # Draws enough values for the expected share of them to be kept, plus a margin.
+            draws = int(missing / index.share) + 16
+            ports.extend(index.sample(array("H", secrets.token_bytes(draws * ports.itemsize))))
+        return [tuple(ports[i:i + length]) for i in range(0, needed, length)]
+
+    def get(self) -> list:
+        """
+        :return list: A new sequence of `Config.sequences_length` ports.
+        """
+        key = self.__key()
+        with self.condition:
+            if not self.__same_key(key, self.key):
+                logging.info("The configuration of the ports changed, the sequences generated in advance are dropped.")
+                self.sequences.clear()
+                self.key = key
+            if not self.sequences:
+                # Not refilled yet.
+                self.sequences.extend(self.generate(self.size, key[2], key[0], tuple(key[1])))
+            sequence = self.sequences.popleft()
+            if len(self.sequences) < self.low:
+                self.condition.notify()
+        return list(sequence)
+
+    def close(self) -> None:
+        """
+        Stops the background thread.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+    def __run(self) -> None:
+        while True:
+            with self.condition:
+                while not self.closed and len(self.sequences) >= self.low:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                key = self.key
+                missing = self.size - len(self.sequences)
+            try:
+                sequences = self.generate(missing, key[2], key[0], tuple(key[1]))
+            except ValueError:
+                logging.exception("Could not generate sequences.")
+                # Until the configuration changes.
+                with self.condition:
+                    while not self.closed and self.__same_key(self.key, key):
+                        self.condition.wait()
+                continue
+            with self.condition:
+                if self.__same_key(self.key, key):
+                    self.sequences.extend(sequences[:self.size - len(self.sequences)])
@@ -1,93 +1,280 @@
-import requests
-import logging
-import random
-
-from .config import Config
-
-
-class TelegramBot:
-
-    """
-
-    This class is a production-ready high-level Telegram bot handler.
-
-    It contains actions the bot must do on its own
-    (not triggered by users, those are located in the `Commands` class).
-
-    """
-
-    def __init__(self):
-        self.__set_identifier()
-        logging.info(f"New instance \"{self.identifier}\" of the Telegram bot created.")
-        self.__set_token()
-        # Construct API address
-        self.api_url = f"https://api.telegram.org/bot{self.token}/"
-        if not self.__is_token_valid():
-            raise ValueError("The Telegram token is invalid. Please check config.py.")
-
-    def __del__(self):
-        logging.info(f"Bot instance {self.identifier} destroyed.")
-
-    def __set_identifier(self) -> None:
-        """
-        Creates a new identifier from 6 letters randomly picked between a and z.
-        It is used as a name for the bot instance.
-        """
-        identifier = ''.join([(chr(random.randint(97, 123))) for _ in range(6)])
-        self.identifier = identifier[0].upper() + identifier[1:]
-
-    def __set_token(self) -> None:
-        """
-        Self explanatory.
-        """
-        self.token = Config.telegram_token
-
-    def __is_token_valid(self) -> bool:
-        """
-        Will request the API with the token provided, and, depending on the response, will deduce if it correct.
-        :return bool: True if it is, False otherwise.
-        """
-        r = requests.get(self.api_url)
-        if r.json()["description"] != "Not Found":  # The API returns "Unauthorized" when the token is invalid.
-            return False
-        return True
-
-    def get_updates(self, offset: int = 0, timeout: int = 30) -> dict:
-        """
-        Get new updates from the API. Essentially, get the new messages.
-
-        :param int offset: (From https://core.telegram.org/bots/api#getupdates).
-        Identifier of the first update to be returned.
-        Must be greater by one than the highest among the identifiers of previously received updates.
-        By default, updates starting with the earliest unconfirmed update are returned.
-        An update is considered confirmed as soon as getUpdates is called with an offset higher than its update_id.
-        The negative offset can be specified to retrieve updates starting from -
-        offset update from the end of the updates queue. All previous updates will be forgotten.
-        :param int timeout: (From https://core.telegram.org/bots/api#getupdates).
-        Timeout in seconds for long polling.
-        Should be positive, short polling should be used for testing purposes only.
-        :return dict: The update.
-        """
-        method = 'getUpdates'
-        params = {'timeout': timeout, 'offset': offset}
-        resp = requests.get(self.api_url + method, params)
-        result_json = resp.json()['result']
-        return result_json
-
-    def send_message(self, chat_id: str, text: str, reply_to: str or None = None) -> requests.Response:
-        """
-        Send a message to a chat_id.
-
-        :param str chat_id: The channel ID into which the message will be sent.
-        :param str text: The message to send.
-        :param str|None reply_to: Optional. ID of the message to respond to.
-        :return requests.Response: A response object.
-        """
-        params = {'chat_id': chat_id, 'text': text, 'parse_mode': 'HTML'}
-
-        if type(reply_to) == int:
-            params.update({"reply_to_message_id": reply_to})
-
-        method = 'sendMessage'
-        resp = requests.post(self.api_url + method, params)
-        return resp
+import requests
+import logging
+import random
+import asyncio
+import time
+
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from .config import Config
+from .ratelimit import RateLimiter
+
+
+class UncertainRequest(requests.RequestException):
+
+    """
+    Raised when a request which is not idempotent (i.e. "sendMessage") failed after it was sent (i.e. read timeout):
+    the API may have processed it, sending it again could deliver a message twice.
+    """
+
+
+class TelegramBot:
+
+    """
+
+    This class is a production-ready high-level Telegram bot handler.
+
+    It contains actions the bot must do on its own
+    (not triggered by users, those are located in the `Commands` class).
+
+    """
+
+    def __init__(self):
+        self.__set_identifier()
+        logging.info(f"New instance \"{self.identifier}\" of the Telegram bot created.")
+        self.__set_token()
+        # Construct API address
+        self.api_url = f"{Config.telegram_api_url}/bot{self.token}/"
+        self.session = self.__create_session()
+        self.rate_limiter = RateLimiter(Config.telegram_global_rate_limit, Config.telegram_chat_rate_limit)
+        # Number of consecutive failed polls, used to slow down polling while the API is unreachable.
+        self.poll_failures = 0
+        if not self.__is_token_valid():
+            raise ValueError("The Telegram token is invalid. Please check config.py.")
+
+    def __del__(self):
+        self.session.close()
+        logging.info(f"Bot instance {self.identifier} destroyed.")
+
+    def __set_identifier(self) -> None:
+        """
+        Creates a new identifier from 6 letters randomly picked between a and z.
+        It is used as a name for the bot instance.
+        """
+        identifier = ''.join([(chr(random.randint(97, 123))) for _ in range(6)])
+        self.identifier = identifier[0].upper() + identifier[1:]
+
+    def __set_token(self) -> None:
+        """
+        Self explanatory.
+        """
+        self.token = Config.telegram_token
+
+    @staticmethod
+    def __create_session() -> requests.Session:
+        """
+        Creates the HTTP session used for every call to the API.
+        Its connections are kept alive and reused, which spares a TCP and TLS handshake per request.
+
+        :return requests.Session: A session object.
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,  # Only one host is ever contacted.
+            pool_maxsize=Config.telegram_pool_size,
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    @staticmethod
+    def __get_backoff_delay(attempt: int) -> float:
+        """
+        Computes a jittered exponential backoff delay.
+
+        :param int attempt: How many attempts failed so far, minus one.
+        :return float: A delay, in seconds.
+        """
+        return random.uniform(0, min(Config.telegram_backoff_max, Config.telegram_backoff_base * 2 ** attempt))
+
+    @staticmethod
+    def __get_retry_after(resp: requests.Response) -> int or None:
+        """
+        :param requests.Response resp: A response with status code 429.
+        :return int|None: The delay asked by the API before retrying, if any.
+        """
+        try:
+            return int(resp.json()["parameters"]["retry_after"])
+        except (ValueError, KeyError, TypeError):
+            return None
+
+    @staticmethod
+    def __is_connect_error(error: requests.RequestException) -> bool:
+        """
+        :param requests.RequestException error: An error raised by a request.
+        :return bool: True if the connection could not be established: the request was not sent.
+        """
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], "reason", None) if error.args else None
+        return isinstance(error, requests.ConnectionError) and isinstance(reason, NewConnectionError)
+
+    def __request(self, http_method: str, method: str, params: dict, poll_timeout: int = 0,
+                  idempotent: bool = True) -> requests.Response or None:
+        """
+        Sends a request to the API through the pooled session.
+        Network errors, 5xx and 429 responses are retried up to `Config.telegram_max_retries` times,
+        waiting for a jittered exponential backoff (or the delay asked by the API) between two attempts.
+        The requests which are not idempotent (i.e. "sendMessage") are only retried after a network error if
+        the connection could not be established. Otherwise (i.e. read timeout), the API may have processed them.
+
+        :param str http_method: "GET" or "POST".
+        :param str method: The API method, such as "sendMessage".
+        :param dict params: The parameters of the API method.
+        :param int poll_timeout: Long polling timeout of the request, added to the read timeout.
+        :param bool idempotent: Whether the request can be sent again after it may have been processed.
+        :return requests.Response|None: The last response received, or None if the API could not be reached.
+        :raises UncertainRequest: If a request which is not idempotent failed after it was sent.
+        """
+        timeout = (Config.telegram_connect_timeout, Config.telegram_read_timeout + poll_timeout)
+        if http_method == "GET":
+            kwargs = {"params": params, "timeout": timeout}
+        else:
+            kwargs = {"data": params, "timeout": timeout}
+
+        resp = None
+        for attempt in range(Config.telegram_max_retries + 1):
+            try:
+                resp = self.session.request(http_method, self.api_url + method, **kwargs)
+            except requests.RequestException as e:
+                logging.warning(f"Request {method} failed (attempt {attempt + 1}): {e}")
+                if not idempotent and not self.__is_connect_error(e):
+                    raise UncertainRequest(f"Request {method} not retried: it may have been received.") from e
+                delay = self.__get_backoff_delay(attempt)
+            else:
+                if resp.status_code == 429:
+                    delay = self.__get_retry_after(resp)
+                    if delay is None:
+                        delay = self.__get_backoff_delay(attempt)
+                    # Hold back every other message as well.
+                    self.rate_limiter.pause(delay)
+                    logging.warning(f"Request {method} rate limited, retrying in {delay} seconds.")
+                elif resp.status_code >= 500:
+                    delay = self.__get_backoff_delay(attempt)
+                    logging.warning(f"Request {method} returned code {resp.status_code} (attempt {attempt + 1}).")
+                else:
+                    return resp
+            if attempt < Config.telegram_max_retries:
+                time.sleep(delay)
+        logging.error(f"Request {method} failed after {Config.telegram_max_retries + 1} attempts.")
+        return resp
+
+    def __is_token_valid(self) -> bool:
+        """
+        Will request the API with the token provided, and, depending on the response, will deduce if it correct.
+        :return bool: True if it is, False otherwise.
+        """
+        r = self.__request("GET", "", {})
+        if r is None:
+            raise ConnectionError("Could not reach the Telegram API.")
+        if r.json()["description"] != "Not Found":  # The API returns "Unauthorized" when the token is invalid.
+            return False
+        return True
+
+    def get_updates(self, offset: int = 0, timeout: int = 30, limit: int = 100) -> dict:
+        """
+        Get new updates from the API. Essentially, get the new messages.
+
+        :param int offset: (From https://core.telegram.org/bots/api#getupdates).
+        Identifier of the first update to be returned.
+        Must be greater by one than the highest among the identifiers of previously received updates.
+        By default, updates starting with the earliest unconfirmed update are returned.
+        An update is considered confirmed as soon as getUpdates is called with an offset higher than its update_id.
+        The negative offset can be specified to retrieve updates starting from -
+        offset update from the end of the updates queue. All previous updates will be forgotten.
+        :param int timeout: (From https://core.telegram.org/bots/api#getupdates).
+        Timeout in seconds for long polling.
+        Should be positive, short polling should be used for testing purposes only.
+        :param int limit: (From https://core.telegram.org/bots/api#getupdates).
+        Limits the number of updates to be retrieved. Values between 1-100 are accepted.
+        :return dict: The update.
+        An empty list is returned if the API could not be reached, or refused the request.
+        """
+        method = 'getUpdates'
+        params = {'timeout': timeout, 'offset': offset, 'limit': limit}
+        resp = self.__request("GET", method, params, poll_timeout=timeout)
+        if resp is not None and not resp.ok and resp.status_code < 500 and resp.status_code != 429:
+            # Not transient (i.e. 401: invalid token ; 409: a webhook is set): it must be fixed by hand.
+            try:
+                description = resp.json().get("description", "")
+            except ValueError:
+                description = ""
+            logging.error(f"Could not get the updates: code {resp.status_code}, \"{description}\".")
+        if resp is None or not resp.ok:
+            # Do not hammer the API while it is failing: wait longer after each consecutive failure.
+            self.poll_failures += 1
+            time.sleep(self.__get_backoff_delay(self.poll_failures))
+            return []
+        self.poll_failures = 0
+        result_json = resp.json()['result']
+        return result_json
+
+    def set_webhook(self, url: str, secret_token: str = "") -> bool:
+        """
+        Asks Telegram to push the updates to an URL instead of keeping them for `get_updates`.
+
+        :param str url: The HTTPS URL to send the updates to.
+        :param str secret_token: Optional. Secret sent back in the header "X-Telegram-Bot-Api-Secret-Token".
+        :return bool: True if the webhook was set, False otherwise.
+        """
+        params = {'url': url}
+        if secret_token:
+            params.update({'secret_token': secret_token})
+        resp = self.__request("POST", 'setWebhook', params)
+        if resp is None or not resp.ok:
+            logging.error(f"Could not set the webhook to {url}.")
+            return False
+        logging.info(f"Webhook set to {url}.")
+        return True
+
+    def delete_webhook(self) -> bool:
+        """
+        Removes the webhook, so that the updates can be fetched with `get_updates` again.
+
+        :return bool: True if the webhook was removed, False otherwise.
+        """
+        resp = self.__request("POST", 'deleteWebhook', {})
+        return resp is not None and resp.ok
+
+    def send_message(self, chat_id: str, text: str, reply_to: str or None = None) -> requests.Response or None:
+        """
+        Send a message to a chat_id.
+        Waits if needed, so that the rate limits set in the configuration are respected.
+
+        :param str chat_id: The channel ID into which the message will be sent.
+        :param str text: The message to send.
+        :param str|None reply_to: Optional. ID of the message to respond to.
+        :return requests.Response|None: A response object, or None if the API could not be reached.
+        :raises UncertainRequest: If the message was sent, but no response was received: it may have been delivered.
+        """
+        params = {'chat_id': chat_id, 'text': text, 'parse_mode': 'HTML'}
+
+        if type(reply_to) == int:
+            params.update({"reply_to_message_id": reply_to})
+
+        method = 'sendMessage'
+        self.rate_limiter.acquire(chat_id)
+        resp = self.__request("POST", method, params, idempotent=False)
+        return resp
+
+    async def get_updates_async(self, offset: int = 0, timeout: int = 30) -> dict:
+        """
+        Asynchronous version of `TelegramBot.get_updates`.
+        The request runs in the default executor of the event loop, over the same pooled session.
+
+        .. seealso: TelegramBot.get_updates()
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.get_updates, offset, timeout)
+
+    async def send_message_async(self, chat_id: str, text: str,
+                                 reply_to: str or None = None) -> requests.Response or None:
+        """
+        Asynchronous version of `TelegramBot.send_message`.
+        The request runs in the default executor of the event loop, over the same pooled session.
+
+        .. seealso: TelegramBot.send_message()
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.send_message, chat_id, text, reply_to)
@@ -1,271 +1,1236 @@
-import unittest
-
-from .permissions import Permissions
-from .telegram import TelegramBot
-from .channels import Channels
-from .commands import Commands
-from .database import Database
-from .config import Config
-from .utils import Utils
-from .core import Core
-
-
-class TestChannels(unittest.TestCase):
-
-    def setUp(self):
-        self.bot = TelegramBot()
-        self.obj = Channels(self.bot)
-        self.test_chat_id = "12345"
-
-    def tearDown(self):
-        del self.obj
-        del self.bot
-
-    def _add(self) -> None:
-        all_channels_before = self.obj.list_all_channels()
-        active_channels_before = self.obj.list_active_channels()
-
-        self.obj.add(self.test_chat_id)
-
-        all_channels_after = self.obj.list_all_channels()
-        active_channels_after = self.obj.list_active_channels()
-
-        self.assertListEqual(all_channels_before + [self.test_chat_id], all_channels_after)
-        self.assertListEqual(active_channels_before + [self.test_chat_id], active_channels_after)
-
-    def test_disable(self):
-        self._add()
-
-        all_channels_before = self.obj.list_all_channels()
-        active_channels_before = self.obj.list_active_channels()
-
-        self.obj.disable(self.test_chat_id)
-
-        all_channels_after = self.obj.list_all_channels()
-        active_channels_after = self.obj.list_active_channels()
-
-        active_channels_before.remove(self.test_chat_id)
-
-        self.assertListEqual(all_channels_before, all_channels_after)
-        self.assertListEqual(active_channels_before, active_channels_after)
-
-    def test_broadcast(self):
-        pass
-
-    def test_list_active_channels(self):
-        pass
-
-    def test_list_all_channels(self):
-        pass
-
-
-class TestCommands(unittest.TestCase):
-
-    def setUp(self):
-        self.valid_types = (type(None), str)
-
-    def test_invalid(self):
-        resp = Commands.invalid()
-        self.assertIsInstance(resp, self.valid_types)
-
-    def test_help(self):
-        resp = Commands.help()
-        self.assertIsInstance(resp, str)
-
-    def test_target_port(self):
-        resp = Commands.target_port()
-        self.assertIsInstance(resp, str)
-
-    def test_add_perm(self):
-        pass
-
-    def test_remove_perm(self):
-        pass
-
-    def test_generate(self):
-        resp = Commands.generate()
-        self.assertIsInstance(resp, str)
-
-    def test_status(self):
-        resp = Commands.status()
-        self.assertIsInstance(resp, str)
-
-    def test_print_config(self):
-        resp = Commands.print_config()
-        self.assertIsInstance(resp, str)
-
-    def test_print_broadcast_list(self):
-        resp = Commands.print_broadcast_list()
-        self.assertIsInstance(resp, str)
-
-    def test_forget(self):
-        resp = Commands.forget("123456")
-        self.assertIsInstance(resp, self.valid_types)
-
-    def test_list_groups_members(self):
-        resp = Commands.list_groups_members()
-        self.assertIsInstance(resp, str)
-
-    def test_start(self):
-        pass
-
-    def test_stop(self):
-        pass
-
-    def test_shutdown(self):
-        pass
-
-
-class TestCore(unittest.TestCase):
-
-    def test_generate_new_sequence(self):
-        seq1 = Core.generate_new_sequence()
-        seq2 = Core.generate_new_sequence()
-
-        seq3 = Core.generate_new_sequence(num=7)
-        seq4 = Core.generate_new_sequence(num=9)
-
-        seq5 = Core.generate_new_sequence(num=2, seed=12345)
-        seq6 = Core.generate_new_sequence(num=2, seed=12345)
-
-        self.assertNotEqual(seq1, seq2)  # Could potentially happen with normal behavior, but is very unlikely.
-        self.assertEqual(len(seq1), Config.sequences_length)
-
-        self.assertEqual(len(seq3), 7)
-        self.assertEqual(len(seq4), 9)
-
-        self.assertEqual(seq5, seq6)
-
-    def test_set_open_sequence(self):
-        pass
-
-    def test_configure_knockd(self):
-        pass
-
-
-class TestDatabase(unittest.TestCase):
-
-    def test_create_db(self):
-        pass
-
-    def test_insert_new_column(self):
-        pass
-
-    def test_column_exists(self):
-        pass
-
-    def test_key_exists(self):
-        pass
-
-    def test_insert_dict(self):
-        pass
-
-    def test_insert_list(self):
-        pass
-
-    def test_update(self):
-        pass
-
-    def test_query_column(self):
-        pass
-
-    def test_query(self):
-        pass
-
-
-class TestPermissions(unittest.TestCase):
-
-    def setUp(self):
-        self.perms = Permissions()
-
-    def test_set_telegram_admins(self):
-        self.assertTrue(self.perms.is_group_valid("admin"))
-
-    def test_user_exists(self):
-        pass
-
-    def test_get_group_members(self):
-        pass
-
-    def test_get_valid_groups(self):
-        pass
-
-    def test_is_group_valid(self):
-        pass
-
-    def test_create_user(self):
-        pass
-
-    def _add_user_to_group(self, user_id: str, group: str) -> None:
-        self.perms.add_user_to_group(user_id, group)
-
-    def test_remove_user_from_group(self):
-        """
-        Will test both add and remove.
-        """
-        user_id = "12345"
-        group = "admin"
-
-        group_before_add = self.perms.get_group_members(group)
-
-        self._add_user_to_group(user_id, group)
-
-        group_after_add = self.perms.get_group_members(group)
-        group_before_remove = group_after_add
-
-        self.perms.remove_user_from_group(user_id, group)
-
-        group_after_remove = self.perms.get_group_members(group)
-
-        # Make sure add works
-        self.assertNotEqual(group_before_add, group_after_add)
-        # Make sure remove works
-        self.assertNotEqual(group_before_remove, group_after_remove)
-        # Extra assert to test both (will pass if both are broken)
-        self.assertEqual(group_before_add, group_after_remove)
-
-    def test_get_groups_permissions(self):
-        pass
-
-    def test_is_user_allowed(self):
-        pass
-
-
-class TestTelegramBot(unittest.TestCase):
-
-    def test___set_identifier(self):
-        pass
-
-    def test___set_token(self):
-        pass
-
-    def test___is_token_valid(self):
-        pass
-
-    def test_get_updates(self):
-        pass
-
-    def test_send_message(self):
-        pass
-
-
-class TestUtils(unittest.TestCase):
-
-    def test_start_service(self):
-        pass
-
-    def test_stop_service(self):
-        pass
-
-    def test_restart_service(self):
-        pass
-
-    def test_install_package(self):
-        pass
-
-    def test_filter_port_list(self):
-        pass
-
-
-if __name__ == "__main__":
-    unittest.main()
+import unittest
+import tempfile
+import random
+import shelve
+import threading
+import requests
+import fcntl
+import multiprocessing
+import time
+import os
+
+from array import array
+from collections import Counter
+
+from . import PKS
+from .checkpoint import OffsetCheckpoint
+from .permissions import Permissions
+from .telegram import TelegramBot, UncertainRequest
+from .mock_telegram import MockTelegramServer
+from .webhook import WebhookServer
+from .channels import Channels
+from .commands import Commands
+from .database import Database
+from .backends import ShelveBackend, LogBackend
+from .filelock import FileLock
+from .ratelimit import TokenBucket
+from .sequencepool import SequencePool
+from .portindex import PortIndex
+from .timesequence import TimeSequences
+from .userlist import UserList
+from .outbox import Outbox
+from .dispatcher import Dispatcher
+from .config import Config
+from .utils import Utils
+from .core import Core
+
+
+class MockTelegramTestCase(unittest.TestCase):
+
+    """
+    Runs the tests against a local mock of the Telegram Bot API.
+    """
+
+    def setUp(self):
+        self.server = MockTelegramServer(token="test")
+        self.server.start()
+        self.config_backup = (Config.telegram_api_url, Config.telegram_token, Config.telegram_backoff_base)
+        Config.telegram_api_url = self.server.url
+        Config.telegram_token = self.server.token
+        Config.telegram_backoff_base = 0.01
+
+    def tearDown(self):
+        Config.telegram_api_url, Config.telegram_token, Config.telegram_backoff_base = self.config_backup
+        self.server.stop()
+
+
+class TestPKS(unittest.TestCase):
+
+    class FakeBot:
+        def __init__(self, updates: list):
+            self.updates = updates
+            self.calls = 0
+
+        def get_updates(self, offset: int = 0, timeout: int = 30, limit: int = 100) -> list:
+            self.calls += 1
+            return [u for u in self.updates if u['update_id'] >= offset][:limit]
+
+    @staticmethod
+    def _update(update_id: int, date: int) -> dict:
+        return {
+            "update_id": update_id,
+            "message": {"message_id": update_id, "date": date, "text": "/help", "chat": {"id": 1}, "from": {"id": 1}},
+        }
+
+    def test_skip_backlog(self):
+        now = int(time.time())
+        stale = [self._update(i, now - 3600) for i in range(250)]
+        bot = self.FakeBot(stale + [self._update(250, now)])
+        pks = PKS(bot)
+
+        # The stale batches are dropped, the one containing a recent update is kept.
+        self.assertEqual(pks.skip_backlog(0, max_age=60), 200)
+        self.assertEqual(bot.calls, 3)
+
+        bot = self.FakeBot(stale)
+        pks.bot = bot
+        self.assertEqual(pks.skip_backlog(0, max_age=60), 250)
+
+    def test_execute(self):
+        pks = PKS(self.FakeBot([]))
+        commands_l = pks.commands_l
+
+        update = self._update(1, int(time.time()))
+        update['message']['text'] = "/add_perm 12345"
+        self.assertEqual(pks.execute(update), "Too few arguments: expected 2, got 1. Please refer to \"/help\".")
+        update['message']['text'] = "/add_perms guest"
+        self.assertEqual(pks.execute(update),
+                         "Too few arguments: expected at least 2, got 1. Please refer to \"/help\".")
+        update['message']['text'] = "/import_perms\n2001,guest\n2002,unknown"
+        self.assertEqual(pks.execute(update), "1 users added to a group.\n1 invalid lines ignored: 2002,unknown")
+        pks.commands_o.permissions.remove_user_from_group("2001", "guest")
+        update['message']['text'] = "/unknown"
+        self.assertIsNone(pks.execute(update))
+
+        # The registry is not rebuilt, and the arguments of a call do not leak into the next one.
+        self.assertIs(pks.commands_l, commands_l)
+        self.assertListEqual(pks.commands_l["/add_perm"][2], [])
+
+    def test_help(self):
+        pks = PKS(self.FakeBot([]))
+        pks.commands_o.running = True
+        update = self._update(1, int(time.time()))
+        help_text = pks.execute(update)
+        self.assertTrue(help_text.startswith("Commands available:"))
+        self.assertIn("/add_perm: Add a user to a group.", help_text)
+        self.assertNotIn("/help:", help_text)
+        # Built once, with the registry.
+        self.assertIs(pks.execute(update), help_text)
+
+
+class TestChannels(MockTelegramTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.bot = TelegramBot()
+        self.obj = Channels(self.bot, db_name=os.path.join(self.directory.name, "channels.db"))
+        self.test_chat_id = "12345"
+
+    def tearDown(self):
+        if self.obj.retry_timer is not None:
+            self.obj.retry_timer.cancel()
+        self.obj.db.close()
+        del self.obj
+        del self.bot
+        self.directory.cleanup()
+        super().tearDown()
+
+    def _add(self) -> None:
+        all_channels_before = self.obj.list_all_channels()
+        active_channels_before = self.obj.list_active_channels()
+
+        self.obj.add(self.test_chat_id)
+
+        all_channels_after = self.obj.list_all_channels()
+        active_channels_after = self.obj.list_active_channels()
+
+        self.assertListEqual(all_channels_before + [self.test_chat_id], all_channels_after)
+        self.assertListEqual(active_channels_before + [self.test_chat_id], active_channels_after)
+
+    def test_disable(self):
+        self._add()
+
+        all_channels_before = self.obj.list_all_channels()
+        active_channels_before = self.obj.list_active_channels()
+
+        self.obj.disable(self.test_chat_id)
+
+        all_channels_after = self.obj.list_all_channels()
+        active_channels_after = self.obj.list_active_channels()
+
+        active_channels_before.remove(self.test_chat_id)
+
+        self.assertListEqual(all_channels_before, all_channels_after)
+        self.assertListEqual(active_channels_before, active_channels_after)
+
+    def test_broadcast(self):
+        chat_ids = [str(chat_id) for chat_id in range(500, 520)]
+        for chat_id in chat_ids:
+            self.obj.add(chat_id)
+        backup = Config.broadcast_max_pending
+        Config.broadcast_max_pending = 3
+        try:
+            results = self.obj.broadcast("Test")
+        finally:
+            Config.broadcast_max_pending = backup
+            for chat_id in chat_ids:
+                self.obj.disable(chat_id)
+        self.assertTrue(all(results[chat_id] for chat_id in chat_ids))
+        self.assertEqual(self.server.calls["sendMessage"], len(results))
+
+    def test_delivery_outcomes(self):
+        chat_ids = ["700", "701", "702"]
+        for chat_id in chat_ids:
+            self.obj.add(chat_id)
+        self.server.blocked_chats.add("701")
+        backup = Config.telegram_max_retries
+        Config.telegram_max_retries = 0
+        try:
+            results = self.obj.broadcast("Test")
+            self.assertTrue(results["700"])
+            self.assertFalse(results["701"])
+            # The bot was blocked: the channel is disabled.
+            self.assertNotIn("701", self.obj.list_active_channels())
+            self.assertIsNone(self.obj.db.get_retry("701"))
+
+            self.server.error_rate = 1
+            # Only the channels of this test are broadcast to.
+            self.obj.db.disable_channels([chat_id for chat_id in self.obj.list_active_channels()
+                                          if chat_id not in chat_ids])
+            results = self.obj.broadcast("Test 2")
+            self.assertEqual(results, {"700": False, "702": False})
+            entry = self.obj.db.get_retry("702")
+            self.assertEqual((entry["messages"], entry["attempts"]), (["Test 2"], 0))
+            self.assertGreater(entry["due"], time.time())
+
+            # Not due yet.
+            self.assertEqual(self.obj.retry_pending(), 0)
+            self.obj.db.set_retry("702", dict(entry, due=0))
+            self.obj.db.set_retry("700", dict(entry, due=0, attempts=Config.broadcast_max_retries))
+            # Failed again: retried later, or given up after too many attempts.
+            self.assertEqual(self.obj.retry_pending(), 2)
+            self.assertEqual(self.obj.db.get_retry("702")["attempts"], 1)
+            self.assertIsNone(self.obj.db.get_retry("700"))
+
+            self.server.error_rate = 0
+            self.obj.db.set_retry("702", dict(entry, due=0))
+            sent = len(self.server.sent)
+            self.assertEqual(self.obj.retry_pending(), 1)
+            self.assertEqual(self.server.sent[sent:][0][1:3], ("702", "Test 2"))
+            self.assertEqual(self.obj.db.list_retries(), {})
+            # The entries are deleted, not only set to None.
+            self.assertFalse(self.obj.db.key_exists(self.obj.db.db_columns[1], "702"))
+        finally:
+            Config.telegram_max_retries = backup
+            self.obj.db.disable_channels(chat_ids)
+
+    def test_list_active_channels(self):
+        for chat_id in ["600", "601", "602"]:
+            self.obj.add(chat_id)
+        active_channels = self.obj.list_active_channels()
+        self.assertEqual(active_channels[-3:], ["600", "601", "602"])
+        self.assertEqual(self.obj.list_active_channels(offset=len(active_channels) - 2, limit=1), ["601"])
+        self.assertEqual(list(self.obj.iter_active_channels()), active_channels)
+        # Already active: nothing is written.
+        self.obj.db.flush()
+        self.obj.add("600")
+        self.assertFalse(self.obj.db.pending)
+        for chat_id in ["600", "601", "602"]:
+            self.obj.disable(chat_id)
+        self.assertEqual(self.obj.list_active_channels(), active_channels[:-3])
+
+    def test_list_all_channels(self):
+        pass
+
+
+class TestCommands(unittest.TestCase):
+
+    def setUp(self):
+        self.valid_types = (type(None), str)
+
+    def test_permissions_required(self):
+        commands = Commands(Channels(None))
+        forbidden = "Action forbidden ; insufficient rights."
+        # The identity of the caller is passed with each call.
+        self.assertEqual(commands.add_perm("12345", "member", user_id="12345"), forbidden)
+        self.assertEqual(commands.add_perm("12345", "member", user_id=Permissions.system_account),
+                         "User 12345 successfully added to group member !")
+        self.assertEqual(commands.remove_perm("12345", "member"), forbidden)
+        commands.remove_perm("12345", "member", user_id=Permissions.system_account)
+
+    def test_invalid(self):
+        resp = Commands.invalid()
+        self.assertIsInstance(resp, self.valid_types)
+
+    def test_help(self):
+        resp = Commands.help()
+        self.assertIsInstance(resp, str)
+
+    def test_target_port(self):
+        resp = Commands.target_port()
+        self.assertIsInstance(resp, str)
+
+    def test_add_perm(self):
+        pass
+
+    def test_remove_perm(self):
+        pass
+
+    def test_generate(self):
+        resp = Commands.generate()
+        self.assertIsInstance(resp, str)
+
+    def test_generate_system_account(self):
+        # As called by trigger_sequence_change.py, on each SSH login.
+        commands = Commands(Channels(None))
+        backup = Config.knockd_config_file, Utils.__dict__["restart_service"], Config.sequence_secret
+        with tempfile.TemporaryDirectory() as directory:
+            Config.knockd_config_file = os.path.join(directory, "knockd.conf")
+            Config.sequence_secret = None
+            Utils.restart_service = staticmethod(lambda service: True)
+            try:
+                resp = commands.generate(user_id=Permissions.system_account)
+            finally:
+                Config.knockd_config_file, Utils.restart_service, Config.sequence_secret = backup
+        self.assertTrue(resp.startswith("New sequence: "), resp)
+
+    def test_status(self):
+        resp = Commands.status()
+        self.assertIsInstance(resp, str)
+
+    def test_print_config(self):
+        resp = Commands.print_config()
+        self.assertIsInstance(resp, str)
+
+    def test_print_broadcast_list(self):
+        resp = Commands.print_broadcast_list()
+        self.assertIsInstance(resp, str)
+
+    def test_forget(self):
+        resp = Commands.forget("123456")
+        self.assertIsInstance(resp, self.valid_types)
+
+    def test_list_groups_members(self):
+        resp = Commands.list_groups_members()
+        self.assertIsInstance(resp, str)
+
+    def test_start(self):
+        pass
+
+    def test_stop(self):
+        pass
+
+    def test_shutdown(self):
+        pass
+
+
+class TestCore(unittest.TestCase):
+
+    def test_generate_new_sequence(self):
+        seq1 = Core.generate_new_sequence()
+        seq2 = Core.generate_new_sequence()
+
+        seq3 = Core.generate_new_sequence(num=7)
+        seq4 = Core.generate_new_sequence(num=9)
+
+        seq5 = Core.generate_new_sequence(num=2, seed=12345)
+        seq6 = Core.generate_new_sequence(num=2, seed=12345)
+
+        self.assertNotEqual(seq1, seq2)  # Could potentially happen with normal behavior, but is very unlikely.
+        self.assertEqual(len(seq1), Config.sequences_length)
+
+        self.assertEqual(len(seq3), 7)
+        self.assertEqual(len(seq4), 9)
+
+        self.assertEqual(seq5, seq6)
+
+    def test_set_open_sequence(self):
+        pass
+
+    def test_configure_knockd(self):
+        backup = Config.knockd_config_file
+        with tempfile.TemporaryDirectory() as directory:
+            Config.knockd_config_file = os.path.join(directory, "knockd.conf")
+            try:
+                Core.configure_knockd([1100, 1200, 1300], [2100, 2200, 2300])
+                with open(Config.knockd_config_file) as conf_file:
+                    conf = conf_file.read()
+            finally:
+                Config.knockd_config_file = backup
+        self.assertEqual(conf.count("[options]"), 1)
+        self.assertIn("[opencloseSSH]\n    sequence                = 1100, 1200, 1300", conf)
+        self.assertIn("[opencloseSSH2]\n    sequence                = 2100, 2200, 2300", conf)
+
+
+class TestTimeSequences(unittest.TestCase):
+
+    def setUp(self):
+        self.sequences = TimeSequences("secret", step=30, windows=2)
+
+    def tearDown(self):
+        self.sequences.close()
+
+    def test_sequence(self):
+        index = PortIndex(range(2000, 2010), (2003, ))
+        sequence = TimeSequences.derive(b"secret", 1000, 5, index)
+        self.assertEqual(sequence, TimeSequences.derive(b"secret", 1000, 5, index))
+        self.assertNotEqual(sequence, TimeSequences.derive(b"secret", 1001, 5, index))
+        self.assertNotEqual(sequence, TimeSequences.derive(b"other", 1000, 5, index))
+        self.assertTrue(all(port in index for port in sequence))
+        self.assertEqual(len(self.sequences.sequence()), Config.sequences_length)
+
+    def test_windows(self):
+        self.assertEqual(self.sequences.window(3000), 100)
+        self.assertEqual(self.sequences.window(3029.9), 100)
+        self.assertEqual(self.sequences.remaining(3020), 10)
+        # The previous step, the current one and the next two.
+        sequences = self.sequences.sequences(3000)
+        self.assertEqual(list(sequences), [99, 100, 101, 102])
+        self.assertEqual(sequences[100], self.sequences.sequence(100))
+
+    def test_start(self):
+        self.sequences.start(apply=False)
+        timer = self.sequences.timer
+        self.assertTrue(timer.is_alive())
+        # Rescheduled, not duplicated.
+        self.sequences.start(apply=False)
+        self.assertTrue(timer.finished.is_set())  # Cancelled.
+        self.sequences.close()
+        self.assertIsNone(self.sequences.timer)
+
+
+class TestPortIndex(unittest.TestCase):
+
+    def test_index(self):
+        index = PortIndex(range(2000, 2010), (2003, 2004, 3000))
+        self.assertEqual(len(index), 8)
+        self.assertEqual([index.select(i) for i in range(8)], [2000, 2001, 2002, 2005, 2006, 2007, 2008, 2009])
+        self.assertEqual([index.rank(port) for port in (1999, 2000, 2004, 2005, 2010)], [0, 0, 3, 3, 8])
+        self.assertIn(2005, index)
+        self.assertNotIn(2003, index)
+        self.assertNotIn(70000, index)
+        self.assertEqual([index.next_port(port) for port in (2003, 2009, 1000)], [2005, 2009, 2000])
+        self.assertEqual(index.next_port(2010), 2001)  # Same wrapping as before: (2010 % 2009) + 2000.
+        self.assertEqual(index.from_integer(10), 2002)
+        self.assertIs(PortIndex.get(range(2000, 2010), (2003, )), PortIndex.get(range(2000, 2010), (2003, )))
+        with self.assertRaises(ValueError):
+            PortIndex(range(100, 102), (100, 101))
+
+    def test_current(self):
+        backup = Config.acceptable_port_range, Config.ports_blacklist
+        try:
+            Config.acceptable_port_range, Config.ports_blacklist = range(2000, 2010), [2003]
+            index = PortIndex.current()
+            self.assertNotIn(2003, index)
+            self.assertIs(PortIndex.current(), index)
+            # The blacklist is replaced: the index is rebuilt.
+            Config.ports_blacklist = [2004]
+            self.assertIn(2003, PortIndex.current())
+        finally:
+            Config.acceptable_port_range, Config.ports_blacklist = backup
+
+    def test_sample(self):
+        index = PortIndex(range(2000, 2010), (2003, ))
+        ports = index.sample(array("H", range(1 << 16)))
+        # Every 16-bit value once: each acceptable port is given the same number of times.
+        self.assertEqual(len(ports), len(index) * (1 << 16) // 16)
+        self.assertEqual(Counter(ports), {port: (1 << 16) // 16 for port in index.ports})
+
+
+class TestSequencePool(unittest.TestCase):
+
+    def setUp(self):
+        self.backup = Config.acceptable_port_range, Config.ports_blacklist, Config.sequences_length
+        self.pool = SequencePool(10)
+
+    def tearDown(self):
+        self.pool.close()
+        Config.acceptable_port_range, Config.ports_blacklist, Config.sequences_length = self.backup
+
+    def test_generate(self):
+        sequences = SequencePool.generate(1000, 4, range(2000, 2010), (2003, ))
+        self.assertEqual(len(sequences), 1000)
+        self.assertTrue(all(len(sequence) == 4 for sequence in sequences))
+        ports = set(port for sequence in sequences for port in sequence)
+        self.assertEqual(ports, set(range(2000, 2010)) - {2003})
+        with self.assertRaises(ValueError):
+            SequencePool.generate(1, 3, range(100, 102), (100, 101))
+
+    def test_get(self):
+        for _ in range(30):
+            sequence = self.pool.get()
+            self.assertEqual(len(sequence), Config.sequences_length)
+            self.assertTrue(all(port in Config.acceptable_port_range for port in sequence))
+        # The sequences generated for the previous configuration are dropped.
+        Config.acceptable_port_range, Config.ports_blacklist, Config.sequences_length = range(3000, 3005), [3000], 5
+        for _ in range(30):
+            sequence = self.pool.get()
+            self.assertEqual(len(sequence), 5)
+            self.assertTrue(all(3001 <= port < 3005 for port in sequence))
+        # Refilled in the background.
+        deadline = time.monotonic() + 5
+        while len(self.pool.sequences) < 10 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.pool.sequences), 10)
+
+
+def increment_counter(db_name: str, backend: str, count: int, ready) -> None:
+    """
+    Increments a counter of the database `count` times, each time in a transaction.
+    Run in another process by `TestDatabase.test_transaction_between_processes`.
+    """
+    db = Database(db_name, {"users": dict, "events": list}, backend)
+    ready.set()
+    for _ in range(count):
+        with db.transaction():
+            db.update("users", "counter", db.query("users", "counter") + 1)
+    db.close()
+
+
+class TestDatabase(unittest.TestCase):
+
+    backend = "shelve"
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db_name = os.path.join(self.directory.name, "test.db")
+        self.db = Database(self.db_name, {"users": dict, "events": list}, self.backend)
+
+    def tearDown(self):
+        del self.db
+        self.directory.cleanup()
+
+    def test_create_db(self):
+        self.assertEqual(self.db.query_column("users"), {})
+        self.assertEqual(self.db.query_column("events"), [])
+
+    def test_insert_new_column(self):
+        self.db.insert_new_column("settings", dict)
+        self.assertTrue(self.db.column_exists("settings"))
+        self.assertRaises(TypeError, self.db.insert_new_column, "other", int)
+
+    def test_column_exists(self):
+        self.assertTrue(self.db.column_exists("users"))
+        self.assertFalse(self.db.column_exists("unknown"))
+
+    def test_key_exists(self):
+        self.db.insert_dict("users", {"42": ["admin"]})
+        self.assertTrue(self.db.key_exists("users", "42"))
+        self.assertFalse(self.db.key_exists("users", "43"))
+
+    def test_insert_dict(self):
+        self.db.insert_dict("users", {"42": ["admin"], "43": []})
+        self.assertEqual(self.db.query_column("users"), {"42": ["admin"], "43": []})
+
+    def test_insert_list(self):
+        self.db.insert_list("events", "started")
+        self.assertEqual(self.db.query_column("events"), ["started"])
+
+    def test_update(self):
+        self.db.insert_dict("users", {"42": []})
+        self.db.update("users", "42", ["member"])
+        self.assertEqual(self.db.query("users", "42"), ["member"])
+
+    def test_query_column(self):
+        self.db.insert_dict("users", {"42": []})
+        del self.db
+        # The values are persisted.
+        self.db = Database(self.db_name, {"users": dict, "events": list}, self.backend)
+        self.assertEqual(self.db.query_column("users"), {"42": []})
+
+    def test_query(self):
+        self.db.insert_dict("users", {42: ["guest"]})
+        # The keys of dictionary columns are stored as strings.
+        self.assertEqual(self.db.query("users", "42"), ["guest"])
+        self.assertEqual(self.db.query("users", 42), ["guest"])
+
+    def test_find_keys(self):
+        self.db.insert_dict("users", {"42": ["admin", "member"], "43": ["member"], "44": []})
+        self.assertEqual(sorted(self.db.find_keys("users", "member")), ["42", "43"])
+        self.db.update("users", "42", ["guest"])
+        self.assertEqual(self.db.find_keys("users", "member"), ["43"])
+        self.assertEqual(self.db.find_keys("users", "admin"), [])
+
+    def test_flush(self):
+        syncs = []
+        self.db.backend.sync = lambda: syncs.append(time.monotonic())
+        backup = Config.database_flush_interval, Config.database_max_dirty
+        try:
+            Config.database_flush_interval, Config.database_max_dirty = 60, 10
+            for i in range(25):
+                self.db.insert_dict("users", {i: []})
+            # Grouped by 10.
+            self.assertEqual(len(syncs), 2)
+            self.db.flush()
+            self.assertEqual(len(syncs), 3)
+            self.db.flush()
+            self.assertEqual(len(syncs), 3)
+
+            Config.database_flush_interval = 0.05
+            self.db.update("users", "1", ["member"])
+            self.assertEqual(len(syncs), 3)
+            time.sleep(0.5)
+            self.assertEqual(len(syncs), 4)
+        finally:
+            Config.database_flush_interval, Config.database_max_dirty = backup
+
+    def test_transaction(self):
+        self.db.insert_dict("users", {"42": ["member"]})
+        self.db.flush()
+        syncs = []
+        sync = self.db.backend.sync
+        self.db.backend.sync = lambda: syncs.append(1) or sync()
+        with self.db.transaction():
+            for i in range(100, 200):
+                self.db.insert_dict("users", {i: ["guest"]})
+            self.db.update("users", "42", ["admin"])
+            self.db.insert_list("events", "imported")
+            # The reads take the transaction into account.
+            self.assertEqual(self.db.query("users", "42"), ["admin"])
+            self.assertTrue(self.db.key_exists("users", "199"))
+            self.assertEqual(len(self.db.find_keys("users", "guest")), 100)
+            self.assertEqual(self.db.find_keys("users", "member"), [])
+            self.assertEqual(self.db.query_column("events"), ["imported"])
+            self.assertEqual(syncs, [])
+        self.assertEqual(syncs, [1])
+        self.assertEqual(len(self.db.query_column("users")), 101)
+        self.assertEqual(self.db.query("users", "42"), ["admin"])
+
+    def test_transaction_rollback(self):
+        self.db.insert_dict("users", {"42": ["member"]})
+        with self.assertRaises(ValueError):
+            with self.db.transaction():
+                self.db.update("users", "42", ["admin"])
+                self.db.insert_dict("users", {"43": []})
+                raise ValueError
+        self.assertEqual(self.db.query("users", "42"), ["member"])
+        self.assertFalse(self.db.key_exists("users", "43"))
+
+    def test_delete(self):
+        self.db.insert_dict("users", {"42": ["member"], "43": ["admin"]})
+        self.db.flush()
+        self.db.delete("users", "42")
+        self.db.delete("users", "44")
+        # Before and after the flush.
+        for _ in range(2):
+            self.assertFalse(self.db.key_exists("users", "42"))
+            self.assertNotIn("42", self.db.query_column("users"))
+            self.assertEqual(self.db.find_keys("users", "member"), [])
+            with self.assertRaises(KeyError):
+                self.db.query("users", "42")
+            self.db.flush()
+        self.db.close()
+        self.db = Database(self.db_name, {"users": dict, "events": list}, self.backend)
+        self.assertEqual(self.db.query_column("users"), {"43": ["admin"]})
+
+    def test_transaction_between_processes(self):
+        self.db.insert_dict("users", {"counter": 0})
+        self.db.flush()
+        context = multiprocessing.get_context("spawn")
+        ready = context.Event()
+        process = context.Process(target=increment_counter, args=(self.db_name, self.backend, 200, ready))
+        process.start()
+        self.assertTrue(ready.wait(30))
+        for _ in range(200):
+            with self.db.transaction():
+                self.db.update("users", "counter", self.db.query("users", "counter") + 1)
+        process.join(60)
+        self.assertEqual(process.exitcode, 0)
+        # No increment was lost: each transaction read the value written by the other process.
+        with self.db.transaction():
+            self.assertEqual(self.db.query("users", "counter"), 400)
+
+    def test_cache(self):
+        self.db.insert_dict("users", {"42": ["member"]})
+        self.assertEqual(self.db.query("users", "42"), ["member"])
+        reads = []
+        get = self.db.backend.get
+        self.db.backend.get = lambda column, key: reads.append(key) or get(column, key)
+        # Cached.
+        groups = self.db.query("users", "42")
+        self.assertTrue(self.db.key_exists("users", "42"))
+        self.assertEqual(reads, [])
+        # The value returned is a copy.
+        groups.append("admin")
+        self.assertEqual(self.db.query("users", "42"), ["member"])
+        # Updated by the writes.
+        self.db.update("users", "42", ["guest"])
+        self.assertEqual(self.db.query("users", "42"), ["guest"])
+        self.assertEqual(self.db.find_keys("users", "guest"), ["42"])
+        self.assertEqual(self.db.query_column("users"), {"42": ["guest"]})
+        self.assertFalse(self.db.key_exists("users", "43"))
+        self.db.insert_dict("users", {"43": []})
+        self.assertTrue(self.db.key_exists("users", "43"))
+        self.assertEqual(sorted(self.db.query_column("users")), ["42", "43"])
+
+    def test_external_changes(self):
+        backup = Config.database_cache_check_interval
+        try:
+            Config.database_cache_check_interval = 0
+            self.db.insert_dict("users", {"42": ["member"]})
+            self.db.flush()
+            self.assertEqual(self.db.find_keys("users", "member"), ["42"])
+            # Another process modifies the database.
+            other = Database(self.db_name, {"users": dict, "events": list}, self.backend)
+            other.update("users", "42", ["admin"])
+            other.close()
+            self.assertEqual(self.db.query("users", "42"), ["admin"])
+            self.assertEqual(self.db.find_keys("users", "member"), [])
+        finally:
+            Config.database_cache_check_interval = backup
+
+    def test_migrate(self):
+        # Database written with the former layout: one pickled value per column.
+        db_name = os.path.join(self.directory.name, "old.db")
+        with shelve.open(db_name) as old:
+            old["users"] = {"42": ["admin"], "43": []}
+            old["events"] = ["started"]
+        db = Database(db_name, {"users": dict, "events": list, "settings": dict}, "shelve")
+        self.assertEqual(db.query("users", "42"), ["admin"])
+        self.assertEqual(db.query_column("events"), ["started"])
+        self.assertEqual(db.query_column("settings"), {})
+        del db
+        with shelve.open(db_name) as catalog:
+            self.assertNotIn("users", catalog)
+            self.assertEqual(catalog["__layout__"], ShelveBackend.layout_version)
+
+
+class TestSQLiteDatabase(TestDatabase):
+
+    backend = "sqlite"
+
+    def test_find_keys(self):
+        super().test_find_keys()
+        self.db.insert_new_column("channels", dict)
+        self.db.insert_dict("channels", {"1": True, "2": False})
+        self.assertEqual(self.db.find_keys("channels", True), ["1"])
+
+
+class TestLogDatabase(TestDatabase):
+
+    backend = "log"
+
+
+class TestLogBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db_name = os.path.join(self.directory.name, "test.db")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_truncated_log(self):
+        backend = LogBackend(self.db_name)
+        backend.create_column("users", dict)
+        backend.sync()
+        sizes = [os.path.getsize(f"{self.db_name}.log.0")]
+        for i in range(50):
+            backend.put("users", str(i), [i])
+            backend.sync()
+            sizes.append(os.path.getsize(f"{self.db_name}.log.0"))
+        backend.close()
+        with open(f"{self.db_name}.log.0", "rb") as file:
+            log = file.read()
+
+        # Simulates crashes at random points of the writes.
+        cuts = random.Random(0).sample(range(sizes[0], len(log)), 30)
+        for cut in cuts:
+            with open(f"{self.db_name}.log.0", "wb") as file:
+                file.write(log[:cut])
+            backend = LogBackend(self.db_name)
+            # The complete records are kept, the incomplete one is dropped.
+            complete = len([size for size in sizes[1:] if size <= cut])
+            self.assertEqual(dict(backend.items("users")), {str(i): [i] for i in range(complete)})
+            # The log is usable afterwards.
+            backend.put("users", "new", [])
+            backend.close()
+            backend = LogBackend(self.db_name)
+            self.assertEqual(len(list(backend.items("users"))), complete + 1)
+            backend.close()
+
+    def test_compaction(self):
+        backup = Config.database_log_garbage_ratio, Config.database_log_compaction_min_records
+        try:
+            Config.database_log_garbage_ratio, Config.database_log_compaction_min_records = 0.5, 100
+            backend = LogBackend(self.db_name)
+            backend.create_column("channels", dict)
+            for i in range(1000):
+                backend.put("channels", str(i % 10), i)
+            # Most of these records were overwritten: the log was compacted in the background,
+            # the writes going to a new log meanwhile.
+            self.assertIsNotNone(backend.compaction)
+            backend.put("channels", "0", 1000)
+            # Compacts the records written since, and waits for the snapshot.
+            backend.compact()
+            backend.close()
+            self.assertTrue(os.path.exists(f"{self.db_name}.snapshot"))
+            self.assertEqual(os.path.getsize(f"{self.db_name}.log.{backend.log_number}"), 0)
+            self.assertEqual(len([name for name in os.listdir(self.directory.name) if ".log." in name]), 1)
+            backend = LogBackend(self.db_name)
+            self.assertEqual(dict(backend.items("channels")), {"0": 1000, **{str(i): 990 + i for i in range(1, 10)}})
+            backend.close()
+        finally:
+            Config.database_log_garbage_ratio, Config.database_log_compaction_min_records = backup
+
+
+class TestFileLock(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "test.lock")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def other_process_can_lock(self, mode: int) -> bool:
+        """
+        A separate open file behaves like another process.
+        """
+        with open(self.path, "a") as file:
+            try:
+                fcntl.flock(file.fileno(), mode | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+            return True
+
+    def test_modes(self):
+        lock = FileLock.get(self.path)
+        self.assertIs(lock, FileLock.get(self.path))
+        with lock.shared():
+            self.assertTrue(self.other_process_can_lock(fcntl.LOCK_SH))
+            self.assertFalse(self.other_process_can_lock(fcntl.LOCK_EX))
+            # Reentrant, and can be upgraded.
+            with lock.exclusive():
+                self.assertFalse(self.other_process_can_lock(fcntl.LOCK_SH))
+                with lock.shared():
+                    self.assertFalse(self.other_process_can_lock(fcntl.LOCK_SH))
+            self.assertTrue(self.other_process_can_lock(fcntl.LOCK_SH))
+            self.assertFalse(self.other_process_can_lock(fcntl.LOCK_EX))
+        self.assertTrue(self.other_process_can_lock(fcntl.LOCK_EX))
+
+    def test_contention(self):
+        lock = FileLock.get(self.path)
+        with open(self.path, "a") as file:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+            threading.Timer(0.1, fcntl.flock, (file.fileno(), fcntl.LOCK_UN)).start()
+            with lock.shared():
+                pass
+        stats = lock.stats()
+        self.assertEqual(stats["acquisitions"], 1)
+        self.assertEqual(stats["contentions"], 1)
+        self.assertGreater(stats["wait_max"], 0.05)
+
+
+class TestDispatcher(unittest.TestCase):
+
+    def test_submit(self):
+        dispatcher = Dispatcher(workers=4)
+        done = []
+        started = threading.Barrier(2, timeout=5)
+
+        def task(key: str, index: int) -> None:
+            if index == 0:
+                # Both keys must be processed at the same time to get through.
+                started.wait()
+            time.sleep(0.01)
+            done.append((key, index))
+
+        for index in range(5):
+            dispatcher.submit("a", task, "a", index)
+            dispatcher.submit("b", task, "b", index)
+        dispatcher.close()
+
+        # Tasks sharing a key ran in order.
+        self.assertListEqual([i for k, i in done if k == "a"], list(range(5)))
+        self.assertListEqual([i for k, i in done if k == "b"], list(range(5)))
+        self.assertFalse(dispatcher.shutdown_requested.done())
+
+    def test_shutdown_requested(self):
+        dispatcher = Dispatcher(workers=1)
+
+        def shutdown() -> None:
+            raise SystemExit
+
+        dispatcher.submit("a", shutdown)
+        self.assertTrue(dispatcher.shutdown_requested.result(timeout=5))
+        dispatcher.close()
+
+
+class TestOffsetCheckpoint(unittest.TestCase):
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "offset")
+            self.assertEqual(OffsetCheckpoint(path).load(), 0)
+            OffsetCheckpoint(path).save(1234)
+            self.assertEqual(OffsetCheckpoint(path).load(), 1234)
+
+
+class TestOutbox(unittest.TestCase):
+
+    class FakeBot:
+        def __init__(self):
+            self.sent = []
+            self.gate = threading.Event()  # Cleared to hold the messages being sent.
+            self.gate.set()
+
+        def send_message(self, chat_id: str, text: str, reply_to: str or None = None) -> str:
+            self.gate.wait(5)
+            self.sent.append((chat_id, text, reply_to))
+            return "response"
+
+    def setUp(self):
+        self.bot = self.FakeBot()
+        self.outbox = Outbox(self.bot, window=0.5, workers=2)
+
+    def tearDown(self):
+        self.outbox.close()
+
+    def test_put_first(self):
+        # A reply and the broadcast queued right after it, to an idle chat: a single API call.
+        outbox = Outbox(self.bot, window=0.5, workers=2, first_window=0.2)
+        try:
+            futures = [outbox.put("3", "New sequence: 1, 2, 3", 10), outbox.put("3", "Sequence changed.")]
+            for future in futures:
+                self.assertEqual(future.result(timeout=5), "response")
+        finally:
+            outbox.close()
+        self.assertListEqual(self.bot.sent, [("3", "New sequence: 1, 2, 3\n\nSequence changed.", 10)])
+
+    def test_put(self):
+        # Nothing else is pending for the chat: sent without waiting for the window.
+        start = time.monotonic()
+        self.assertEqual(self.outbox.put("2", "New SSH connection registered.").result(timeout=5), "response")
+        self.assertLess(time.monotonic() - start, self.outbox.window)
+        # The messages queued while the chat is being sent to are merged, identical ones included.
+        self.bot.gate.clear()
+        futures = [self.outbox.put("1", "New sequence: 1, 2, 3", 10)]
+        deadline = time.monotonic() + 5
+        while "1" not in self.outbox.in_flight and time.monotonic() < deadline:
+            time.sleep(0.01)
+        futures.append(self.outbox.put("1", "/status: running."))
+        futures.append(self.outbox.put("1", "/status: running."))
+        self.bot.gate.set()
+        for future in futures:
+            self.assertEqual(future.result(timeout=5), "response")
+        self.assertListEqual(self.bot.sent, [
+            ("2", "New SSH connection registered.", None),
+            ("1", "New sequence: 1, 2, 3", 10),
+            ("1", "/status: running.\n\n/status: running.", None),
+        ])
+
+    def test_merge(self):
+        long_text = "a" * (Outbox.max_message_length - 10)
+        merged = Outbox.merge([(long_text, None, 1), ("b", None, 2), ("c" * 20, None, 3)])
+        self.assertListEqual(merged, [(long_text + "\n\nb", None, [1, 2]), ("c" * 20, None, [3])])
+
+
+class TestPermissions(unittest.TestCase):
+
+    def setUp(self):
+        self.perms = Permissions()
+
+    def test_set_telegram_admins(self):
+        self.assertTrue(self.perms.is_group_valid("admin"))
+
+    def test_user_exists(self):
+        pass
+
+    def test_get_group_members(self):
+        users = [str(user_id) for user_id in range(1000, 1005)]
+        for user_id in users:
+            self._add_user_to_group(user_id, "guest")
+        self._add_user_to_group(users[0], "guest")
+        members = self.perms.get_group_members("guest")
+        self.assertEqual(members[-5:], users)
+        self.assertEqual(self.perms.count_group_members("guest"), len(members))
+        self.assertEqual(self.perms.get_group_members("guest", offset=len(members) - 4, limit=2), users[1:3])
+        self.assertEqual(self.perms.get_group_members("invalid"), [])
+        # The last member takes the place of the one removed.
+        self.perms.remove_user_from_group(users[1], "guest")
+        self.assertEqual(self.perms.get_group_members("guest")[-4:], [users[0], users[4], users[2], users[3]])
+        self.assertEqual(self.perms.count_group_members("guest"), len(members) - 1)
+        for user_id in users:
+            self.perms.remove_user_from_group(user_id, "guest")
+        self.assertEqual(self.perms.get_group_members("guest"), members[:-5])
+        self.assertEqual(self.perms.count_group_members("guest"), len(members) - 5)
+
+    def test_get_valid_groups(self):
+        pass
+
+    def test_is_group_valid(self):
+        pass
+
+    def test_create_user(self):
+        pass
+
+    def _add_user_to_group(self, user_id: str, group: str) -> None:
+        self.perms.add_user_to_group(user_id, group)
+
+    def test_remove_user_from_group(self):
+        """
+        Will test both add and remove.
+        """
+        user_id = "12345"
+        group = "admin"
+
+        group_before_add = self.perms.get_group_members(group)
+
+        self._add_user_to_group(user_id, group)
+
+        group_after_add = self.perms.get_group_members(group)
+        group_before_remove = group_after_add
+
+        self.perms.remove_user_from_group(user_id, group)
+
+        group_after_remove = self.perms.get_group_members(group)
+
+        # Make sure add works
+        self.assertNotEqual(group_before_add, group_after_add)
+        # Make sure remove works
+        self.assertNotEqual(group_before_remove, group_after_remove)
+        # Extra assert to test both (will pass if both are broken)
+        self.assertEqual(group_before_add, group_after_remove)
+
+    def test_bulk(self):
+        users = [str(user_id) for user_id in range(2000, 3000)]
+        syncs = []
+        sync = self.perms.db.backend.sync
+        self.perms.db.backend.sync = lambda: syncs.append(1) or sync()
+        try:
+            added, invalid = self.perms.import_memberships([[user_id, "member"] for user_id in users] + [["1", "x"]])
+            self.assertEqual(len(syncs), 1)
+        finally:
+            self.perms.db.backend.sync = sync
+        self.assertEqual((added, invalid), (1000, [["1", "x"]]))
+        self.assertEqual(self.perms.add_users_to_group(users[:10] + ["3000"], "member"), ["3000"])
+        self.assertTrue(self.perms.is_user_allowed("2500", ["manage_sequences"]))
+        self.assertEqual(len(self.perms.remove_users_from_group(users + ["3000", "3001"], "member")), 1001)
+        self.assertFalse(self.perms.is_user_allowed("2500", ["manage_sequences"]))
+        self.assertNotIn("2500", self.perms.get_group_members("member"))
+
+    def test_get_groups_permissions(self):
+        pass
+
+    def test_is_user_allowed(self):
+        user_id = "54321"
+        self.assertTrue(self.perms.is_user_allowed(user_id, ["none"]))
+        self.assertFalse(self.perms.is_user_allowed(user_id, ["manage_sequences"]))
+        self._add_user_to_group(user_id, "manager")
+        self.assertTrue(self.perms.is_user_allowed(user_id, ["manage_sequences", "modify_bot_behaviour"]))
+        self.assertFalse(self.perms.is_user_allowed(user_id, ["manage_sequences", "admin_access"]))
+        self.assertFalse(self.perms.is_user_allowed(user_id, ["unknown"]))
+        # The mask in memory is dropped when the groups change.
+        self.perms.remove_user_from_group(user_id, "manager")
+        self.assertFalse(self.perms.is_user_allowed(user_id, ["manage_sequences"]))
+        self.assertTrue(self.perms.is_user_allowed(self.perms.system_account, ["admin_access"]))
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_reserve(self):
+        bucket = TokenBucket(rate=10, capacity=2)
+        # The burst is allowed...
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        # ...then each token must be waited for.
+        self.assertAlmostEqual(bucket.reserve(), 0.1, delta=0.02)
+        self.assertAlmostEqual(bucket.reserve(), 0.2, delta=0.02)
+
+    def test_pause(self):
+        bucket = TokenBucket(rate=10, capacity=2)
+        bucket.pause(1)
+        self.assertGreaterEqual(bucket.reserve(), 1)
+
+
+class TestTelegramBot(MockTelegramTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.bot = TelegramBot()
+
+    def tearDown(self):
+        del self.bot
+        super().tearDown()
+
+    def test___set_identifier(self):
+        pass
+
+    def test___set_token(self):
+        pass
+
+    def test___is_token_valid(self):
+        Config.telegram_token = "invalid"
+        self.assertRaises(ValueError, TelegramBot)
+
+    def test_get_updates(self):
+        self.assertListEqual(self.bot.get_updates(timeout=0), [])
+        update = self.server.push_message(12345, 12345, "/help")
+        self.assertListEqual(self.bot.get_updates(timeout=0), [update])
+        # Updates are confirmed by requesting a higher offset.
+        self.assertListEqual(self.bot.get_updates(update['update_id'] + 1, timeout=0), [])
+
+    def test_get_updates_errors(self):
+        self.server.error_rate = 1
+        self.assertListEqual(self.bot.get_updates(timeout=0), [])
+        self.assertEqual(self.server.calls["getUpdates"], Config.telegram_max_retries + 1)
+
+    def test_get_updates_refused(self):
+        self.server.webhook_url = "https://example.com/webhook"
+        with self.assertLogs(level="ERROR") as logs:
+            self.assertListEqual(self.bot.get_updates(timeout=0), [])
+        self.assertIn("code 409", logs.output[0])
+        # Not retried.
+        self.assertEqual(self.server.calls["getUpdates"], 1)
+
+    def test_send_message(self):
+        resp = self.bot.send_message("12345", "Hello", 42)
+        self.assertTrue(resp.ok)
+        self.assertEqual(self.server.sent[0][1:], ("12345", "Hello", "42"))
+
+    def test_send_message_retry(self):
+        # Every request fails, until the errors are disabled.
+        self.server.error_rate = 1
+        threading.Timer(0.05, setattr, (self.server, "error_rate", 0)).start()
+        Config.telegram_backoff_base = 0.05
+        self.assertTrue(self.bot.send_message("12345", "Hello").ok)
+        self.assertGreater(self.server.calls["sendMessage"], 1)
+
+    def test_send_message_timeout(self):
+        # The message is received, but the response comes too late: it is not sent again.
+        self.server.latency = 0.3
+        backup = Config.telegram_read_timeout
+        Config.telegram_read_timeout = 0.1
+        try:
+            self.assertRaises(UncertainRequest, self.bot.send_message, "12345", "Hello")
+        finally:
+            Config.telegram_read_timeout = backup
+        self.assertEqual(self.server.calls["sendMessage"], 1)
+        # Nor queued to be broadcast again.
+        self.assertEqual(Channels.get_delivery_outcome(UncertainRequest()), "failed")
+
+
+class TestUserList(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "users.txt")
+        self.backup = Config.user_lists_check_interval
+        Config.user_lists_check_interval = 0
+
+    def tearDown(self):
+        Config.user_lists_check_interval = self.backup
+        self.directory.cleanup()
+
+    def write(self, content: str, mode: str = "w") -> None:
+        with open(self.path, mode) as file:
+            file.write(content)
+        # The changes must be visible even within the resolution of the modification time.
+        os.utime(self.path, ns=(0, time.time_ns() + random.randrange(1, 10 ** 9)))
+
+    def test_reload(self):
+        self.write("# Comment\n100\n101\n\n102")
+        users = UserList([1], self.path)
+        # The last line is not complete: it only counts once the file is unchanged at the next check.
+        self.assertNotIn("102", users.settled_ids)
+        self.assertTrue(users)
+        for user_id in ["1", "100", "101", "102"]:
+            self.assertIn(user_id, users)
+        self.assertNotIn("# Comment", users)
+        # It is read again at each check.
+        self.assertEqual(users.offset, len("# Comment\n100\n101\n\n"))
+        # Being written: the prefix of the ID does not count.
+        self.write("3", "a")
+        self.assertNotIn("1023", users)
+        self.write("\n103\n", "a")
+        self.assertIn("1023", users)
+        self.assertNotIn("102", users)
+        self.assertIn("103", users)
+        # Only the new lines are read.
+        offset = users.offset
+        self.write("104\n", "a")
+        self.assertIn("104", users)
+        self.assertEqual(users.offset, offset + 4)
+        # Rewritten.
+        self.write("105\n")
+        self.assertIn("105", users)
+        self.assertNotIn("100", users)
+        self.assertIn("1", users)
+        # Deleted: the IDs are kept.
+        os.remove(self.path)
+        self.assertIn("105", users)
+        self.assertFalse(UserList([]))
+
+
+class TestUtils(unittest.TestCase):
+
+    def test_start_service(self):
+        pass
+
+    def test_stop_service(self):
+        pass
+
+    def test_restart_service(self):
+        pass
+
+    def test_install_package(self):
+        pass
+
+    def test_filter_port_list(self):
+        backup = Config.acceptable_port_range, Config.ports_blacklist
+        Config.acceptable_port_range, Config.ports_blacklist = range(2000, 2100), list(range(2010, 2050))
+        try:
+            self.assertEqual(Utils.filter_port_list([2000, 2010, 2049, 2050, 1000, 2099, 2100]),
+                             [2000, 2050, 2050, 2050, 2000, 2099, 2001])
+        finally:
+            Config.acceptable_port_range, Config.ports_blacklist = backup
+
+
+class TestWebhookServer(unittest.TestCase):
+
+    class FakePKS:
+        def __init__(self):
+            self.processed = []
+            self.event = threading.Event()
+
+        def is_update_processable(self, update: dict) -> bool:
+            return True
+
+        def process(self, update: dict) -> None:
+            self.processed.append(update)
+            self.event.set()
+
+    def setUp(self):
+        self.pks = self.FakePKS()
+        self.server = WebhookServer(self.pks, host="127.0.0.1", port=0, path="/pks", secret_token="secret", workers=1)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = f"http://127.0.0.1:{self.server.port}"
+        self.headers = {"X-Telegram-Bot-Api-Secret-Token": "secret"}
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+
+    def test_process_update(self):
+        update = {
+            "update_id": 1,
+            "message": {"message_id": 1, "date": 0, "text": "/help", "chat": {"id": 12345}, "from": {"id": 12345}},
+        }
+        resp = requests.post(self.url + "/pks", json=update, headers=self.headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(self.pks.event.wait(5))
+        self.assertListEqual(self.pks.processed, [update])
+
+    def test_reject_invalid_requests(self):
+        self.assertEqual(requests.post(self.url + "/other", json={}, headers=self.headers).status_code, 404)
+        self.assertEqual(requests.post(self.url + "/pks", json={}).status_code, 403)
+        self.assertEqual(requests.post(self.url + "/pks", data="{", headers=self.headers).status_code, 400)
+        self.assertListEqual(self.pks.processed, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+# -*- coding: UTF8 -*-
+
+import logging
+import threading
+import weakref
+import hashlib
+import hmac
+import struct
+import time
+
+from .config import Config
+from .portindex import PortIndex
+
+
+class TimeSequences:
+
+    """
+    Sequences derived from a secret shared with the clients and the current time step, as TOTP codes are (RFC 6238):
+    the i-th port of the sequence of time step t is HMAC-SHA256(secret, t || i), mapped to an acceptable port
+    (see `PortIndex.from_integer()`).
+    The client (see `pksclient`) computes the current sequence on its own: knocking does not wait for Telegram.
+
+    The sequences of the previous step (clocks may drift), of the current one and of the `Config.sequence_time_windows`
+    next ones are written to knockd in advance, so knockd is only reconfigured every `Config.sequence_time_windows`
+    steps, by a timer (see `start()`).
+
+    Usage:
+
+    >>> sequences = TimeSequences(Config.sequence_secret)
+    >>> sequences.sequence()
+    [20523, 48216, 7129]
+    """
+
+    def __init__(self, secret: str, step: int or None = None, windows: int or None = None):
+        """
+        The parameters left to None take their value from the configuration (`Config.sequence_time_*`).
+
+        :param str secret: The secret shared with the clients.
+        :param int|None step: Duration of a time step, in seconds.
+        :param int|None windows: Number of time steps written to knockd after the current one.
+        """
+        step = Config.sequence_time_step if step is None else step
+        windows = Config.sequence_time_windows if windows is None else windows
+        self.secret = secret.encode("utf-8")
+        self.step = step
+        self.windows = max(1, windows)
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def __del__(self):
+        self.close()
+
+    @staticmethod
+    def derive(secret: bytes, window: int, length: int, index: PortIndex) -> list:
+        """
+        :param bytes secret: The secret shared with the clients.
+        :param int window: A time step: the number of steps since the epoch.
+        :param int length: Number of ports.
+        :param PortIndex index: The acceptable ports.
+        :return list: The sequence of this time step.
+        """
+        return [
+            index.from_integer(
+                int.from_bytes(hmac.new(secret, struct.pack(">QI", window, i), hashlib.sha256).digest(), "big")
+            ) for i in range(length)
+        ]
+
+    def window(self, now: float or None = None) -> int:
+        """
+        :param float|None now: Optional. A timestamp ; by default, the current time.
+        :return int: The time step it belongs to.
+        """
+        if now is None:
+            now = time.time()
+        return int(now // self.step)
+
+    def sequence(self, window: int or None = None) -> list:
+        """
+        :param int|None window: Optional. A time step ; by default, the current one.
+        :return list: Its sequence of `Config.sequences_length` ports.
+        """
+        if window is None:
+            window = self.window()
+        return self.derive(self.secret, window, Config.sequences_length, PortIndex.current())
+
+    def sequences(self, now: float or None = None) -> dict:
+        """
+        :param float|None now: Optional. A timestamp ; by default, the current time.
+        :return dict: Time step -> sequence, from the step before the current one to the last written in advance.
+        """
+        current = self.window(now)
+        return {window: self.sequence(window) for window in range(current - 1, current + self.windows + 1)}
+
+    def apply(self) -> list:
+        """
+        Writes the sequences of the previous, current and next time steps to knockd, and restarts it.
+
+        :return list: The sequence of the current time step.
+        """
+        # Imported here: Core depends on this module.
+        from .core import Core
+        with self.lock:
+            sequences = self.sequences()
+            Core.set_open_sequence(*sequences.values())
+            logging.info(f"Wrote the sequences of the time steps {min(sequences)} to {max(sequences)} to knockd.")
+            return sequences[min(sequences) + 1]
+
+    @staticmethod
+    def __apply_reference(reference: weakref.ref) -> None:
+        """
+        Writes the next sequences to knockd, unless the instance has been deleted in the meantime.
+        """
+        sequences = reference()
+        if sequences is None:
+            return
+        try:
+            sequences.apply()
+        except Exception:
+            logging.exception("Could not write the time-based sequences to knockd.")
+        sequences.start(apply=False)
+
+    def start(self, apply: bool = True) -> None:
+        """
+        Writes the sequences to knockd, and schedules the next writes,
+        every `windows` steps, just as the last step written begins.
+
+        :param bool apply: Whether the sequences are written right away.
+        """
+        if apply:
+            self.apply()
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            delay = (self.window() + self.windows) * self.step - time.time()
+            self.timer = threading.Timer(max(0.0, delay), self.__apply_reference, (weakref.ref(self), ))
+            self.timer.daemon = True
+            self.timer.start()
+
+    def close(self) -> None:
+        """
+        Stops rewriting knockd's configuration.
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+    def remaining(self, now: float or None = None) -> float:
+        """
+        :param float|None now: Optional. A timestamp ; by default, the current time.
+        :return float: Number of seconds before the current time step ends.
+        """
+        if now is None:
+            now = time.time()
+        return (self.window(now) + 1) * self.step - now
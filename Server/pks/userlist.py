@@ -0,0 +1,126 @@
+# -*- coding: UTF8 -*-
+
+import logging
+import threading
+import time
+import os
+
+from .config import Config
+
+
+class UserList:
+
+    """
+    A set of Telegram user IDs: those of a list, and optionally those of a file, one per line.
+    Empty lines and lines starting with "#" are ignored.
+
+    The file is checked at most every `Config.user_lists_check_interval` seconds, and reloaded when it changed.
+    When lines were only appended to it, only these are read.
+    The last line, while it does not end with a newline, may still be being written: it is read again at each check,
+    until it is complete. Its IDs only count once the file is unchanged at the next check (i.e. the last line of a file
+    edited by hand, without a final newline).
+    If the file can no longer be read, the IDs loaded before are kept.
+
+    Usage:
+
+    >>> whitelist = UserList(Config.telegram_user_whitelist, Config.telegram_user_whitelist_file)
+    >>> "01234" in whitelist
+    """
+
+    def __init__(self, user_ids: list, path: str or None = None):
+        """
+        :param list user_ids: User IDs.
+        :param str|None path: Optional. A file listing other user IDs. It must exist.
+        """
+        self.user_ids = {str(user_id) for user_id in user_ids}
+        self.path = path
+        self.lock = threading.Lock()
+        self.file_ids = set()
+        # The IDs of the last line of the file, if it is not complete: read (`partial_ids`), and counted
+        # once the file was found unchanged at the next check (`settled_ids`).
+        self.partial_ids = set()
+        self.settled_ids = set()
+        self.checked = time.monotonic()
+        # The state of the file when it was read, and the number of bytes of complete lines read.
+        self.stat = None
+        self.offset = 0
+        # The last bytes of complete lines read, to tell whether the file was only appended to.
+        self.tail = b""
+        if self.path:
+            self.__load()
+
+    def __contains__(self, user_id: str) -> bool:
+        self.__check()
+        return user_id in self.user_ids or user_id in self.file_ids or user_id in self.settled_ids
+
+    def __bool__(self) -> bool:
+        self.__check()
+        return bool(self.user_ids or self.file_ids or self.settled_ids)
+
+    @staticmethod
+    def __parse(data: bytes) -> set:
+        """
+        :param bytes data: Lines of the file.
+        :return set: The user IDs they list.
+        """
+        user_ids = set()
+        for line in data.decode("utf-8").splitlines():
+            line = line.strip()
+            if line and not line.startswith("#"):
+                user_ids.add(line)
+        return user_ids
+
+    def __check(self) -> None:
+        """
+        Reloads the file if it changed, at most every `Config.user_lists_check_interval` seconds.
+        """
+        if not self.path or time.monotonic() - self.checked < Config.user_lists_check_interval:
+            return
+        if not self.lock.acquire(blocking=False):
+            # Another thread is checking: use the current IDs.
+            return
+        try:
+            self.checked = time.monotonic()
+            try:
+                self.__load()
+            except OSError as error:
+                logging.warning(f"Could not reload the user list {self.path}, keeping the previous one: {error}")
+        finally:
+            self.lock.release()
+
+    def __load(self) -> None:
+        """
+        Reads the new lines of the file, or the whole file if it was not only appended to.
+        Only the complete lines are counted as read.
+        """
+        with open(self.path, "rb") as file:
+            stat = os.fstat(file.fileno())
+            if self.stat is not None and (stat.st_mtime_ns, stat.st_size) == self.stat[1:]:
+                # The last line is not being written anymore.
+                self.settled_ids = self.partial_ids
+                return
+            appended = False
+            if self.stat is not None and stat.st_ino == self.stat[0] and stat.st_size >= self.offset:
+                file.seek(self.offset - len(self.tail))
+                appended = file.read(len(self.tail)) == self.tail
+            if not appended:
+                file.seek(0)
+                self.offset = 0
+            data = file.read()
+        # The last line, if it is not complete, is read again at the next check.
+        end = data.rfind(b"\n") + 1
+        data, self.partial_ids = data[:end], self.__parse(data[end:])
+        self.settled_ids = set()
+        user_ids = self.__parse(data)
+        if appended:
+            self.file_ids.update(user_ids)
+            self.tail = (self.tail + data)[-64:]
+            logging.info(f"User list {self.path} reloaded: {len(user_ids)} IDs appended.")
+        else:
+            if self.stat is not None:
+                logging.info(f"User list {self.path} reloaded: {len(user_ids - self.file_ids)} IDs added, "
+                             f"{len(self.file_ids - user_ids)} removed.")
+            self.file_ids = user_ids
+            self.tail = data[-64:]
+        self.offset += len(data)
+        self.stat = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
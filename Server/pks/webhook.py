@@ -0,0 +1,131 @@
+# -*- coding: UTF8 -*-
+
+import json
+import logging
+import ssl
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .config import Config
+from .dispatcher import Dispatcher
+
+
+class WebhookServer:
+
+    """
+
+    Small HTTP(S) server receiving the updates pushed by Telegram, used instead of long polling.
+
+    Each update is acknowledged right away, then handed to a pool of workers
+    which pass it through the same pipeline as the polling loop (`PKS.process`).
+    The updates of a same chat are processed in the order they were received.
+
+    It can be tested locally by POSTing a recorded update to it, for instance:
+
+    curl -X POST -H "Content-Type: application/json" -d @update.json http://127.0.0.1:8443/pks
+
+    .. seealso :: PKS.main_webhook()
+
+    """
+
+    def __init__(self, pks, host: str or None = None, port: int or None = None, path: str or None = None,
+                 secret_token: str or None = None, workers: int or None = None):
+        """
+        The parameters left to None take their value from the configuration (`Config.webhook_*`).
+
+        :param PKS pks: The object processing the updates.
+        :param str|None host: Address to listen on.
+        :param int|None port: Port to listen on. 0 picks a free port (see attribute `port`).
+        :param str|None path: The only path on which updates are accepted.
+        :param str|None secret_token: Expected value of the header "X-Telegram-Bot-Api-Secret-Token". Empty to disable.
+        :param int|None workers: Number of threads processing the updates.
+        """
+        host = Config.webhook_host if host is None else host
+        port = Config.webhook_port if port is None else port
+        path = Config.webhook_path if path is None else path
+        secret_token = Config.webhook_secret_token if secret_token is None else secret_token
+        workers = Config.webhook_workers if workers is None else workers
+        self.pks = pks
+        self.path = path
+        self.secret_token = secret_token
+        self.dispatcher = Dispatcher(workers)
+        self.shutdown_requested = False
+        self.httpd = ThreadingHTTPServer((host, port), self.__get_handler_class())
+        self.httpd.daemon_threads = True
+        if Config.webhook_certfile:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(Config.webhook_certfile, Config.webhook_keyfile or None)
+            self.httpd.socket = context.wrap_socket(self.httpd.socket, server_side=True)
+        self.port = self.httpd.server_address[1]
+
+    def __get_handler_class(self) -> type:
+        """
+        :return type: A request handler class bound to this server.
+        """
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self) -> None:
+                if self.path != server.path:
+                    self.send_error(404)
+                    return
+                if server.secret_token and \
+                        self.headers.get("X-Telegram-Bot-Api-Secret-Token") != server.secret_token:
+                    self.send_error(403)
+                    return
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    update = json.loads(self.rfile.read(length))
+                except ValueError:
+                    self.send_error(400)
+                    return
+                # Answer immediately ; Telegram would otherwise send the update again.
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                server.submit(update)
+
+            def log_message(self, format: str, *args) -> None:
+                logging.debug("Webhook: " + format, *args)
+
+        return Handler
+
+    def submit(self, update: dict) -> None:
+        """
+        Queues an update for processing.
+
+        :param dict update: A Telegram update.
+        """
+        if self.pks.is_update_processable(update):
+            logging.debug(update)
+            self.dispatcher.submit(update['message']['chat']['id'], self.__process, update)
+
+    def __process(self, update: dict) -> None:
+        try:
+            self.pks.process(update)
+        except SystemExit:
+            self.shutdown_requested = True
+            # Must be called from another thread than the one serving.
+            threading.Thread(target=self.httpd.shutdown).start()
+        except Exception:
+            logging.exception(f"Could not process update {update.get('update_id')}.")
+
+    def serve_forever(self) -> None:
+        """
+        Serves until `shutdown()` is called, or until a command asks for the bot to shutdown.
+        The updates already received are processed before returning.
+        """
+        logging.info(f"Webhook server listening on port {self.port}.")
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.httpd.server_close()
+            self.dispatcher.close()
+
+    def shutdown(self) -> None:
+        """
+        Stops the server. Must not be called from the thread running `serve_forever()`.
+        """
+        self.httpd.shutdown()
@@ -1,20 +1,26 @@
-# -*- coding: UTF8 -*-
-
-import sys
-
-import pks
-
-
-if not sys.platform.startswith("linux"):
-    input("This server can only run on Linux distributions. Press enter to quit...")
-    exit()
-
-bot = pks.TelegramBot()
-pk = pks.PKS(bot)
-
-try:
-    pk.main()
-except SystemExit:
-    del pk
-    del bot
-    exit(0)
+# -*- coding: UTF8 -*-
+
+import sys
+import asyncio
+
+import pks
+
+
+if not sys.platform.startswith("linux"):
+    input("This server can only run on Linux distributions. Press enter to quit...")
+    exit()
+
+bot = pks.TelegramBot()
+pk = pks.PKS(bot)
+
+try:
+    if pks.Config.engine == "async":
+        asyncio.run(pk.main_async())
+    elif pks.Config.engine == "webhook":
+        pk.main_webhook()
+    else:
+        pk.main()
+except SystemExit:
+    del pk
+    del bot
+    exit(0)
@@ -1,17 +1,19 @@
-# -*- coding: UTF8 -*-
-
-import pks
-
-if not pks.Config.use_open_sequence:
-    bot = pks.BotHandler()  # Create a new bot instance
-
-    chan = pks.Channels(bot)
-    cmd = pks.Commands(chan)
-
-    message = "New SSH connection registered.\n"
-    message += cmd.generate()
-
-    if type(message) == str:
-        chan.broadcast(message)
-
-    del bot
+# -*- coding: UTF8 -*-
+
+import pks
+
+# Time-based sequences rotate on their own, and are computed by the clients.
+if not pks.Config.use_open_sequence and not pks.Config.sequence_secret:
+    bot = pks.TelegramBot()  # Create a new bot instance
+
+    chan = pks.Channels(bot)
+    cmd = pks.Commands(chan)
+
+    message = "New SSH connection registered.\n"
+    # Run as the system account, which has every right.
+    message += cmd.generate(user_id=pks.Permissions.system_account)
+
+    if type(message) == str:
+        chan.broadcast(message)
+
+    del bot